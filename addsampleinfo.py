@@ -4,11 +4,11 @@ from pathlib import Path
 import subprocess
 import sys
 import time
-from typing import Set
-import shutil
 
 # your interface
 from extracttool import extract_apk_info
+from iconml_fsevents import DirWatcher
+from iconml_handoff import atomic_move
 
 DEFAULT_OUTDIR = Path("./download")
 CLIENT_PATH = Path("./tool/linux_client")
@@ -102,32 +102,13 @@ def ensure_dir(p: Path):
     p.mkdir(parents=True, exist_ok=True)
 
 
-def stable_new_files(dirpath: Path, known: Set[Path]) -> list[Path]:
-    """
-    返回新增且“稳定”的 txt 文件（大小不再变化）。
-    """
-    result = []
-    for f in dirpath.glob("*.txt"):
-        if f in known:
-            continue
-        try:
-            s1 = f.stat().st_size
-            time.sleep(0.2)
-            s2 = f.stat().st_size
-            if s1 == s2 and s1 > 0:
-                result.append(f)
-        except FileNotFoundError:
-            pass
-    return result
-
-
 def move_to_processed(src: Path, dst_dir: Path = PROCESSED_DIR):
     ensure_dir(dst_dir)
     dst = dst_dir / src.name
     if dst.exists():
         base, ext = os.path.splitext(src.name)
         dst = dst_dir / f"{base}_{int(time.time())}{ext}"
-    shutil.move(str(src), str(dst))
+    atomic_move(str(src), str(dst))
     print(f"[MOVE] {src.name} -> {dst}")
 
 
@@ -160,17 +141,19 @@ def main():
     client = ensure_client()
     print(f"[INIT] Using client: {client}")
 
-    seen: Set[Path] = set()
+    # 写完（close_write / rename 进来）的 txt 才会被产出；无需逐文件 sleep
+    watcher = DirWatcher(str(ADDSAMPLES_DIR), suffixes=(".txt",), poll_interval=POLL_INTERVAL)
 
-    print(f"[WATCH] Monitoring directory: {ADDSAMPLES_DIR.resolve()}")
+    print(f"[WATCH] Monitoring directory: {ADDSAMPLES_DIR.resolve()} (mode={watcher.mode})")
     while True:
         try:
-            new_files = stable_new_files(ADDSAMPLES_DIR, seen)
+            new_files = [Path(p) for p in watcher.ready(timeout=POLL_INTERVAL)]
             if new_files:
                 print(f"[DETECT] Found {len(new_files)} new txt file(s): {[f.name for f in new_files]}")
 
             for txt in new_files:
-                seen.add(txt)
+                if not txt.exists():
+                    continue
                 try:
                     process_txt_file(client, txt, DEFAULT_OUTDIR)
                     move_to_processed(txt, PROCESSED_DIR)
@@ -178,8 +161,7 @@ def main():
                     print(f"[FATAL] Error processing {txt.name}: {e}")
                     # 默认 continue-on-error
                     move_to_processed(txt, PROCESSED_DIR)
-
-            time.sleep(POLL_INTERVAL)
+                watcher.forget(str(txt))
         except KeyboardInterrupt:
             print("\n[EXIT] KeyboardInterrupt. Exiting watcher.")
             break
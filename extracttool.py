@@ -1,4 +1,5 @@
 import os
+import io
 import subprocess
 import zipfile
 import tempfile
@@ -8,6 +9,7 @@ import struct
 import zlib
 import hashlib
 from devid import getsignsha1
+from iconml_handoff import atomic_write_bytes, atomic_write_text
 
 def calc_combined_png_md5(file_path):
     with open(file_path, 'rb') as f:
@@ -310,9 +312,8 @@ def extract_icon(apk_path, icon_path_list, output_basename="resolved_icon", only
                 if path.find(".jpg")>0:
                     ext = ext.replace(".png",".jpg")
                 output_name = f"{output_basename}_{count}{ext}"
-                with open(output_name, 'wb') as f:
-                    f.write(zf.read(path))
-                f.close()
+                # tmp + rename，基准库加载方不会读到半截图标
+                atomic_write_bytes(output_name, zf.read(path))
                 crc=""
                 if output_name.find(".png")>0:
                     crc=calc_png_crc(output_name)
@@ -393,7 +394,7 @@ def extract_apk_info(apk_path):
     if thumbprint:
         print("[+] Certificate Thumbprint:", thumbprint)
     
-    fw=open("./info/"+info['package']+".txt","w")
+    fw=io.StringIO()
     fw.write(f"[+] Analyzing APK: {apk_path}\n")
     fw.write("package: "+info['package']+"\n")
     fw.write("label: "+info['label']+"\n\n")
@@ -407,7 +408,7 @@ def extract_apk_info(apk_path):
     fw.write("\nIcon hash:\n")
     for item in crclist:
         fw.write("    "+item[0]+"="+f"{item[1]:08X}"+"\n")
-    fw.close()
+    atomic_write_text("./info/"+info['package']+".txt", fw.getvalue())
 
 
 def main(apk_path):
@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+IconML S3 Client – importable, futures-based API
+
+    from iconml_client import IconMLClient
+
+    with IconMLClient(bucket="mr-dev-iconml-request") as c:
+        futs = [c.submit_icon(p, request={"hash": h, "icon_filename": p.name}) for h, p in items]
+        for f in futs:
+            res = f.result()        # {"imageresult": {...}, "inforesult": {...} or None}
+
+        batch = c.submit_hash_batch(txt_path="./batch_2025_11_10.txt").result()
+        # {hash: {"hash", "status", "icon_base", "inforesult", "imageresult"}}
+
+Submissions (uploads) run on a bounded thread pool. One shared background poller
+resolves all pending result keys: pending keys are grouped by a short name prefix and
+each group is resolved with one list_objects_v2 call (StartAfter just before the
+smallest pending key), instead of one HEAD per key per poll. Found results are
+fetched on the same bounded pool. Futures fail with TimeoutError after max_wait.
+Listing errors are logged and retried with backoff; if the poller stops (close(), or an
+unexpected exit) every pending future fails instead of hanging.
+
+submit_bulk() takes a directory of icons plus request dicts (e.g. from a JSONL file),
+names every icon by its content (<sha256>.<ext>), uploads each distinct icon at most once,
+and skips icons whose object or image result already exists in the bucket.
+
+Running this file as a script is the same as iconml_request_demo.py (CLI).
+"""
+
+import os
+import json
+import hashlib
+import logging
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from iconml_layout import PARTITION_LEVELS, partition_key
+from iconml_request_demo import (
+    DEFAULT_BUCKET, DEFAULT_MAX_WAIT_SECS, DEFAULT_POLL_SECS, DEFAULT_REGION,
+    PREFIX_IMAGERESULTS, PREFIX_IMAGES, PREFIX_INFORESULTS, PREFIX_REQUEST,
+    PREFIX_REQUESTBYHASH, PREFIX_REQUESTBYHASH_BUNDLE, PREFIX_REQUESTBYHASH_DONE,
+    image_result_name, is_not_found, read_hash_lines, s3_iter_jsonl_gz,
+)
+
+DEFAULT_WORKERS   = 16
+PROBE_PREFIX_LEN  = 2      # pending keys sharing this many leading name chars share one LIST
+POLL_MAX_BACKOFF  = 30.0   # cap on the poll interval after consecutive listing errors
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+
+def sha256_file(path, bufsize: int = 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(bufsize), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _combine(out: Future, parts: Dict[str, Optional[Future]]):
+    """Resolve `out` with {name: result} once every non-None part is done; fail on the first error."""
+    result: Dict[str, Any] = {k: None for k in parts}
+    pending = {k: f for k, f in parts.items() if f is not None}
+    left = [len(pending)]
+    lock = threading.Lock()
+    if not pending:
+        out.set_result(result)
+        return
+
+    def _done(k: str, f: Future):
+        exc = f.exception()
+        with lock:
+            if out.done():
+                return
+            if exc is not None:
+                out.set_exception(exc)
+                return
+            result[k] = f.result()
+            left[0] -= 1
+            if left[0] == 0:
+                out.set_result(result)
+
+    for k, f in pending.items():
+        f.add_done_callback(lambda f, k=k: _done(k, f))
+
+
+class _Wait:
+    __slots__ = ("future", "deadline", "fetch")
+
+    def __init__(self, deadline: float, fetch: Optional[Callable[[str], Any]]):
+        self.future: Future = Future()
+        self.deadline = deadline
+        self.fetch = fetch
+
+
+class ResultPoller(threading.Thread):
+    """Shared background poller: many pending keys per listing, bounded concurrent fetches."""
+    def __init__(self, s3, bucket: str, pool: ThreadPoolExecutor,
+                 poll_secs: float = DEFAULT_POLL_SECS, probe_prefix_len: int = PROBE_PREFIX_LEN):
+        super().__init__(daemon=True, name="iconml-poller")
+        self.s3 = s3
+        self.bucket = bucket
+        self.pool = pool
+        self.poll_secs = poll_secs
+        self.probe_prefix_len = probe_prefix_len
+        self._lock = threading.Lock()
+        self._waits: Dict[str, List[_Wait]] = {}
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._closed = False           # set once the loop has exited; later waits fail at once
+        self._errors = 0               # consecutive cycles with listing errors (backoff)
+
+    def wait_for(self, key: str, max_wait: float,
+                 fetch: Optional[Callable[[str], Any]] = None) -> Future:
+        """
+        Future resolved once `key` exists. fetch(key) runs on the pool to build the result;
+        by default the object is read as JSON. Pass fetch=lambda k: True to only wait.
+        """
+        w = _Wait(time.time() + max_wait, fetch or self._get_json)
+        with self._lock:
+            if self._closed:
+                w.future.set_exception(RuntimeError(f"result poller stopped; not waiting for {key}"))
+                return w.future
+            self._waits.setdefault(key, []).append(w)
+        return w.future
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+    # ---------------- internals ----------------
+    def _get_json(self, key: str) -> Dict[str, Any]:
+        r = self.s3.get_object(Bucket=self.bucket, Key=key)
+        return json.loads(r["Body"].read().decode("utf-8", errors="replace"))
+
+    def _groups(self, keys: Iterable[str]) -> Dict[str, List[str]]:
+        out: Dict[str, List[str]] = {}
+        for k in keys:
+            d, name = k.rsplit("/", 1) if "/" in k else ("", k)
+            prefix = (d + "/" if d else "") + name[:self.probe_prefix_len]
+            out.setdefault(prefix, []).append(k)
+        return out
+
+    def exists_many(self, keys: Iterable[str]) -> set:
+        """Synchronous existence check for many keys with the same grouped LISTs as the poll loop."""
+        found = set()
+        for prefix, group in self._groups(set(keys)).items():
+            found.update(self._probe(prefix, group))
+        return found
+
+    def _probe(self, prefix: str, keys: List[str]) -> List[str]:
+        """One paginated LIST over [min(keys), max(keys)] under prefix; returns the keys that exist."""
+        want = set(keys)
+        lo, hi = min(keys), max(keys)
+        # any string just below `lo` works as StartAfter; extra keys in between are skipped
+        start_after = lo[:-1] + chr(ord(lo[-1]) - 1) if lo and ord(lo[-1]) > 0 else None
+        found: List[str] = []
+        token = None
+        while True:
+            params = {"Bucket": self.bucket, "Prefix": prefix}
+            if token:
+                params["ContinuationToken"] = token
+            elif start_after:
+                params["StartAfter"] = start_after
+            resp = self.s3.list_objects_v2(**params)
+            past = False
+            for c in resp.get("Contents", []):
+                if c["Key"] in want:
+                    found.append(c["Key"])
+                if c["Key"] >= hi:
+                    past = True
+                    break
+            if past or not resp.get("IsTruncated"):
+                return found
+            token = resp.get("NextContinuationToken")
+
+    def _deliver(self, key: str, waits: List[_Wait]):
+        for w in waits:
+            if not w.future.set_running_or_notify_cancel():
+                continue
+            try:
+                w.future.set_result(w.fetch(key))
+            except BaseException as e:
+                w.future.set_exception(e)
+
+    def _cycle(self) -> bool:
+        """One pass: expire deadlines, probe every group. Returns False if any listing failed."""
+        now = time.time()
+        with self._lock:
+            for key in list(self._waits):
+                alive = []
+                for w in self._waits[key]:
+                    if w.future.cancelled():
+                        continue
+                    if now > w.deadline:
+                        w.future.set_exception(TimeoutError(f"not ready: s3://{self.bucket}/{key}"))
+                        continue
+                    alive.append(w)
+                if alive:
+                    self._waits[key] = alive
+                else:
+                    self._waits.pop(key)
+            keys = list(self._waits)
+        ok = True
+        for prefix, group in self._groups(keys).items():
+            try:
+                found = self._probe(prefix, group)
+            except Exception as e:       # ClientError, and BotoCoreError (connection/read timeouts)
+                logging.warning(f"[POLL] list {prefix} failed: {e}")
+                ok = False
+                continue
+            for key in found:
+                with self._lock:
+                    waits = self._waits.pop(key, [])
+                if waits:
+                    self.pool.submit(self._deliver, key, waits)
+        return ok
+
+    def _fail_pending(self, exc: BaseException):
+        with self._lock:
+            self._closed = True
+            waits = [w for ws in self._waits.values() for w in ws]
+            self._waits.clear()
+        for w in waits:
+            if not w.future.done():
+                w.future.set_exception(exc)
+
+    def run(self):
+        try:
+            while not self._stopped.is_set():
+                try:
+                    ok = self._cycle()
+                except Exception as e:
+                    logging.exception(f"[POLL] cycle failed: {e}")
+                    ok = False
+                self._errors = 0 if ok else self._errors + 1
+                delay = min(self.poll_secs * (2 ** min(self._errors, 10)), max(POLL_MAX_BACKOFF, self.poll_secs))
+                # results take at least one server round, so new waits do not wake the poller
+                self._wake.wait(delay)
+        finally:
+            self._fail_pending(RuntimeError(f"result poller stopped (s3://{self.bucket})"))
+
+
+class IconMLClient:
+    def __init__(self,
+                 bucket: str = DEFAULT_BUCKET,
+                 profile: Optional[str] = None,
+                 region: Optional[str] = DEFAULT_REGION,
+                 partition_levels: int = PARTITION_LEVELS,
+                 poll_secs: float = DEFAULT_POLL_SECS,
+                 max_wait: float = DEFAULT_MAX_WAIT_SECS,
+                 workers: int = DEFAULT_WORKERS,
+                 s3=None):
+        self.bucket = bucket
+        self.partition_levels = partition_levels
+        self.max_wait = max_wait
+        if s3 is None:
+            session = boto3.Session(profile_name=profile, region_name=region)
+            s3 = session.client("s3", config=Config(max_pool_connections=workers + 4,
+                                                   retries={"max_attempts": 8, "mode": "adaptive"}))
+        self.s3 = s3
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="iconml")
+        self.transfer_config = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+                                              multipart_chunksize=MULTIPART_THRESHOLD, use_threads=True)
+        self.poller = ResultPoller(s3, bucket, self.pool, poll_secs=poll_secs)
+        self.poller.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.poller.stop()
+        self.pool.shutdown(wait=True)
+
+    def _key(self, prefix: str, name: str) -> str:
+        return partition_key(prefix, name, self.partition_levels)
+
+    def _submit(self, out: Future, fn: Callable, *args):
+        """Run fn on the pool; its exceptions fail `out`."""
+        def _run():
+            try:
+                fn(*args)
+            except BaseException as e:
+                if not out.done():
+                    out.set_exception(e)
+        self.pool.submit(_run)
+        return out
+
+    # ---------------- icon + request json ----------------
+    def submit_icon(self, icon_path, request: Optional[Dict[str, Any]] = None,
+                    request_path=None, max_wait: Optional[float] = None) -> Future:
+        """
+        Upload icon + request json and return a Future of
+        {"imageresult": dict, "inforesult": dict or None (icon-only request)}.
+        """
+        icon_path = Path(icon_path).expanduser().resolve()
+        if request is None:
+            with Path(request_path).expanduser().open("r", encoding="utf-8") as f:
+                request = json.load(f)
+        req = dict(request)
+        icon_filename = req.setdefault("icon_filename", icon_path.name)
+        upload = self.pool.submit(self._upload_icon, icon_path, icon_filename)
+        return self._submit_request(req, self.max_wait if max_wait is None else max_wait, after=upload)
+
+    def _upload_icon(self, icon_path: Path, icon_filename: str):
+        self.s3.upload_file(str(icon_path), self.bucket, self._key(PREFIX_IMAGES, icon_filename),
+                            Config=self.transfer_config)
+
+    def _submit_request(self, req: Dict[str, Any], wait: float, after: Optional[Future] = None) -> Future:
+        """Put the request json (once `after`, the icon upload, has succeeded) and wait for its results."""
+        out: Future = Future()
+        icon_filename = req["icon_filename"]
+
+        def _go():
+            req_hash = req.get("hash")
+            req_name = f"{req_hash}.json" if req_hash else f"{Path(icon_filename).stem}_{int(time.time())}.json"
+            self.s3.put_object(Bucket=self.bucket, Key=self._key(PREFIX_REQUEST, req_name),
+                               Body=json.dumps(req, ensure_ascii=False).encode("utf-8"),
+                               ContentType="application/json")
+            parts = {
+                "imageresult": self.poller.wait_for(self._key(PREFIX_IMAGERESULTS, image_result_name(icon_filename)), wait),
+                "inforesult": (self.poller.wait_for(self._key(PREFIX_INFORESULTS, f"{req_hash}.json"), wait)
+                               if req_hash else None),
+            }
+            _combine(out, parts)
+
+        if after is None:
+            return self._submit(out, _go)
+
+        def _after(f: Future):
+            if f.exception() is not None:
+                out.set_exception(f.exception())
+            else:
+                self._submit(out, _go)
+        after.add_done_callback(_after)
+        return out
+
+    # ---------------- bulk, content-addressed ----------------
+    def submit_bulk(self, icon_dir, requests: Iterable[Dict[str, Any]],
+                    max_wait: Optional[float] = None) -> List[Future]:
+        """
+        Each request names its icon file in `icon_dir` via "icon_filename" (or "icon").
+        Icons are renamed to <sha256>.<ext>; each distinct icon is uploaded at most once, and
+        not at all if images/<sha256>.<ext> already exists. An existing image result also skips
+        the upload, unless a request with "hash" still has to go through the watcher, which
+        downloads the icon for it.
+        A request without "hash" whose image result already exists is resolved without
+        submitting anything. Returns one Future per request, in order; results also carry
+        "icon_filename" (the content-addressed name). A request whose icon cannot be read
+        gets a failed Future; the rest of the batch is still submitted.
+        self.last_bulk_stats has the counts.
+        """
+        icon_dir = Path(icon_dir).expanduser().resolve()
+        wait = self.max_wait if max_wait is None else max_wait
+        reqs = [dict(r) for r in requests]
+        srcs = [icon_dir / (r.get("icon_filename") or r.get("icon") or "") for r in reqs]
+
+        # 1) hash icons concurrently (each distinct path once); unreadable icons fail only their requests
+        def _digest(p: Path):
+            try:
+                return sha256_file(p)
+            except Exception as e:
+                return e
+
+        paths = list(dict.fromkeys(srcs))
+        digests = dict(zip(paths, self.pool.map(_digest, paths)))
+        errors: Dict[Path, Exception] = {p: d for p, d in digests.items() if isinstance(d, Exception)}
+        for p, e in errors.items():
+            logging.warning(f"[BULK] cannot hash {p}: {e}")
+        paths = [p for p in paths if p not in errors]
+        cas: Dict[Path, str] = {p: digests[p] + p.suffix.lower() for p in paths}
+
+        # 2) one grouped existence check for every distinct icon object and image result
+        names = set(cas.values())
+        img_keys = {n: self._key(PREFIX_IMAGES, n) for n in names}
+        res_keys = {n: self._key(PREFIX_IMAGERESULTS, image_result_name(n)) for n in names}
+        existing = self.poller.exists_many(list(img_keys.values()) + list(res_keys.values()))
+
+        # 3) upload the missing distinct icons that a submitted request will need
+        submitted = {cas[src] for req, src in zip(reqs, srcs)
+                     if src not in errors and (req.get("hash") or res_keys[cas[src]] not in existing)}
+        uploads: Dict[str, Future] = {}
+        for p in paths:
+            n = cas[p]
+            if n in uploads or n not in submitted or img_keys[n] in existing:
+                continue
+            uploads[n] = self.pool.submit(self._upload_icon, p, n)
+
+        # 4) requests
+        futs: List[Future] = []
+        cached = 0
+        for req, src in zip(reqs, srcs):
+            if src in errors:
+                failed: Future = Future()
+                failed.set_exception(errors[src])
+                futs.append(failed)
+                continue
+            n = cas[src]
+            req.pop("icon", None)
+            req["icon_filename"] = n
+            if not req.get("hash") and res_keys[n] in existing:
+                cached += 1
+                futs.append(self.poller.wait_for(res_keys[n], wait, fetch=lambda k, n=n: {
+                    "icon_filename": n, "imageresult": self.poller._get_json(k), "inforesult": None}))
+                continue
+            inner = self._submit_request(req, wait, after=uploads.get(n))
+            futs.append(self._tag(inner, n))
+        self.last_bulk_stats = {
+            "requests": len(reqs), "distinct_icons": len(names), "uploaded": len(uploads),
+            "skipped_existing": len(names) - len(uploads), "cached_results": cached,
+            "unreadable_icons": len(errors),
+        }
+        return futs
+
+    @staticmethod
+    def _tag(inner: Future, icon_filename: str) -> Future:
+        out: Future = Future()
+
+        def _done(f: Future):
+            if f.exception() is not None:
+                out.set_exception(f.exception())
+            else:
+                out.set_result(dict(f.result(), icon_filename=icon_filename))
+        inner.add_done_callback(_done)
+        return out
+
+    # ---------------- requestbyhash batch ----------------
+    def submit_hash_batch(self, txt_path=None, hashes: Optional[List[str]] = None,
+                          name: Optional[str] = None, max_wait: Optional[float] = None) -> Future:
+        """
+        Upload a batch txt (or a list of hashes under `name`) and return a Future of
+        {hash: record} read from the batch bundle once the done marker appears.
+        """
+        if txt_path is not None:
+            txt_path = Path(txt_path).expanduser().resolve()
+            name = name or txt_path.name
+            hashes = read_hash_lines(txt_path)
+            body = txt_path.read_bytes()
+        else:
+            if not name or not hashes:
+                raise ValueError("submit_hash_batch needs txt_path, or hashes together with name")
+            body = ("\n".join(hashes) + "\n").encode("utf-8")
+        wait = self.max_wait if max_wait is None else max_wait
+        out: Future = Future()
+
+        def _go():
+            self.s3.put_object(Bucket=self.bucket, Key=f"{PREFIX_REQUESTBYHASH}{name}", Body=body,
+                               ContentType="text/plain")
+            done = self.poller.wait_for(f"{PREFIX_REQUESTBYHASH_DONE}{name}", wait, fetch=lambda k: True)
+
+            def _on_done(f: Future):
+                if f.exception() is not None:
+                    out.set_exception(f.exception())
+                    return
+                self._submit(out, lambda: out.set_result(self._fetch_batch(name, hashes)))
+            done.add_done_callback(_on_done)
+
+        return self._submit(out, _go)
+
+    def _fetch_batch(self, name: str, hashes: List[str]) -> Dict[str, Dict[str, Any]]:
+        key_bundle = f"{PREFIX_REQUESTBYHASH_BUNDLE}{os.path.splitext(name)[0]}.jsonl.gz"
+        try:
+            return {rec["hash"]: rec for rec in s3_iter_jsonl_gz(self.s3, self.bucket, key_bundle)}
+        except ClientError as e:
+            if not is_not_found(e):
+                raise
+        # batches finalized before bundles existed: per-hash GETs (already on a pool thread)
+        return {h: self._fetch_hash(h) for h in hashes}
+
+    def _get_json_or_none(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            r = self.s3.get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if is_not_found(e):
+                return None
+            raise
+        return json.loads(r["Body"].read().decode("utf-8", errors="replace"))
+
+    def _fetch_hash(self, h: str) -> Dict[str, Any]:
+        info = self._get_json_or_none(self._key(PREFIX_INFORESULTS, f"{h}.json"))
+        icon_fn = ((info or {}).get("request") or {}).get("icon_filename")
+        image = self._get_json_or_none(self._key(PREFIX_IMAGERESULTS, image_result_name(icon_fn))) if icon_fn else None
+        return {
+            "hash": h,
+            "status": "done" if info is not None and image is not None else "pending",
+            "icon_base": os.path.splitext(icon_fn)[0] if icon_fn else None,
+            "inforesult": info,
+            "imageresult": image,
+        }
+
+
+if __name__ == "__main__":
+    from iconml_request_demo import main
+    main()
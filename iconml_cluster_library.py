@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+基准库近重复聚类（离线任务）
+
+对 ./images 去重后的唯一张量做分块全配对 Siamese 打分（块 i × 块 j，j >= i，单块内只取上三角），
+得分 > --threshold 的边按块对写入检查点目录；全部块对完成后做代表聚类并写出 CLUSTER_FILE：
+  - 按相似邻居数从多到少依次取未归属的点作代表，其未归属的直接邻居并入该簇；
+    因而每个成员都与代表直接相似，匹配端“代表过 gate 才展开”的近似检索才有意义；
+  - 簇文件按路径记录（代表/成员取各唯一张量的代表路径），并带库版本 generation，
+    库变化后匹配端自动忽略旧簇文件。
+
+内存：每个块对的得分矩阵最多 block×block 个 float32（默认 2048² ≈ 16MB）。
+断点续跑：每个块对完成即原子写出 edges_<i>_<j>.npz，重跑时跳过；meta.json 记录库版本与参数，
+不一致时拒绝续跑（--reset 清空重来）。
+并行：--shard k/n 只处理 (块对序号 % n == k) 的块对，多个进程/主机可共享同一检查点目录，
+最后任一进程（或 --merge-only）在全部块对齐备后生成簇文件。
+
+用法：
+  python iconml_cluster_library.py --threshold 0.98
+  python iconml_cluster_library.py --shard 0/4 & python iconml_cluster_library.py --shard 1/4 & ...
+  python iconml_cluster_library.py --merge-only
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import iconml_siamese_compare as sc
+from iconml_handoff import atomic_write_json, commit_temp, temp_target
+from iconml_result_cache import weights_fingerprint
+
+CLUSTER_THRESHOLD = 0.98
+BLOCK_SIZE        = 2048
+CHECKPOINT_DIR    = "./state/cluster_ckpt"
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """"k/n" -> (k, n)，要求 n >= 1 且 0 <= k < n。"""
+    try:
+        k, n = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise ValueError(f"--shard must look like k/n, got {value!r}")
+    if n < 1 or not 0 <= k < n:
+        raise ValueError(f"--shard {value}: need n >= 1 and 0 <= k < n")
+    return k, n
+
+
+def block_pairs(u: int, block: int) -> List[Tuple[int, int]]:
+    nb = (u + block - 1) // block
+    return [(i, j) for i in range(nb) for j in range(i, nb)]
+
+
+def edge_file(ckpt: str, i: int, j: int) -> str:
+    return os.path.join(ckpt, f"edges_{i}_{j}.npz")
+
+
+def check_meta(ckpt: str, meta: Dict, reset: bool) -> bool:
+    path = os.path.join(ckpt, "meta.json")
+    if reset and os.path.isdir(ckpt):
+        shutil.rmtree(ckpt)
+    os.makedirs(ckpt, exist_ok=True)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            old = json.load(f)
+    except (OSError, ValueError):
+        old = None
+    if old is None:
+        atomic_write_json(path, meta)
+        return True
+    if old != meta:
+        print(f"[CLUSTER] checkpoint {ckpt} was built with different settings/library:\n"
+              f"  old={old}\n  new={meta}\n  rerun with --reset to start over")
+        return False
+    return True
+
+
+def score_block_pair(model, imgs: np.ndarray, i: int, j: int, block: int, threshold: float):
+    a0, b0 = i * block, j * block
+    A = imgs[a0:a0 + block]
+    B = imgs[b0:b0 + block]
+    S = sc.predict_similarity_multi(model, sc.as_float_batch(A), B, batch_size=sc.BATCH_SIZE)
+    mask = S > threshold
+    if i == j:
+        mask &= np.triu(np.ones_like(mask, dtype=bool), k=1)
+    ra, rb = np.nonzero(mask)
+    return (ra + a0).astype(np.int32), (rb + b0).astype(np.int32), S[ra, rb].astype(np.float16)
+
+
+def save_edges(path: str, a: np.ndarray, b: np.ndarray, s: np.ndarray):
+    tmp = temp_target(path)
+    with open(tmp, "wb") as f:
+        np.savez(f, a=a, b=b, s=s)
+    commit_temp(tmp, path)
+
+
+def load_edges(ckpt: str, pairs: List[Tuple[int, int]]):
+    aa, bb = [], []
+    for i, j in pairs:
+        with np.load(edge_file(ckpt, i, j)) as z:
+            aa.append(z["a"])
+            bb.append(z["b"])
+    if not aa:
+        return np.empty((0,), np.int64), np.empty((0,), np.int64)
+    return np.concatenate(aa).astype(np.int64), np.concatenate(bb).astype(np.int64)
+
+
+def leader_clusters(u: int, a: np.ndarray, b: np.ndarray) -> List[Tuple[int, List[int]]]:
+    """邻居数从多到少取代表；代表吸收其未归属的直接邻居。返回 [(rep, [members])]，含单点簇。"""
+    src = np.concatenate([a, b])
+    dst = np.concatenate([b, a])
+    order = np.argsort(src, kind="stable")
+    src, dst = src[order], dst[order]
+    deg = np.bincount(src, minlength=u)
+    start = np.concatenate([[0], np.cumsum(deg)])
+    assigned = np.zeros((u,), dtype=bool)
+    out = []
+    for r in np.argsort(-deg, kind="stable"):
+        if assigned[r]:
+            continue
+        assigned[r] = True
+        nb = dst[start[r]:start[r + 1]]
+        nb = nb[~assigned[nb]]
+        assigned[nb] = True
+        out.append((int(r), [int(x) for x in nb]))
+    return out
+
+
+def write_clusters(out_path: str, lib: "sc.BaseLibrary", clusters, meta: Dict):
+    rep_path = [lib.paths[int(m[0])] for m in lib.members]       # 唯一张量 -> 代表路径
+    multi = [(r, ms) for r, ms in clusters if ms]
+    atomic_write_json(out_path, {
+        "version": 1,
+        "generation": meta["generation"],
+        "threshold": meta["threshold"],
+        "weights": meta["weights"],
+        "unique": lib.unique_count,
+        "generated_at": round(time.time(), 3),
+        # 单点簇不写出：匹配端会把未出现的唯一张量当作自身代表
+        "clusters": [{"rep": rep_path[r], "members": [rep_path[m] for m in ms]} for r, ms in multi],
+    }, indent=None)
+    covered = sum(len(ms) for _, ms in multi)
+    print(f"[CLUSTER] {len(clusters)} clusters ({len(multi)} multi-member covering {covered + len(multi)} "
+          f"unique tensors) -> {out_path}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Offline near-duplicate clustering of the IconML base library")
+    ap.add_argument("--threshold", type=float, default=CLUSTER_THRESHOLD, help="Edge threshold (member vs rep)")
+    ap.add_argument("--block", type=int, default=BLOCK_SIZE, help="Unique tensors per block")
+    ap.add_argument("--checkpoint-dir", default=CHECKPOINT_DIR)
+    ap.add_argument("--out", default=sc.CLUSTER_FILE)
+    ap.add_argument("--shard", default="0/1", help="k/n: only score block pairs with index %% n == k")
+    ap.add_argument("--merge-only", action="store_true", help="Only build clusters from finished checkpoints")
+    ap.add_argument("--reset", action="store_true", help="Discard existing checkpoints")
+    args = ap.parse_args(argv)
+    try:
+        k, n = parse_shard(args.shard)
+    except ValueError as e:
+        ap.error(str(e))
+
+    sc.setup_gpu()
+    lib, model = sc.load_matcher()
+    if len(lib) == 0:
+        print("[FATAL] No valid images found in ./images . Exit.")
+        return 1
+    meta = {
+        "generation": sc.library_tag(lib.paths),
+        "unique": lib.unique_count,
+        "block": args.block,
+        "threshold": args.threshold,
+        "weights": weights_fingerprint(sc.WEIGHTS_PATH),
+    }
+    if not check_meta(args.checkpoint_dir, meta, args.reset):
+        return 2
+
+    pairs = block_pairs(lib.unique_count, args.block)
+    if not args.merge_only:
+        mine = [p for idx, p in enumerate(pairs) if idx % n == k]
+        todo = [p for p in mine if not os.path.exists(edge_file(args.checkpoint_dir, *p))]
+        print(f"[CLUSTER] {lib.unique_count} unique tensors, {len(pairs)} block pairs; "
+              f"shard {k}/{n}: {len(mine)} assigned, {len(mine) - len(todo)} already done")
+        t0 = time.time()
+        for c, (i, j) in enumerate(todo, 1):
+            a, b, s = score_block_pair(model, lib.imgs, i, j, args.block, args.threshold)
+            save_edges(edge_file(args.checkpoint_dir, i, j), a, b, s)
+            el = time.time() - t0
+            print(f"[CLUSTER] block ({i},{j}) edges={len(a)}  {c}/{len(todo)}  "
+                  f"eta={el / c * (len(todo) - c):.0f}s")
+
+    missing = [p for p in pairs if not os.path.exists(edge_file(args.checkpoint_dir, *p))]
+    if missing:
+        print(f"[CLUSTER] {len(missing)} block pair(s) still pending (other shards); not merging yet")
+        return 0
+    a, b = load_edges(args.checkpoint_dir, pairs)
+    clusters = leader_clusters(lib.unique_count, a, b)
+    write_clusters(args.out, lib, clusters, meta)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
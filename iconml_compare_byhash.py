@@ -5,7 +5,6 @@ import os
 import sys
 import time
 import json
-import shutil
 import hashlib
 import zipfile
 import subprocess
@@ -20,6 +19,11 @@ AAPT2_PATH = "./aapt2"
 CLIENT_PATH = Path("./tool/linux_client")
 # 3) devid.py：必须提供 getsignsha1(apk_path) -> (devid, certsha1)
 from devid import getsignsha1
+from iconml_fsevents import DirWatcher
+from iconml_handoff import atomic_move, atomic_write_json, atomic_write_text
+from iconml_ipc import IPCError, IPCTimeout, IPCUnavailable, MatchIPCClient
+from iconml_layout import PARTITION_LEVELS, layout_hint
+from iconml_tracker import CompletionTracker
 
 # ================== 本地目录配置 ==================
 DIR_REQUEST_BY_HASH       = Path("./requestbyhash")
@@ -34,10 +38,15 @@ DIR_IMAGERESULTS          = Path("./imageresults")
 DIR_BAKIMAGERESULTS       = Path("./bakimageresults")
 
 # ================== 轮询与超时 ==================
-POLL_INTERVAL      = 3.0    # 主循环轮询间隔
-STABLE_WAIT        = 0.2    # txt 文件稳定判定
+POLL_INTERVAL      = 3.0    # 主循环轮询间隔（有新 txt 就绪时立即返回）
 MAX_WAIT_SECONDS   = 1800   # 每批最多等待 30 分钟（根据需要调整）
 
+# ================== 匹配端直连 ==================
+# icon 字节经 Unix socket 直接交给常驻匹配端并同步拿回结果（结果文件由匹配端照常写入 imageresults）；
+# 匹配端未运行或调用失败时退回写 ./uploadimages；已发出但等结果超时则不退回（匹配端仍会写出结果，避免重复匹配）
+MATCH_IPC_ENABLED  = True
+match_ipc = MatchIPCClient()
+
 # ================== 工具函数 ==================
 def ensure_dir(p: Path):
     p.mkdir(parents=True, exist_ok=True)
@@ -98,52 +107,20 @@ def read_hashes_from_txt(txt: Path) -> List[str]:
             out.append(s)
     return out
 
-def stable_new_txts(dirpath: Path, seen_mtime: Dict[Path, float]) -> List[Path]:
-    """
-    返回需要新处理的 txt 列表。安全修复点：
-    - 对同名文件的“再次出现”与“覆盖写入”都能识别为新任务。
-    判定规则：
-      1) 先做 size 稳定性判定（等待 STABLE_WAIT），确保文件写入完成；
-      2) 如果文件不在 seen_mtime 中 => 新；
-      3) 如果文件在 seen_mtime 中，但 stat().st_mtime > seen_mtime[f] => 新。
-    """
-    ret: List[Path] = []
-    for f in dirpath.glob("*.txt"):
-        try:
-            s1 = f.stat().st_size
-            t1 = f.stat().st_mtime
-            time.sleep(STABLE_WAIT)
-            s2 = f.stat().st_size
-            t2 = f.stat().st_mtime
-        except FileNotFoundError:
-            # 写入过程中被移动/删除，下一轮再说
-            continue
-
-        # 写入稳定且非空
-        if s1 == s2 and s2 > 0:
-            last = seen_mtime.get(f)
-            if last is None or t2 > last:
-                ret.append(f)
-    return ret
-
 def move_to_done(src: Path, dst_dir: Path):
     ensure_dir(dst_dir)
     dst = dst_dir / src.name
     if dst.exists():
         base, ext = os.path.splitext(src.name)
         dst = dst_dir / f"{base}_{int(time.time())}{ext}"
-    shutil.move(str(src), str(dst))
+    atomic_move(str(src), str(dst))
     print(f"[MOVE] {src.name} -> {dst.name}")
 
 def write_json(p: Path, obj: dict):
-    ensure_dir(p.parent)
-    with open(p, "w", encoding="utf-8") as f:
-        json.dump(obj, f, ensure_ascii=False, indent=2)
+    atomic_write_json(str(p), obj)
 
 def write_text(p: Path, s: str):
-    ensure_dir(p.parent)
-    with open(p, "w", encoding="utf-8") as f:
-        f.write(s)
+    atomic_write_text(str(p), s)
 
 def safe_remove(p: Path):
     try:
@@ -268,6 +245,33 @@ def sha256_of_file(p: Path) -> str:
             h.update(chunk)
     return h.hexdigest()
 
+def handoff_icon_ipc(h: str, icon_path: Path, icon_filename: str) -> bool:
+    """
+    经 IPC 把 icon 交给匹配端并等待结果。成功返回 True（本地 icon 已删除，imageresults 已写好，
+    并直接记入 tracker，批次监控不再等这张图的目录事件）；
+    超时也返回 True：匹配端已收到 icon，处理完会照常写 imageresults，由结果监控按普通待完成项等待。
+    返回 False 时由调用方走目录交接。
+    """
+    if not MATCH_IPC_ENABLED:
+        return False
+    try:
+        data = icon_path.read_bytes()
+        payload = match_ipc.match(icon_filename, data, hash=h)
+    except IPCTimeout as e:
+        print(f"[WARN] ipc match timed out for {icon_filename}: {e}; matcher still owns it, waiting for imageresults")
+        safe_remove(icon_path)
+        return True
+    except IPCUnavailable:
+        return False
+    except (IPCError, OSError) as e:
+        print(f"[WARN] ipc match failed for {icon_filename}: {e}; fallback to {DIR_UPLOADIMAGES}")
+        return False
+    safe_remove(icon_path)
+    tracker.mark_image(Path(icon_filename).stem)
+    best = payload.get("best_match") or {}
+    print(f"[IPC ] {h} -> {icon_filename} best={best.get('package') or '-'}")
+    return True
+
 # ================== 单个 hash 处理 ==================
 def process_one_hash(client: Path, h: str) -> Tuple[str, str, str, str]:
     """
@@ -326,11 +330,10 @@ def process_one_hash(client: Path, h: str) -> Tuple[str, str, str, str]:
             if ext == ".jpeg":
                 ext = ".jpg"
             final_name = f"{digest}{ext}"
-            final_path = DIR_UPLOADIMAGES / final_name
-            ensure_dir(DIR_UPLOADIMAGES)
-            if final_path.exists():
-                os.remove(str(final_path))
-            shutil.move(str(tmp_out), str(final_path))
+            if not handoff_icon_ipc(h, tmp_out, final_name):
+                final_path = DIR_UPLOADIMAGES / final_name
+                # rename 落地：匹配端只会看到完整的图标文件
+                atomic_move(str(tmp_out), str(final_path))
             icon_filename = final_name
             print(f"[ICON] {h} -> {final_name}")
         else:
@@ -357,23 +360,6 @@ def process_one_hash(client: Path, h: str) -> Tuple[str, str, str, str]:
     else:
         return (h, "", "info_only", "no_icon_extracted")
 
-# ================== 结果探测 ==================
-def result_exists_for_hash(h: str) -> bool:
-    """inforesults/<hash>.json 或 bakinforesults/<hash>.json 是否存在"""
-    return (DIR_INFORESULTS / f"{h}.json").exists() or (DIR_BAKINFORESULTS / f"{h}.json").exists()
-
-def result_exists_for_icon(icon_filename: str) -> bool:
-    """
-    imageresults 下的 JSON 命名为 <icon_hash>.json，
-    其中 icon_filename = <icon_hash>.<ext>（如 .png/.webp/...）。
-    """
-    if not icon_filename:
-        return False
-    base, _ = os.path.splitext(icon_filename)  # base = icon_hash
-    cand = DIR_IMAGERESULTS / f"{base}.json"
-    bak  = DIR_BAKIMAGERESULTS / f"{base}.json"
-    return cand.exists() or bak.exists()
-
 # ================== 批次状态与监控 ==================
 @dataclass
 class BatchState:
@@ -389,6 +375,11 @@ class BatchState:
     remaining: Dict[str, str] = field(default_factory=dict)             # {hash: icon_filename}
 
 active_batches: Dict[str, BatchState] = {}  # key = txt.stem
+# 反向索引：hash -> 批次、icon -> hash；结果目录（含 bak）以增量方式喂入
+tracker = CompletionTracker(
+    info_dirs=[str(DIR_INFORESULTS), str(DIR_BAKINFORESULTS)],
+    image_dirs=[str(DIR_IMAGERESULTS), str(DIR_BAKIMAGERESULTS)],
+)
 
 def build_summary_text(original_txt: str,
                        success_hashes: List[str],
@@ -430,7 +421,10 @@ def build_summary_text(original_txt: str,
         lines.append(f"  - {h}  reason={why}")
     lines.append("")
     lines.append("NOTE:")
-    lines.append("  SUCCESS COMPLETED: inforesults/<hash>.json & imageresults/<icon>.json are both present (or in bak*).")
+    # 本地结果目录始终平铺；S3 上的 key 形式取决于分区布局（ICONML_S3_PARTITION_LEVELS）
+    info_key = layout_hint("inforesults/", "<hash>.json", PARTITION_LEVELS)
+    image_key = layout_hint("imageresults/", "<icon>.json", PARTITION_LEVELS)
+    lines.append(f"  SUCCESS COMPLETED: {info_key} & {image_key} are both present (or in bak*).")
     lines.append("  PENDING_OR_TIMEOUT: missing either inforesult or imageresult when batch finalized.")
     lines.append("  INFO_ONLY_NO_ICON: request json generated but icon could not be extracted, so no image result expected.")
     lines.append("  FAILED_EARLY: download or parsing failed; no request was monitored.")
@@ -460,6 +454,11 @@ def process_txt_start(txt: Path, client: Path):
 
     bs.remaining = {h: icon for (h, icon) in bs.success_ready}
     active_batches[name] = bs
+    # 注册到追踪器：已存在的结果在这里一次性探测
+    tracker.add_batch(name, bs.remaining.keys(), icons=bs.remaining)
+    pending_set = tracker.remaining.get(name, set())
+    for h in [h for h in bs.remaining if h not in pending_set]:
+        bs.remaining.pop(h, None)
     print(f"[ENQUEUE] batch={name}: watch={len(bs.remaining)} info_only={len(bs.info_only)} failed={len(bs.failed)}")
 
 def tick_monitor():
@@ -468,18 +467,16 @@ def tick_monitor():
     now = time.time()
     done_names: List[str] = []
 
+    # 只处理新出现的结果文件（反向索引），不再逐 hash exists()
+    touched = tracker.poll()
+
     for name, bs in list(active_batches.items()):
-        # 更新可监控剩余项
-        finished_now: List[str] = []
-        for h, icon in list(bs.remaining.items()):
-            has_info  = result_exists_for_hash(h)
-            has_image = result_exists_for_icon(icon)
-            if not (has_info and has_image):
-                print(f"[WAIT] {bs.name} hash={h} info={has_info} image={has_image} icon={icon}")
-            if has_info and has_image:
-                finished_now.append(h)
-        for h in finished_now:
-            bs.remaining.pop(h, None)
+        # 同步可监控剩余项
+        if name in touched:
+            pending_set = tracker.remaining.get(name, set())
+            for h in [h for h in bs.remaining if h not in pending_set]:
+                bs.remaining.pop(h, None)
+            print(f"[WAIT] {bs.name} completed={len(bs.success_ready) - len(bs.remaining)} pending={len(bs.remaining)}")
 
         # 完成或超时则收尾
         timeout = (now - bs.start_ts) > MAX_WAIT_SECONDS
@@ -507,6 +504,7 @@ def tick_monitor():
 
     for nm in done_names:
         active_batches.pop(nm, None)
+        tracker.drop_batch(nm)
 
 # ================== 主循环 ==================
 def main():
@@ -521,26 +519,20 @@ def main():
     client = ensure_client()
     print(f"[INIT] client: {client}")
 
-    # 用 mtime 追踪：修复“同名文件再次出现不再处理”的问题
-    seen_mtime: Dict[Path, float] = {}
-    print(f"[WATCH] {DIR_REQUEST_BY_HASH.resolve()} (poll={POLL_INTERVAL}s)")
+    # 事件驱动：同名文件再次出现/覆盖写入都会重新产出事件
+    watcher = DirWatcher(str(DIR_REQUEST_BY_HASH), suffixes=(".txt",), poll_interval=1.0)
+    print(f"[WATCH] {DIR_REQUEST_BY_HASH.resolve()} (mode={watcher.mode}, tick={POLL_INTERVAL}s)")
 
     while True:
         try:
-            # —— 清理 seen_mtime 中已不存在的文件（被移动到 done 后）——
-            seen_mtime = {p: t for p, t in seen_mtime.items() if p.exists()}
-
-            # 发现新 txt：启动批次（不阻塞）
-            new_txts = stable_new_txts(DIR_REQUEST_BY_HASH, seen_mtime)
+            # 发现新 txt：启动批次（不阻塞）；无事件时最多等待 POLL_INTERVAL
+            new_txts = [Path(p) for p in watcher.ready(timeout=POLL_INTERVAL)]
             if new_txts:
                 print(f"[DETECT] new/updated txt: {[p.name for p in new_txts]}")
 
             for txt in new_txts:
-                # 记录当前 mtime（避免重复触发）
-                try:
-                    seen_mtime[txt] = txt.stat().st_mtime
-                except FileNotFoundError:
-                    # 被瞬时移动，下一轮再处理
+                if not txt.exists():
+                    # 被瞬时移动，忽略
                     continue
 
                 try:
@@ -563,8 +555,6 @@ def main():
 
             # 统一监控所有活跃批次
             tick_monitor()
-
-            time.sleep(POLL_INTERVAL)
         except KeyboardInterrupt:
             print("\n[EXIT] bye")
             break
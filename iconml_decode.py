@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+批量 icon 解码与缩放（NumPy 路径）
+
+e_load_image 逐张调用：每次都新建 TF 算子、返回 (1,32,32,3) 张量再 .numpy()[0]，
+百万级基准库预加载时调度开销远大于实际像素计算。这里提供可选的替代路径：
+  - PIL 解码 PNG/WebP/JPEG 字节为 uint8 RGB（解码期间释放 GIL，线程池即可并行）；
+  - 按源尺寸分组，同尺寸的一组用面积平均一次缩放到 32×32：
+        out = Wy · img · Wxᵀ   （Wy/Wx 为按重叠长度归一化的面积权重矩阵，按尺寸缓存）
+    等价于逐格求覆盖区域的像素均值（非整数倍时按覆盖比例加权）；
+  - 结果（[0,1] float32，或经 finish 量化为 uint8）直接写入调用方预分配数组的对应行。
+
+通道处理与 tf.io.decode_image(channels=3) 一致：带 alpha 的图直接丢弃 alpha，不做背景合成。
+是否与 e_load_image 逐像素一致取决于其缩放方式，切换前用
+    python iconml_siamese_compare.py decode-check
+比对像素差与匹配召回。
+"""
+
+import io
+import os
+import logging
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+DECODER = os.environ.get("ICONML_DECODER", "tf")     # tf（e_load_image，默认）/ numpy
+RESIZE_BATCH = 256        # 同尺寸分组内每次缩放的图片数（限制临时 float32 数组大小）
+
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def decode_rgb(data: bytes) -> np.ndarray:
+    """图片字节 -> (H,W,3) uint8；动图取第一帧。"""
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as im:
+        return np.asarray(im.convert("RGB"), dtype=np.uint8)
+
+
+@lru_cache(maxsize=256)
+def area_weights(src: int, dst: int) -> np.ndarray:
+    """(dst, src) 面积权重：输出第 i 格覆盖输入区间 [i*s, (i+1)*s)，s = src/dst，按重叠长度加权。"""
+    scale = src / dst
+    edges = np.arange(dst + 1, dtype=np.float64) * scale
+    j = np.arange(src, dtype=np.float64)[None, :]
+    w = np.clip(np.minimum(edges[1:, None], j + 1) - np.maximum(edges[:-1, None], j), 0.0, None)
+    w /= w.sum(axis=1, keepdims=True)
+    return w.astype(np.float32)
+
+
+def resize_area_batch(imgs: np.ndarray, size: int) -> np.ndarray:
+    """(n,H,W,3) uint8 -> (n,size,size,3) float32 [0,1]。"""
+    wy = area_weights(imgs.shape[1], size)
+    wx = area_weights(imgs.shape[2], size)
+    out = np.einsum("ih,nhwc,jw->nijc", wy, imgs.astype(np.float32), wx, optimize=True)
+    out *= np.float32(1.0 / 255.0)
+    return out
+
+
+def decode_image(data: bytes, size: int) -> np.ndarray:
+    """单张：字节 -> (size,size,3) float32 [0,1]。"""
+    return resize_area_batch(decode_rgb(data)[np.newaxis], size)[0]
+
+
+def decode_into(out: np.ndarray, items: Sequence, pool, read: Callable[[object], bytes] = read_file,
+                finish: Optional[Callable[[np.ndarray], np.ndarray]] = None) -> np.ndarray:
+    """
+    items[i] 经 read() 取字节、在 pool 中解码，缩放后写入 out[i]（out 可以是库数组的切片视图）。
+    finish 对缩放结果做最后转换（如 uint8 量化）。返回 (len(items),) 的成功掩码；失败的行内容未定义。
+    """
+    size = out.shape[1]
+
+    def _dec(i: int):
+        try:
+            return decode_rgb(read(items[i]))
+        except Exception as e:
+            logging.warning(f"[LOAD] Failed to load '{items[i]}': {e}")
+            return None
+
+    decoded = list(pool.map(_dec, range(len(items))))
+    ok = np.array([d is not None for d in decoded], dtype=bool)
+    groups: Dict[Tuple[int, int], List[int]] = {}
+    for i, d in enumerate(decoded):
+        if d is not None:
+            groups.setdefault(d.shape[:2], []).append(i)
+    for idx in groups.values():
+        for s in range(0, len(idx), RESIZE_BATCH):
+            part = idx[s:s + RESIZE_BATCH]
+            res = resize_area_batch(np.stack([decoded[i] for i in part], axis=0), size)
+            out[part] = finish(res) if finish is not None else res
+            for i in part:
+                decoded[i] = None            # 尽早释放解码后的原图
+    return ok
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+基准库元数据过滤（限定候选集的查询）
+
+request JSON 可带可选的 "filter" 字段，只在满足条件的基准图里匹配：
+    "filter": {
+        "devid": "3a5f..." | ["...", ...],            # 任一即可
+        "package_prefix": "com.example." | [...],     # 任一前缀即可
+        "packages": ["com.a", "com.b"],               # 精确包名，任一即可
+        "permissions": ["android.permission.SEND_SMS"] # 必须全部申请
+    }
+不同字段之间取交集。值统一小写比较。
+
+匹配端启动时从 ./info/<package>.txt（已有的 parse_info_file 解析结果）建倒排表：
+    devid -> 行号数组、permission -> 行号数组、包名有序表（前缀查询用二分）
+select() 只做数组求交，打分开销与子集大小成正比，而不是整库。
+"""
+
+import bisect
+import hashlib
+import json
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+FILTER_FIELDS = ("devid", "package_prefix", "packages", "permissions")
+
+
+def normalize_filter(obj) -> Optional[Dict[str, List[str]]]:
+    """把 request 里的 filter 规整为 {field: [小写值, ...]}；没有有效条件时返回 None。"""
+    if not isinstance(obj, dict):
+        return None
+    out: Dict[str, List[str]] = {}
+    for k in FILTER_FIELDS:
+        v = obj.get(k)
+        if v is None or v == "" or v == []:
+            continue
+        vals = [v] if isinstance(v, str) else list(v)
+        vals = sorted({str(x).strip().lower() for x in vals if str(x).strip()})
+        if vals:
+            out[k] = vals
+    return out or None
+
+
+def filter_key(f: Optional[Dict[str, List[str]]]) -> str:
+    """过滤条件的稳定短摘要（结果缓存键的一部分）；无过滤为空串。"""
+    if not f:
+        return ""
+    return hashlib.sha1(json.dumps(f, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+
+class MetadataIndex:
+    """
+    paths      : 基准图路径（行号即下标）
+    package_of : 路径 -> 包名（与结果 JSON 的 package 一致）
+    info_of    : 包名 -> parse_info_file 的结果 dict（devid / permissions 以 ';' 分隔）
+    """
+    def __init__(self, paths: List[str], package_of: Callable[[str], str],
+                 info_of: Callable[[str], dict], workers: int = 8):
+        t0 = time.time()
+        self.n = len(paths)
+        pkg_rows: Dict[str, List[int]] = {}
+        for i, p in enumerate(paths):
+            pkg_rows.setdefault(package_of(p).lower(), []).append(i)
+        pkgs = sorted(pkg_rows)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            infos = list(pool.map(info_of, pkgs))
+
+        by_devid: Dict[str, List[int]] = {}
+        by_perm: Dict[str, List[int]] = {}
+        for pkg, info in zip(pkgs, infos):
+            rows = pkg_rows[pkg]
+            devid = (info.get("devid") or "").strip().lower()
+            if devid:
+                by_devid.setdefault(devid, []).extend(rows)
+            for perm in (info.get("permissions") or "").split(";"):
+                perm = perm.strip().lower()
+                if perm:
+                    by_perm.setdefault(perm, []).extend(rows)
+
+        def _arr(rows):
+            return np.unique(np.asarray(rows, dtype=np.int64))
+        self.packages = pkgs                                      # 有序，前缀查询用
+        self.package_rows = [_arr(pkg_rows[p]) for p in pkgs]
+        self.by_devid = {k: _arr(v) for k, v in by_devid.items()}
+        self.by_perm = {k: _arr(v) for k, v in by_perm.items()}
+        logging.info(f"[FILTER] Metadata index: {len(pkgs)} packages, {len(self.by_devid)} devids, "
+                     f"{len(self.by_perm)} permissions over {self.n} rows ({time.time() - t0:.1f}s)")
+
+    def _union(self, arrs: List[np.ndarray]) -> np.ndarray:
+        arrs = [a for a in arrs if a.size]
+        if not arrs:
+            return np.empty((0,), dtype=np.int64)
+        return arrs[0] if len(arrs) == 1 else np.unique(np.concatenate(arrs))
+
+    def _prefix_rows(self, prefix: str) -> List[np.ndarray]:
+        lo = bisect.bisect_left(self.packages, prefix)
+        hi = bisect.bisect_left(self.packages, prefix + "\uffff")
+        return self.package_rows[lo:hi]
+
+    def _package_rows(self, pkg: str) -> List[np.ndarray]:
+        i = bisect.bisect_left(self.packages, pkg)
+        return [self.package_rows[i]] if i < len(self.packages) and self.packages[i] == pkg else []
+
+    def select(self, f: Optional[Dict[str, List[str]]]) -> Optional[np.ndarray]:
+        """返回满足条件的行号（升序）；f 为空返回 None（表示整库）。"""
+        if not f:
+            return None
+        sets: List[np.ndarray] = []
+        empty = np.empty((0,), dtype=np.int64)
+        if "devid" in f:
+            sets.append(self._union([self.by_devid.get(v, empty) for v in f["devid"]]))
+        if "package_prefix" in f:
+            sets.append(self._union([a for v in f["package_prefix"] for a in self._prefix_rows(v)]))
+        if "packages" in f:
+            sets.append(self._union([a for v in f["packages"] for a in self._package_rows(v)]))
+        for perm in f.get("permissions", []):
+            sets.append(self.by_perm.get(perm, empty))
+        # 从最小的集合开始求交
+        sets.sort(key=len)
+        rows = sets[0]
+        for s in sets[1:]:
+            if not rows.size:
+                break
+            rows = np.intersect1d(rows, s, assume_unique=True)
+        return rows
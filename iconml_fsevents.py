@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+统一的本地目录“文件就绪”事件服务
+
+各流水线原先各自轮询目录，并对每个候选文件 time.sleep(0.2) 做大小稳定判定，
+1000 个待处理文件即一次扫描 200 秒。这里统一为 DirWatcher，配合 iconml_handoff 的交接协议：
+目录里出现的最终文件名（或 <name>.ready 标记）即代表文件已写完，不再做任何稳定判定。
+
+  - Linux 下使用 inotify（ctypes 直接调用 libc，无第三方依赖）：
+      IN_MOVED_TO     -> 生产者 tmp -> rename 到最终名
+      IN_CLOSE_WRITE  -> 原地写入并关闭（仅兼容旧生产者；新代码请走 rename 或 .ready）
+  - 其他平台或 inotify 不可用时退化为轮询：
+      目录 mtime 变化时才 scandir；新出现（或 size/mtime 变化）的最终名立即产出。
+
+用法：
+    w = DirWatcher("./uploadimages", suffixes=(".png", ".webp"), recursive=True)
+    while True:
+        for path in w.ready(timeout=1.0):
+            ...
+"""
+
+import os
+import time
+import errno
+import select
+import struct
+import logging
+import ctypes
+import ctypes.util
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from iconml_handoff import READY_SUFFIX, is_temp_name
+
+# inotify 常量（<sys/inotify.h>）
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+
+_EVENT_HDR = struct.Struct("iIII")
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        name = ctypes.util.find_library("c") or "libc.so.6"
+        _libc = ctypes.CDLL(name, use_errno=True)
+    return _libc
+
+
+def inotify_available() -> bool:
+    try:
+        libc = _load_libc()
+        return hasattr(libc, "inotify_init1")
+    except OSError:
+        return False
+
+
+class DirWatcher:
+    """
+    监听单个目录（可递归），产出已完成交接的文件路径。
+
+    suffixes     : 只关心的扩展名（大小写敏感，与各脚本原逻辑一致）；None 表示全部
+    recursive    : 是否包含子目录
+    emit_existing: 启动时目录内已有文件是否也作为事件产出
+    use_inotify  : False 强制使用轮询
+    ready_marker : True 时只在 <name>.ready 出现后产出 <name>（用于无法 rename 的外部生产者），
+                   产出后标记文件被删除
+    """
+    def __init__(self,
+                 path: str,
+                 suffixes: Optional[Iterable[str]] = None,
+                 recursive: bool = False,
+                 poll_interval: float = 1.0,
+                 emit_existing: bool = True,
+                 use_inotify: bool = True,
+                 ready_marker: bool = False):
+        self.path = str(path)
+        self.suffixes = tuple(suffixes) if suffixes else None
+        self.recursive = recursive
+        self.poll_interval = poll_interval
+        self.ready_marker = ready_marker
+
+        os.makedirs(self.path, exist_ok=True)
+
+        # 轮询状态：path -> (size, mtime_ns)
+        self._emitted: Dict[str, Tuple[int, int]] = {}
+        self._dir_mtime: Dict[str, int] = {}
+        self._last_scan = 0.0
+        self._backlog: List[str] = []
+
+        self._fd = -1
+        self._wd_dirs: Dict[int, str] = {}
+        if use_inotify and inotify_available():
+            try:
+                self._init_inotify()
+            except OSError as e:
+                logging.warning(f"[FSEV] inotify unavailable for {self.path}, fallback to polling: {e}")
+                self._close_fd()
+
+        # 启动基线：已有文件要么下一次 ready() 时产出，要么直接视为已产出
+        if self._fd < 0:
+            self._dirs_changed()
+            existing = dict(self._walk_files())
+            self._emitted.update(existing)
+            if emit_existing:
+                self._backlog.extend(existing)
+        elif emit_existing:
+            self._backlog.extend(p for p, _ in self._walk_files())
+
+    @property
+    def mode(self) -> str:
+        return "inotify" if self._fd >= 0 else "poll"
+
+    # ---------------- 对外接口 ----------------
+    def ready(self, timeout: float = 0.0) -> List[str]:
+        """
+        返回就绪文件路径列表；无事件时最多阻塞 timeout 秒。
+        """
+        if self._backlog:
+            out, self._backlog = self._backlog, []
+            return self._finish(out)
+        deadline = time.time() + max(0.0, timeout)
+        while True:
+            if self._fd >= 0:
+                out = self._drain_inotify(0.0)
+            elif time.time() - self._last_scan >= self.poll_interval or not timeout:
+                out = self._poll_scan()
+            else:
+                out = []
+            if out:
+                return self._finish(out)
+
+            remain = deadline - time.time()
+            if remain <= 0:
+                return []
+            if self._fd >= 0:
+                out = self._drain_inotify(remain)
+                if out:
+                    return self._finish(out)
+            else:
+                time.sleep(min(remain, self.poll_interval))
+
+    def forget(self, path: str):
+        """消费者移走/删除文件后可调用，释放轮询状态。"""
+        self._emitted.pop(path, None)
+
+    def close(self):
+        self._close_fd()
+
+    # ---------------- 公共 ----------------
+    def _match(self, name: str) -> bool:
+        if is_temp_name(name):
+            return False
+        if self.ready_marker:
+            if not name.endswith(READY_SUFFIX):
+                return False
+            name = name[:-len(READY_SUFFIX)]
+        if self.suffixes is None:
+            return True
+        return os.path.splitext(name)[1] in self.suffixes
+
+    def _finish(self, paths: List[str]) -> List[str]:
+        """ready_marker 模式：标记 -> 目标文件，并清理标记。"""
+        if not self.ready_marker:
+            return paths
+        out = []
+        for m in paths:
+            target = m[:-len(READY_SUFFIX)]
+            try:
+                os.remove(m)
+            except OSError:
+                pass
+            self._emitted.pop(m, None)
+            if os.path.exists(target):
+                out.append(target)
+        return out
+
+    def _walk_files(self, root: Optional[str] = None):
+        stack = [root or self.path]
+        while stack:
+            d = stack.pop()
+            try:
+                it = os.scandir(d)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            with it:
+                for e in it:
+                    try:
+                        if e.is_dir(follow_symlinks=False):
+                            if self.recursive:
+                                stack.append(e.path)
+                            continue
+                        if not self._match(e.name):
+                            continue
+                        st = e.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield e.path, (st.st_size, st.st_mtime_ns)
+
+    # ---------------- 轮询实现 ----------------
+    def _dirs_changed(self) -> bool:
+        changed = False
+        dirs = [self.path]
+        if self.recursive:
+            dirs = [r for r, _, _ in os.walk(self.path)]
+        for d in dirs:
+            try:
+                m = os.stat(d).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if self._dir_mtime.get(d) != m:
+                self._dir_mtime[d] = m
+                changed = True
+        return changed
+
+    def _poll_scan(self) -> List[str]:
+        self._last_scan = time.time()
+        # 按协议，文件只会以 rename/新建的方式出现，目录 mtime 不变即无新文件
+        if not self._dirs_changed():
+            return []
+        out: List[str] = []
+        present = set()
+        for p, key in self._walk_files():
+            present.add(p)
+            if self._emitted.get(p) == key:
+                continue
+            self._emitted[p] = key
+            if key[0] > 0 or self.ready_marker:
+                out.append(p)
+        for p in list(self._emitted):
+            if p not in present:
+                self._emitted.pop(p, None)
+        return out
+
+    # ---------------- inotify 实现 ----------------
+    def _init_inotify(self):
+        libc = _load_libc()
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._fd = fd
+        self._add_watch(self.path)
+        if self.recursive:
+            for root, dirs, _ in os.walk(self.path):
+                for d in dirs:
+                    self._add_watch(os.path.join(root, d))
+
+    def _add_watch(self, d: str):
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+        if self.recursive:
+            mask |= IN_CREATE
+        wd = _load_libc().inotify_add_watch(self._fd, os.fsencode(d), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), d)
+        self._wd_dirs[wd] = d
+
+    def _close_fd(self):
+        if self._fd >= 0:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+        self._fd = -1
+        self._wd_dirs.clear()
+
+    def _drain_inotify(self, wait: float) -> List[str]:
+        if wait > 0:
+            r, _, _ = select.select([self._fd], [], [], wait)
+            if not r:
+                return []
+        out: List[str] = []
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not buf:
+                break
+            out.extend(self._parse_events(buf))
+        return list(dict.fromkeys(out))
+
+    def _parse_events(self, buf: bytes) -> List[str]:
+        out: List[str] = []
+        off = 0
+        while off + _EVENT_HDR.size <= len(buf):
+            wd, mask, _cookie, ln = _EVENT_HDR.unpack_from(buf, off)
+            off += _EVENT_HDR.size
+            name = os.fsdecode(buf[off:off + ln].rstrip(b"\0"))
+            off += ln
+
+            if mask & IN_Q_OVERFLOW:
+                # 事件队列溢出：全量扫描一次作为补偿
+                logging.warning(f"[FSEV] inotify overflow on {self.path}, rescanning")
+                out.extend(p for p, _ in self._walk_files())
+                continue
+            d = self._wd_dirs.get(wd)
+            if d is None:
+                continue
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                self._wd_dirs.pop(wd, None)
+                if d == self.path:
+                    # 被监听目录本身消失：重建并重新挂载
+                    os.makedirs(self.path, exist_ok=True)
+                    self._add_watch(self.path)
+                continue
+            full = os.path.join(d, name)
+            if mask & IN_ISDIR:
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_watch(full)
+                    # 子目录创建到挂载 watch 之间落地的文件，这里补一次
+                    out.extend(p for p, _ in self._walk_files(full))
+                continue
+            if not self._match(name):
+                continue
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and os.path.exists(full):
+                out.append(full)
+        return out
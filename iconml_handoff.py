@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+流水线之间的文件交接协议
+
+约定：目录里出现的“最终文件名”即代表文件已完整写入。
+  - 生产者先写 <name>.<pid>.<tid>.tmp，fsync 后 os.replace 到最终名（同目录内 rename 是原子的）；
+  - 无法改成 rename 的外部生产者，可在原地写完 <name> 后再放一个 <name>.ready 标记；
+  - 消费者（DirWatcher）忽略 *.tmp，只信任最终名或 .ready 标记，不再做任何 size 稳定判定或 sleep。
+"""
+
+import os
+import json
+import errno
+import shutil
+import threading
+from typing import Any
+
+TMP_SUFFIX   = ".tmp"
+READY_SUFFIX = ".ready"
+
+
+def is_temp_name(name: str) -> bool:
+    return name.endswith(TMP_SUFFIX)
+
+
+def _tmp_path(path: str) -> str:
+    d, base = os.path.split(path)
+    return os.path.join(d, f".{base}.{os.getpid()}.{threading.get_ident()}{TMP_SUFFIX}")
+
+
+def _fsync_dir(d: str):
+    try:
+        fd = os.open(d or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write_bytes(path: str, data: bytes):
+    path = str(path)
+    d = os.path.dirname(path)
+    if d:
+        os.makedirs(d, exist_ok=True)
+    tmp = _tmp_path(path)
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    _fsync_dir(d)
+
+
+def atomic_write_text(path: str, s: str, encoding: str = "utf-8"):
+    atomic_write_bytes(path, s.encode(encoding))
+
+
+def atomic_write_json(path: str, obj: Any, indent: int = 2):
+    atomic_write_text(path, json.dumps(obj, ensure_ascii=False, indent=indent))
+
+
+def temp_target(path: str) -> str:
+    """给需要自己写文件的调用方（如 boto3 download_file）用的临时路径，配合 commit_temp 使用。"""
+    path = str(path)
+    d = os.path.dirname(path)
+    if d:
+        os.makedirs(d, exist_ok=True)
+    return _tmp_path(path)
+
+
+def commit_temp(tmp: str, path: str):
+    with open(tmp, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, str(path))
+    _fsync_dir(os.path.dirname(str(path)))
+
+
+def atomic_move(src: str, dst: str):
+    """
+    移动文件且保证 dst 只会以完整形态出现：
+    同文件系统直接 rename；跨文件系统则复制到 dst 同目录的临时名，fsync 后 rename，再删除源。
+    """
+    src, dst = str(src), str(dst)
+    d = os.path.dirname(dst)
+    if d:
+        os.makedirs(d, exist_ok=True)
+    try:
+        os.replace(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    tmp = _tmp_path(dst)
+    try:
+        shutil.copy2(src, tmp)
+        commit_temp(tmp, dst)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    os.remove(src)
+
+
+def mark_ready(path: str):
+    """原地写入的生产者在写完后调用：落一个空的 <path>.ready 标记。"""
+    atomic_write_bytes(str(path) + READY_SUFFIX, b"")
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Siamese 模型推理后端
+
+build_and_load_model 得到的 Keras 模型默认以 eager 方式 model([left, right]) 调用：
+每批都走 Python 调度，最后一个不满批的形状不同还会触发重新 trace。这里提供可选后端：
+  - keras  ：原样调用（默认，行为与旧代码一致）
+  - graph  ：tf.function 固定输入签名 (BATCH_SIZE,H,W,C)×2，可选 XLA（jit_compile）
+  - tflite ：由同一个 concrete function 转换为 TFLite，可选 float16 / dynamic-range 量化，
+             Interpreter 使用指定线程数
+固定签名的后端会把不满批的输入补零到 batch_size、超出的按 batch_size 切块，输出截回原长度，
+因此任何批大小都只对应一个编译好的图。
+
+后端对象与 Keras 模型的调用方式相同：backend([left, right], training=False) -> (n,1) ndarray，
+predict_similarity_* 无需区分。parity_check() 用于与 Keras 结果逐分数比对。
+"""
+
+import os
+import abc
+import time
+import logging
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+
+INFER_BACKEND       = os.environ.get("ICONML_INFER_BACKEND", "keras")   # keras / graph / tflite
+INFER_XLA           = os.environ.get("ICONML_INFER_XLA", "1") == "1"
+INFER_TFLITE_QUANT  = os.environ.get("ICONML_INFER_TFLITE_QUANT", "none")  # none / float16 / dynamic
+INFER_INTRA_THREADS = int(os.environ.get("ICONML_INFER_INTRA_THREADS", "0"))  # 0 = TF 默认（全部核）
+INFER_INTER_THREADS = int(os.environ.get("ICONML_INFER_INTER_THREADS", "0"))
+BACKENDS = ("keras", "graph", "tflite")
+
+
+def configure_threads(intra: int = INFER_INTRA_THREADS, inter: int = INFER_INTER_THREADS):
+    """必须在 TF 运行时初始化（第一次执行算子）之前调用；之后调用只会记录警告。"""
+    try:
+        if intra > 0:
+            tf.config.threading.set_intra_op_parallelism_threads(intra)
+        if inter > 0:
+            tf.config.threading.set_inter_op_parallelism_threads(inter)
+    except RuntimeError as e:
+        logging.warning(f"[INFER] thread settings ignored (runtime already initialized): {e}")
+        return
+    if intra > 0 or inter > 0:
+        print(f"[INFER] threads intra={intra or 'default'} inter={inter or 'default'}")
+
+
+class _FixedBatchBackend(abc.ABC):
+    name = "fixed"
+
+    def __init__(self, batch_size: int, input_shape: Tuple[int, int, int]):
+        self.batch_size = batch_size
+        self.input_shape = tuple(input_shape)
+        self.padded = 0            # 累计补零的样本数（观察用）
+
+    @abc.abstractmethod
+    def _run(self, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+        """恰好 batch_size 个样本对 -> (batch_size, 1)。"""
+
+    def __call__(self, inputs: Sequence[np.ndarray], training: bool = False) -> np.ndarray:
+        left, right = inputs
+        left = np.asarray(left, dtype=np.float32)
+        right = np.asarray(right, dtype=np.float32)
+        n = left.shape[0]
+        bs = self.batch_size
+        out = np.empty((n,), dtype=np.float32)
+        for start in range(0, n, bs):
+            end = min(start + bs, n)
+            l, r = left[start:end], right[start:end]
+            if end - start < bs:
+                pad = ((0, bs - (end - start)),) + ((0, 0),) * 3
+                l, r = np.pad(l, pad), np.pad(r, pad)
+                self.padded += bs - (end - start)
+            out[start:end] = self._run(l, r).reshape(-1)[:end - start]
+        return out.reshape(-1, 1)
+
+
+class GraphBackend(_FixedBatchBackend):
+    name = "graph"
+
+    def __init__(self, model, batch_size: int, input_shape: Tuple[int, int, int], jit: bool = INFER_XLA):
+        super().__init__(batch_size, input_shape)
+        spec = tf.TensorSpec((batch_size,) + self.input_shape, tf.float32)
+        self.jit = jit
+
+        def _fwd(a, b):
+            return model([a, b], training=False)
+
+        try:
+            self._fn = tf.function(_fwd, input_signature=[spec, spec], jit_compile=jit)
+            self._fn.get_concrete_function()
+        except Exception as e:
+            if not jit:
+                raise
+            logging.warning(f"[INFER] XLA compile failed, falling back to plain graph: {e}")
+            self.jit = False
+            self._fn = tf.function(_fwd, input_signature=[spec, spec])
+        self.concrete = self._fn.get_concrete_function()
+
+    def _run(self, left, right):
+        return self._fn(tf.constant(left), tf.constant(right)).numpy()
+
+
+class TFLiteBackend(_FixedBatchBackend):
+    name = "tflite"
+
+    def __init__(self, model, batch_size: int, input_shape: Tuple[int, int, int],
+                 quant: str = INFER_TFLITE_QUANT, num_threads: Optional[int] = None):
+        super().__init__(batch_size, input_shape)
+        graph = GraphBackend(model, batch_size, input_shape, jit=False)
+        # 先把变量冻结为常量：Keras 3 的变量不会被转换器自动冻结，TFLite 里会变成未初始化的 READ_VARIABLE
+        frozen = convert_variables_to_constants_v2(graph.concrete)
+        conv = tf.lite.TFLiteConverter.from_concrete_functions([frozen], model)
+        if quant in ("float16", "dynamic"):
+            conv.optimizations = [tf.lite.Optimize.DEFAULT]
+            if quant == "float16":
+                conv.target_spec.supported_types = [tf.float16]
+        t0 = time.time()
+        self.tflite_model = conv.convert()
+        threads = num_threads or INFER_INTRA_THREADS or os.cpu_count() or 1
+        self._interp = tf.lite.Interpreter(model_content=self.tflite_model, num_threads=threads)
+        self._interp.allocate_tensors()
+        # 输入按签名参数名 (a, b) 取下标：get_input_details() 的顺序不保证与参数顺序一致
+        ins = self._interp.get_signature_runner().get_input_details()
+        self._in = [ins["a"]["index"], ins["b"]["index"]]
+        self._out = self._interp.get_output_details()[0]["index"]
+        print(f"[INFER] TFLite model ready ({len(self.tflite_model) / 1024:.0f}KB, quant={quant}, "
+              f"threads={threads}, {time.time() - t0:.1f}s)")
+
+    def _run(self, left, right):
+        self._interp.set_tensor(self._in[0], left)
+        self._interp.set_tensor(self._in[1], right)
+        self._interp.invoke()
+        return self._interp.get_tensor(self._out)
+
+
+def make_backend(model, name: str, batch_size: int, input_shape: Tuple[int, int, int]):
+    """按名称包装已加载权重的 Keras 模型；keras 原样返回。"""
+    if name not in BACKENDS:
+        raise ValueError(f"unknown inference backend: {name} (choose from {', '.join(BACKENDS)})")
+    if name == "keras":
+        return model
+    t0 = time.time()
+    if name == "graph":
+        be = GraphBackend(model, batch_size, input_shape)
+        print(f"[INFER] Graph backend ready (batch={batch_size}, xla={be.jit}, {time.time() - t0:.1f}s)")
+        return be
+    return TFLiteBackend(model, batch_size, input_shape)
+
+
+def parity_check(ref_model, backend, base_imgs: np.ndarray, queries: List[np.ndarray],
+                 predict, threshold: float) -> dict:
+    """
+    用同一批查询分别经 Keras 与后端全库打分：
+      max_abs       = 得分最大绝对差
+      top1_agreement= 最高分下标一致的查询比例
+      hit_mismatch  = 阈值判定不一致的 (query, base) 对数
+    predict 为 predict_similarity_pairs（避免与调用方循环导入）。
+    """
+    max_abs, top1, mismatch = 0.0, 0, 0
+    t_ref = t_be = 0.0
+    for q in queries:
+        t0 = time.time()
+        s_ref = predict(ref_model, q, base_imgs)
+        t1 = time.time()
+        s_be = predict(backend, q, base_imgs)
+        t2 = time.time()
+        t_ref += t1 - t0
+        t_be += t2 - t1
+        max_abs = max(max_abs, float(np.abs(s_ref - s_be).max()))
+        top1 += int(np.argmax(s_ref) == np.argmax(s_be))
+        mismatch += int(((s_ref > threshold) != (s_be > threshold)).sum())
+    n = max(1, len(queries))
+    return {
+        "queries": len(queries),
+        "max_abs": max_abs,
+        "top1_agreement": top1 / n,
+        "hit_mismatch": mismatch,
+        "keras_secs": round(t_ref, 3),
+        "backend_secs": round(t_be, 3),
+    }
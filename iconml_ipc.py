@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+提取端 -> 匹配端的本地直连通道（Unix domain socket）
+
+原流程：process_one_hash 把 icon 写进 ./uploadimages，匹配端 DirWatcher 发现后打分，
+结果写 ./imageresults，requestbyhash 侧再从目录事件里等结果。
+这里让提取端把 icon 字节与元数据直接发给常驻的匹配端，同一连接上同步拿回结果 payload：
+  - 匹配端（iconml_siamese_compare.main）启动 MatchIPCServer，结果照常写 ./imageresults，
+    所以下游（watcher 上传、CompletionTracker）无需任何改动；
+  - 提取端用 MatchIPCClient.match()；socket 不存在/连接失败时抛 IPCUnavailable，
+    调用方退回原来的 ./uploadimages 目录交接；
+  - 请求已发出但等结果超时抛 IPCTimeout：匹配端仍会处理完这张图并照常写 ./imageresults，
+    调用方不能再走目录交接（否则同一张图会被匹配两次），只需按普通待完成项等结果文件。
+
+帧格式（每个方向）：
+    [4 字节大端 header 长度][header JSON][4 字节大端 body 长度][body 字节]
+请求 header：{"op": "match", "name": <icon 文件名>, ...}；op="ping" 用于探活。
+响应 header：{"ok": true, "result": <payload>} 或 {"ok": false, "error": "..."}，body 为空。
+"""
+
+import os
+import json
+import socket
+import struct
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+SOCK_PATH    = os.environ.get("ICONML_MATCH_SOCK", "./run/iconml_match.sock")
+IPC_TIMEOUT  = 120.0          # 单次匹配的最长等待（大库首轮推理可能较慢）
+IPC_MAX_CONNECTIONS = 32      # 匹配端同时服务的连接数上限（连接线程池大小）；超出的连接直接关闭，对端退回目录交接
+MAX_FRAME    = 16 * 1024 * 1024
+
+_LEN = struct.Struct(">I")
+
+
+class IPCUnavailable(Exception):
+    """匹配端不可达：调用方应退回目录交接。"""
+
+
+class IPCTimeout(IPCUnavailable):
+    """请求已完整发出、等结果超时：匹配端可能仍在处理，结果会照常落到 ./imageresults，调用方不应再退回目录交接。"""
+
+
+class IPCError(Exception):
+    """匹配端收到请求但处理失败（如图片无法解码）。"""
+
+
+def _recv_exact(sock: socket.socket, n: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("peer closed")
+        buf += chunk
+    return bytes(buf)
+
+
+def _recv_part(sock: socket.socket) -> bytes:
+    (n,) = _LEN.unpack(_recv_exact(sock, _LEN.size))
+    if n > MAX_FRAME:
+        raise ValueError(f"frame too large: {n}")
+    return _recv_exact(sock, n)
+
+
+def send_frame(sock: socket.socket, header: Dict[str, Any], body: bytes = b""):
+    h = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    sock.sendall(_LEN.pack(len(h)) + h + _LEN.pack(len(body)) + body)
+
+
+def recv_frame(sock: socket.socket) -> Tuple[Dict[str, Any], bytes]:
+    header = json.loads(_recv_part(sock).decode("utf-8"))
+    return header, _recv_part(sock)
+
+
+# ================== 匹配端 ==================
+class MatchIPCServer(threading.Thread):
+    """
+    handler(name, data, meta) -> payload(dict)。每个连接占用连接池中的一个线程，连接可复用发送多条请求；
+    同时服务的连接数不超过 max_connections，超出的新连接立即关闭（提取端收到 IPCUnavailable 后退回目录交接）。
+    handler 内部自行串行化模型调用。
+    """
+    def __init__(self, handler: Callable[[str, bytes, Dict[str, Any]], Dict[str, Any]],
+                 sock_path: str = SOCK_PATH, max_connections: int = IPC_MAX_CONNECTIONS):
+        super().__init__(name="match-ipc", daemon=True)
+        self.handler = handler
+        self.sock_path = sock_path
+        self.max_connections = max(1, max_connections)
+        self._slots = threading.BoundedSemaphore(self.max_connections)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_connections, thread_name_prefix="match-ipc-conn")
+        self.rejected = 0
+        d = os.path.dirname(sock_path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        try:
+            os.remove(sock_path)     # 上次异常退出残留的 socket 文件
+        except FileNotFoundError:
+            pass
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(sock_path)
+        self._sock.listen(64)
+
+    def run(self):
+        logging.info(f"[IPC] listening on {self.sock_path}")
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                break            # close() 之后
+            if not self._slots.acquire(blocking=False):
+                self.rejected += 1
+                logging.warning(f"[IPC] {self.max_connections} connections busy, rejecting new connection")
+                conn.close()
+                continue
+            try:
+                self._pool.submit(self._serve, conn)
+            except RuntimeError:     # close() 之后池已关闭
+                self._slots.release()
+                conn.close()
+                break
+
+    def _serve(self, conn: socket.socket):
+        try:
+            self._serve_conn(conn)
+        finally:
+            self._slots.release()
+
+    def _serve_conn(self, conn: socket.socket):
+        with conn:
+            while True:
+                try:
+                    header, body = recv_frame(conn)
+                except (ConnectionError, OSError, ValueError):
+                    return
+                op = header.get("op")
+                try:
+                    if op == "ping":
+                        resp = {"ok": True}
+                    elif op == "match":
+                        resp = {"ok": True, "result": self.handler(header.get("name", ""), body, header)}
+                    else:
+                        resp = {"ok": False, "error": f"unknown op: {op}"}
+                except Exception as e:
+                    logging.error(f"[IPC] {op} {header.get('name', '')} failed: {e}")
+                    resp = {"ok": False, "error": str(e)}
+                try:
+                    send_frame(conn, resp)
+                except OSError:
+                    return
+
+    def close(self):
+        try:
+            self._sock.close()
+            self._pool.shutdown(wait=False)
+        finally:
+            try:
+                os.remove(self.sock_path)
+            except OSError:
+                pass
+
+
+# ================== 提取端 ==================
+class MatchIPCClient:
+    """保持一条长连接；断开后下次调用自动重连。线程不安全，每个线程各用一个实例。"""
+
+    def __init__(self, sock_path: str = SOCK_PATH, timeout: float = IPC_TIMEOUT):
+        self.sock_path = sock_path
+        self.timeout = timeout
+        self._sock: Optional[socket.socket] = None
+
+    def _connect(self) -> socket.socket:
+        if self._sock is None:
+            if not os.path.exists(self.sock_path):
+                raise IPCUnavailable(f"no matcher socket at {self.sock_path}")
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.settimeout(self.timeout)
+            try:
+                s.connect(self.sock_path)
+            except OSError as e:
+                s.close()
+                raise IPCUnavailable(f"connect {self.sock_path}: {e}")
+            self._sock = s
+        return self._sock
+
+    def _call(self, header: Dict[str, Any], body: bytes = b"") -> Dict[str, Any]:
+        s = self._connect()
+        sent = False
+        try:
+            send_frame(s, header, body)
+            sent = True
+            resp, _ = recv_frame(s)
+        except socket.timeout as e:
+            self.close()
+            if sent:
+                raise IPCTimeout(f"{header.get('op')} via {self.sock_path}: no reply in {self.timeout:.0f}s")
+            raise IPCUnavailable(f"{header.get('op')} via {self.sock_path}: {e}")
+        except (OSError, ConnectionError, ValueError) as e:
+            self.close()
+            raise IPCUnavailable(f"{header.get('op')} via {self.sock_path}: {e}")
+        if not resp.get("ok"):
+            raise IPCError(resp.get("error", "unknown error"))
+        return resp
+
+    def ping(self) -> bool:
+        try:
+            self._call({"op": "ping"})
+            return True
+        except (IPCUnavailable, IPCError):
+            return False
+
+    def match(self, name: str, data: bytes, **meta: Any) -> Dict[str, Any]:
+        """发送 icon 字节，返回与 imageresults/<stem>.json 相同的 payload；等结果超时抛 IPCTimeout。"""
+        return self._call({"op": "match", "name": name, **meta}, data)["result"]
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+S3 key 布局（可选的 hash 前缀分区）
+
+平铺布局：     iconml/inforesults/<hash>.json
+分区布局(2级)：iconml/inforesults/ab/cd/<hash>.json
+
+分区取自文件名第一个 '.' 之前的部分（hash / icon_hash）：
+  - 是足够长的十六进制串则直接取其前缀；
+  - 否则（如任意 icon 文件名）取其 md5 的前缀。
+因此 images/<icon_base>.png 与 imageresults/<icon_base>.json 落在同一分区。
+
+watcher、compare_byhash、客户端都通过 partition_key() 生成 key，级数由
+ICONML_S3_PARTITION_LEVELS 控制（0 = 平铺，即原布局）。本模块不依赖 boto3。
+"""
+
+import os
+import hashlib
+
+PARTITION_LEVELS = int(os.environ.get("ICONML_S3_PARTITION_LEVELS", "0"))
+PARTITION_WIDTH  = 2
+
+_HEX = set("0123456789abcdef")
+
+
+def partition_of(name: str, levels: int = PARTITION_LEVELS, width: int = PARTITION_WIDTH) -> str:
+    """返回 'ab/cd' 形式的分区路径；levels<=0 时返回空串。"""
+    if levels <= 0:
+        return ""
+    token = os.path.basename(name).split(".", 1)[0].lower()
+    n = levels * width
+    if len(token) < n or not set(token[:n]) <= _HEX:
+        token = hashlib.md5(token.encode("utf-8")).hexdigest()
+    return "/".join(token[i * width:(i + 1) * width] for i in range(levels))
+
+
+def partition_key(prefix: str, name: str, levels: int = PARTITION_LEVELS) -> str:
+    part = partition_of(name, levels)
+    return f"{prefix}{part}/{name}" if part else prefix + name
+
+
+def layout_hint(prefix: str, pattern: str, levels: int = PARTITION_LEVELS) -> str:
+    """用于日志/汇总说明的 key 形式，如 'inforesults/xx/xx/<hash>.json'。"""
+    if levels <= 0:
+        return prefix + pattern
+    return prefix + "/".join(["xx"] * levels) + "/" + pattern
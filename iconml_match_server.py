@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+常驻 HTTP 匹配服务（进程内模型，同步返回结果）
+
+S3 路径（上传 -> watcher -> ./uploadimages -> 匹配 -> 结果上传 -> 客户端轮询）单张最快也要数秒。
+本服务与 iconml_siamese_compare.py 共用同一套模型、基准库与打分逻辑，常驻内存：
+  - POST /match   上传 icon（multipart 字段 file，或原始 body + ?name=<文件名>），
+                  同步返回与 ./imageresults/<name>.json 相同的 payload（build_results_payload）；
+  - GET  /neighbours?q=<包名或基准图路径>[&q=...][&k=10]
+                  库内近邻：与这些条目图标相似的其他包（sc.library_neighbours，直接用库张量，不解码）；
+  - GET  /health  启动进度（库加载数、模型状态）、就绪状态与批处理统计。
+
+启动时先开始监听，模型与基准库在后台并行加载（sc.load_matcher）；就绪前 /match 返回 503。
+
+并发请求合并推理：请求先在线程池解码，再进入批处理队列；批处理协程等待至多 MAX_BATCH_DELAY 秒
+或凑满 MAX_BATCH_QUERIES 个查询后，用 predict_similarity_multi 一次性打分（Q×N 配对按满批切块）。
+推理在单独的单线程执行器里进行，事件循环不被阻塞。
+
+用法：
+  python iconml_match_server.py --port 8765
+  curl -F file=@xcwewsss.png http://127.0.0.1:8765/match
+"""
+
+import os
+import math
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from aiohttp import web
+
+import iconml_siamese_compare as sc
+
+HOST = os.environ.get("ICONML_MATCH_HOST", "127.0.0.1")
+PORT = int(os.environ.get("ICONML_MATCH_PORT", "8765"))
+
+MAX_BATCH_QUERIES = 16        # 单次合并推理的最大查询数
+MAX_BATCH_DELAY   = 0.010     # 首个请求到达后最多再等多少秒凑批
+MAX_UPLOAD_BYTES  = 4 * 1024 * 1024
+DECODE_WORKERS    = 4
+READY_FILE        = "./state/match_server_ready.json"
+
+
+class MatchBatcher:
+    """把并发到达的查询图合并为一次 predict_similarity_multi 调用。"""
+
+    def __init__(self, model, lib: "sc.BaseLibrary",
+                 max_queries: int = MAX_BATCH_QUERIES, max_delay: float = MAX_BATCH_DELAY):
+        self.model = model
+        self.lib = lib
+        self.base_paths = lib.paths
+        self.max_queries = max_queries
+        self.max_delay = max_delay
+        self._queue: "asyncio.Queue" = asyncio.Queue()
+        self._infer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="infer")
+        self._task = None
+        self.batches = 0
+        self.queries = 0
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._infer.shutdown(wait=False)
+
+    async def run_serial(self, fn, *args):
+        """在推理线程上执行 fn(*args)：与批量打分共用一个线程，模型调用始终串行。"""
+        return await asyncio.get_running_loop().run_in_executor(self._infer, fn, *args)
+
+    async def score(self, img: np.ndarray) -> np.ndarray:
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((img, fut))
+        return await fut
+
+    async def _collect(self) -> list:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_queries:
+            remain = deadline - time.monotonic()
+            if remain <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remain))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            imgs = np.stack([img for img, _ in batch], axis=0)
+            try:
+                scores = await self.run_serial(
+                    sc.predict_similarity_multi, self.model, imgs, self.lib.imgs, sc.BATCH_SIZE)
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            self.batches += 1
+            self.queries += len(batch)
+            for (_, fut), row in zip(batch, self.lib.expand(scores)):
+                if not fut.done():       # 客户端断开时 future 已被取消
+                    fut.set_result(row)
+
+
+async def _read_upload(request: web.Request):
+    if request.content_type.startswith("multipart/"):
+        reader = await request.multipart()
+        while True:
+            part = await reader.next()
+            if part is None:
+                break
+            if part.name == "file":
+                return part.filename or request.query.get("name", "upload.png"), await part.read(decode=False)
+        raise web.HTTPBadRequest(text="missing multipart field 'file'")
+    data = await request.read()
+    if not data:
+        raise web.HTTPBadRequest(text="empty body")
+    return request.query.get("name", "upload.png"), data
+
+
+async def handle_match(request: web.Request) -> web.Response:
+    app = request.app
+    batcher: MatchBatcher = app["batcher"]
+    if batcher is None:
+        return web.json_response(app["status"].snapshot(), status=503)
+    t0 = time.time()
+    name, data = await _read_upload(request)
+    name = os.path.basename(name)
+    if not sc.is_image_file(name):
+        raise web.HTTPBadRequest(text=f"unsupported image type: {name}")
+    try:
+        threshold = float(request.query.get("threshold", sc.SIM_THRESHOLD))
+    except ValueError:
+        raise web.HTTPBadRequest(text="threshold must be a number")
+    if not math.isfinite(threshold):
+        raise web.HTTPBadRequest(text="threshold must be a finite number")
+
+    loop = asyncio.get_running_loop()
+    try:
+        img = await loop.run_in_executor(app["decode_pool"], sc.load_image_bytes, data, name)
+    except Exception as e:
+        raise web.HTTPUnprocessableEntity(text=f"failed to decode '{name}': {e}")
+
+    scores = await batcher.score(img)
+    pairs = sc.matched_pairs(scores, threshold)
+    # 命中项要读 ./info/<package>.txt，放到解码线程池，避免阻塞事件循环（包括 /health）
+    payload = await loop.run_in_executor(app["decode_pool"], sc.build_results_payload, name, batcher.base_paths, pairs)
+    print(f"[SERVE] {name}: best={payload['best_match'] and payload['best_match']['package']} "
+          f"in {(time.time() - t0) * 1000:.1f}ms")
+    return web.json_response(payload)
+
+
+async def handle_neighbours(request: web.Request) -> web.Response:
+    batcher: MatchBatcher = request.app["batcher"]
+    if batcher is None:
+        return web.json_response(request.app["status"].snapshot(), status=503)
+    items = [q for q in request.query.getall("q", []) if q.strip()]
+    if not items:
+        raise web.HTTPBadRequest(text="missing query parameter 'q' (package name or base path)")
+    try:
+        k = int(request.query.get("k", sc.NEIGHBOUR_TOP_K))
+    except ValueError:
+        raise web.HTTPBadRequest(text="k must be an integer")
+    same = request.query.get("same_package", "0") in ("1", "true")
+    # 与 /match 共用推理线程，模型调用保持串行
+    rows = await batcher.run_serial(
+        lambda: sc.library_neighbours(batcher.model, batcher.lib, items, top_k=k, same_package=same))
+    return web.json_response({"results": rows})
+
+
+async def handle_health(request: web.Request) -> web.Response:
+    status: sc.ReadyStatus = request.app["status"]
+    body = status.snapshot()
+    body["ready"] = status.is_ready
+    batcher: MatchBatcher = request.app["batcher"]
+    if batcher is not None:
+        body.update(library_size=len(batcher.base_paths), batches=batcher.batches, queries=batcher.queries)
+    return web.json_response(body, status=200 if status.is_ready else 503)
+
+
+def build_app(loader, status: sc.ReadyStatus,
+              max_queries: int = MAX_BATCH_QUERIES, max_delay: float = MAX_BATCH_DELAY) -> web.Application:
+    """loader() -> (BaseLibrary, model)，在后台线程执行，不阻塞监听。"""
+    app = web.Application(client_max_size=MAX_UPLOAD_BYTES)
+    app["decode_pool"] = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="decode")
+    app["status"] = status
+    app["batcher"] = None
+
+    async def _load(app):
+        try:
+            lib, model = await asyncio.get_running_loop().run_in_executor(None, loader)
+        except Exception as e:
+            status.update(force=True, state="failed", error=str(e))
+            print(f"[FATAL] matcher load failed: {e}")
+            return
+        if len(lib) == 0:
+            status.update(force=True, state="failed", error="no valid base images")
+            print(f"[FATAL] No valid images found in {sc.BASE_DIR} .")
+            return
+        batcher = MatchBatcher(model, lib, max_queries, max_delay)
+        batcher.start()
+        app["batcher"] = batcher
+        status.ready(library_size=len(lib), unique=lib.unique_count)
+        print(f"[READY] Serving {len(lib)} base images after {status.state['startup_secs']:.1f}s")
+
+    async def on_startup(app):
+        app["loader_task"] = asyncio.get_running_loop().create_task(_load(app))
+
+    async def on_cleanup(app):
+        app["loader_task"].cancel()
+        if app["batcher"] is not None:
+            await app["batcher"].stop()
+        app["decode_pool"].shutdown(wait=False)
+        status.update(force=True, state="stopped")
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_post("/match", handle_match)
+    app.router.add_get("/neighbours", handle_neighbours)
+    app.router.add_get("/health", handle_health)
+    return app
+
+
+def main():
+    ap = argparse.ArgumentParser(description="IconML in-process matching service")
+    ap.add_argument("--host", default=HOST)
+    ap.add_argument("--port", type=int, default=PORT)
+    ap.add_argument("--max-batch", type=int, default=MAX_BATCH_QUERIES, help="Max queries coalesced per inference")
+    ap.add_argument("--max-delay-ms", type=float, default=MAX_BATCH_DELAY * 1000,
+                    help="Max wait for more queries after the first one arrives")
+    ap.add_argument("--ready-file", default=READY_FILE, help="Readiness/progress JSON ('' to disable)")
+    args = ap.parse_args()
+
+    sc.setup_gpu()
+    status = sc.ReadyStatus(args.ready_file or None)
+    app = build_app(lambda: sc.load_matcher(status), status, args.max_batch, args.max_delay_ms / 1000.0)
+    print(f"[SERVE] Listening on http://{args.host}:{args.port}  (loading in background)")
+    web.run_app(app, host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,19 +4,33 @@
 """
 IconML S3 Client – Submit & Fetch Results
 
+Single-request CLI. For high-volume programmatic use, import IconMLClient from
+iconml_client.py (futures + one shared result poller).
+
 Modes:
   1) icon-json:
      - Upload icon -> iconml/images/<icon_filename>
      - Upload request json -> iconml/request/<hash>.json
      - Poll & fetch:
-         imageresults/<icon_filename>.json
+         imageresults/<icon_stem>.json
          inforesults/<hash>.json   (if request has app info fields)
   2) requestbyhash:
      - Upload txt -> iconml/requestbyhash/<txt_name>
      - Wait for same-named marker in iconml/requestbyhashdone/
-     - For each hash in txt:
+     - Stream the batch bundle iconml/requestbyhashbundle/<txt_stem>.jsonl.gz (one GET)
+     - With --stream: follow iconml/requestbyhashpartial/<txt_stem>/manifest.json and print
+       results part by part as hashes complete, instead of waiting for the whole batch
+     - Fallback when no bundle exists, for each hash in txt:
          fetch inforesults/<hash>.json
-         if present, read request.icon_filename then fetch imageresults/<icon_filename>.json
+         if present, read request.icon_filename then fetch imageresults/<icon_stem>.json
+  3) bulk:
+     - Directory of icons + JSONL of requests (each names its icon via icon_filename)
+     - Icons renamed to <sha256>.<ext>; each distinct icon uploaded once, concurrently,
+       and skipped when images/<sha256>.<ext> or its image result already exists
+     - All results gathered into one JSONL file
+  4) status:
+     - One GET of the state manifest iconml/state/requests.json
+     - Print lifecycle state (received/processing/done/failed + timestamps) per hash
 
 Usage examples:
   python iconml_client.py icon-json \
@@ -27,34 +41,52 @@ Usage examples:
 
   python iconml_client.py requestbyhash \
       --bucket mr-dev-iconml-request \
-      --txt ./batch_2025_11_10.txt
+      --txt ./batch_2025_11_10.txt [--stream]
+
+  Set ICONML_S3_PARTITION_LEVELS (or --partition-levels) to match the watcher when the
+  bucket uses the hash-partitioned layout, e.g. iconml/inforesults/ab/cd/<hash>.json.
+
+  python iconml_client.py bulk \
+      --dir ./icons --requests ./requests.jsonl --out ./results.jsonl
+
+  python iconml_client.py status \
+      --bucket mr-dev-iconml-request \
+      --hash 21cf2e...6724 9a0b...77c1
 """
 
 import argparse
+import gzip
+import io
 import json
 import os
 import sys
 import time
 from pathlib import Path
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, Iterator, List
 
 import boto3
 from botocore.exceptions import ClientError
 
+from iconml_layout import PARTITION_LEVELS, partition_key
+
 # --------- S3 Layout (adjust if needed) ----------
 PREFIX_IMAGES              = "iconml/images/"
 PREFIX_REQUEST             = "iconml/request/"
-PREFIX_PROCESSING          = "iconml/processing/"         # system-managed
-PREFIX_PROCESSED           = "iconml/processed/"          # system-managed
+PREFIX_PROCESSING          = "iconml/processing/"         # legacy, no longer used
+PREFIX_PROCESSED           = "iconml/processed/"          # system-managed (batched archival)
+KEY_STATE_MANIFEST         = "iconml/state/requests.json" # system-managed
 PREFIX_IMAGERESULTS        = "iconml/imageresults/"
 PREFIX_INFORESULTS         = "iconml/inforesults/"
 PREFIX_REQUESTBYHASH       = "iconml/requestbyhash/"
 PREFIX_REQUESTBYHASH_DONE  = "iconml/requestbyhashdone/"
+PREFIX_REQUESTBYHASH_BUNDLE = "iconml/requestbyhashbundle/"
+PREFIX_REQUESTBYHASH_PARTIAL = "iconml/requestbyhashpartial/"
 
 # --------- Defaults for polling ----------
 DEFAULT_POLL_SECS      = 3.0
 DEFAULT_MAX_WAIT_SECS  = 30 * 60    # 30 minutes
 HEAD_RETRY_INTERVAL    = 1.0
+CLOCK_SKEW_SECS        = 300        # partial manifests older than submit time minus this are stale
 
 DEFAULT_BUCKET = "mr-dev-iconml-request"
 DEFAULT_REGION = "us-west-2"
@@ -85,6 +117,24 @@ def s3_get_json(s3, bucket: str, key: str) -> Dict[str, Any]:
     data = r["Body"].read()
     return json.loads(data.decode("utf-8", errors="replace"))
 
+def s3_iter_jsonl_gz(s3, bucket: str, key: str) -> Iterator[Dict[str, Any]]:
+    """Stream a gzip JSONL object line by line without loading it into memory."""
+    r = s3.get_object(Bucket=bucket, Key=key)
+    with gzip.GzipFile(fileobj=r["Body"]) as gz:
+        for line in io.TextIOWrapper(gz, encoding="utf-8", errors="replace"):
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def image_result_name(icon_filename: str) -> str:
+    """The matcher names image results after the icon stem: abc.png -> abc.json."""
+    return f"{Path(icon_filename).stem}.json"
+
+
+def is_not_found(e: ClientError) -> bool:
+    code = e.response.get("Error", {}).get("Code", "")
+    return str(code) in ("404", "NoSuchKey", "NotFound")
+
 def s3_exists(s3, bucket: str, key: str) -> bool:
     try:
         s3.head_object(Bucket=bucket, Key=key)
@@ -120,7 +170,7 @@ def mode_icon_json(args):
     Steps:
       1) upload icon to images/
       2) upload request json to request/<hash>.json
-      3) wait imageresults/<icon_filename>.json   (always for icon mode)
+      3) wait imageresults/<icon_stem>.json   (always for icon mode)
       4) if request has app fields (hash, package/label/devid/permissions), also wait inforesults/<hash>.json
     """
     s3 = s3_client(args.profile, args.region)
@@ -144,22 +194,23 @@ def mode_icon_json(args):
         icon_filename = req["icon_filename"]
 
     # 1) upload icon
-    key_icon = PREFIX_IMAGES + icon_filename
+    levels = args.partition_levels
+    key_icon = partition_key(PREFIX_IMAGES, icon_filename, levels)
     s3_upload_file(s3, bucket, str(icon_path), key_icon)
 
     # 2) upload request json (name by hash if present; else use icon_filename base)
     req_hash = req.get("hash")
     if req_hash:
-        key_req = f"{PREFIX_REQUEST}{req_hash}.json"
+        key_req = partition_key(PREFIX_REQUEST, f"{req_hash}.json", levels)
     else:
         # icon-only mode without hash: allow request named by icon base + timestamp
         base = Path(icon_filename).stem
-        key_req = f"{PREFIX_REQUEST}{base}_{int(time.time())}.json"
+        key_req = partition_key(PREFIX_REQUEST, f"{base}_{int(time.time())}.json", levels)
 
     s3_put_json(s3, bucket, key_req, req)
 
     # 3) wait for imageresults
-    key_imgres = f"{PREFIX_IMAGERESULTS}{icon_filename}.json"
+    key_imgres = partition_key(PREFIX_IMAGERESULTS, image_result_name(icon_filename), levels)
     print(f"[WAIT] imageresults: s3://{bucket}/{key_imgres}")
     ok = poll_until_exists(s3, bucket, key_imgres, args.max_wait, args.poll)
     if not ok:
@@ -171,7 +222,7 @@ def mode_icon_json(args):
 
     # 4) wait for inforesults (only if request had app info / hash)
     if req_hash:
-        key_infores = f"{PREFIX_INFORESULTS}{req_hash}.json"
+        key_infores = partition_key(PREFIX_INFORESULTS, f"{req_hash}.json", levels)
         print(f"[WAIT] inforesults: s3://{bucket}/{key_infores}")
         ok2 = poll_until_exists(s3, bucket, key_infores, args.max_wait, args.poll)
         if not ok2:
@@ -201,9 +252,10 @@ def mode_requestbyhash(args):
     Steps:
       1) upload local txt -> iconml/requestbyhash/<name>.txt
       2) wait same name appears in iconml/requestbyhashdone/
-      3) for each hash in txt:
+      3) stream the batch bundle (one GET for all hashes)
+      4) fallback if the bundle is missing, for each hash in txt:
            - try fetch inforesults/<hash>.json
-           - if present, read request.icon_filename, then fetch imageresults/<icon_filename>.json
+           - if present, read request.icon_filename, then fetch imageresults/<icon_stem>.json
     """
     s3 = s3_client(args.profile, args.region)
     bucket = args.bucket
@@ -220,8 +272,13 @@ def mode_requestbyhash(args):
     # 1) upload txt
     name = txt_path.name
     key_reqhash = f"{PREFIX_REQUESTBYHASH}{name}"
+    submit_ts = time.time()
     s3_upload_file(s3, bucket, str(txt_path), key_reqhash)
 
+    if args.stream:
+        stream_partials(s3, bucket, txt_path, hashes, submit_ts, args.max_wait, args.poll)
+        return
+
     # 2) wait for done marker
     key_done = f"{PREFIX_REQUESTBYHASH_DONE}{name}"
     print(f"[WAIT] requestbyhash done marker: s3://{bucket}/{key_done}")
@@ -230,13 +287,23 @@ def mode_requestbyhash(args):
         print(f"[TIMEOUT] requestbyhash done marker not found within {args.max_wait}s. Exiting.")
         sys.exit(3)
 
+    # 3) batch bundle
+    key_bundle = f"{PREFIX_REQUESTBYHASH_BUNDLE}{txt_path.stem}.jsonl.gz"
+    try:
+        if print_bundle(s3, bucket, key_bundle, hashes):
+            return
+    except ClientError as e:
+        if not is_not_found(e):
+            raise
+        print(f"[NOTE] no bundle at s3://{bucket}/{key_bundle}, falling back to per-hash fetch")
+
     print("\n[INFO] Batch marked done. Now fetching results per hash...\n")
 
-    # 3) per-hash results
+    # 4) per-hash results
     for h in hashes:
         print("="*70)
         print(f"[HASH] {h}")
-        key_info = f"{PREFIX_INFORESULTS}{h}.json"
+        key_info = partition_key(PREFIX_INFORESULTS, f"{h}.json", args.partition_levels)
         if not s3_exists(s3, bucket, key_info):
             print(f"[MISS] inforesults not found for hash: {h}")
             continue
@@ -252,7 +319,7 @@ def mode_requestbyhash(args):
             icon_fn = None
 
         if icon_fn:
-            key_imgres = f"{PREFIX_IMAGERESULTS}{icon_fn}.json"
+            key_imgres = partition_key(PREFIX_IMAGERESULTS, image_result_name(icon_fn), args.partition_levels)
             if s3_exists(s3, bucket, key_imgres):
                 imgres = s3_get_json(s3, bucket, key_imgres)
                 print("\n--- ImageResults ---")
@@ -263,6 +330,177 @@ def mode_requestbyhash(args):
             print("[NOTE] inforesults.request.icon_filename missing; skip imageresults fetch.")
     print("\n[DONE] requestbyhash batch fetch complete.")
 
+def print_record(rec: Dict[str, Any]):
+    h = rec.get("hash", "")
+    print("="*70)
+    print(f"[HASH] {h}  status={rec.get('status')}")
+    if rec.get("inforesult") is None:
+        print(f"[MISS] inforesults not found for hash: {h}")
+        return
+    print("\n--- InfoResults ---")
+    print(json.dumps(rec["inforesult"], ensure_ascii=False, indent=2))
+    if rec.get("imageresult") is not None:
+        print("\n--- ImageResults ---")
+        print(json.dumps(rec["imageresult"], ensure_ascii=False, indent=2))
+    else:
+        print(f"[MISS] imageresults not found for icon: {rec.get('icon_base')}")
+
+def print_bundle(s3, bucket: str, key: str, hashes: List[str]) -> bool:
+    """Print every record of the batch bundle; hashes absent from it are reported as missing."""
+    print(f"\n[INFO] Batch marked done. Streaming bundle s3://{bucket}/{key}\n")
+    seen = set()
+    for rec in s3_iter_jsonl_gz(s3, bucket, key):
+        seen.add(rec.get("hash", ""))
+        print_record(rec)
+    for h in hashes:
+        if h not in seen:
+            print(f"[MISS] hash not in bundle: {h}")
+    print("\n[DONE] requestbyhash batch fetch complete.")
+    return True
+
+def stream_partials(s3, bucket: str, txt_path: Path, hashes: List[str],
+                    submit_ts: float, max_wait: float, poll_secs: float):
+    """
+    Follow the rolling partial manifest: each poll is one GET; new parts are streamed
+    and their records printed as soon as they are published. Stops at the final manifest.
+    """
+    key_manifest = f"{PREFIX_REQUESTBYHASH_PARTIAL}{txt_path.stem}/manifest.json"
+    print(f"[WAIT] partial results: s3://{bucket}/{key_manifest}")
+    fetched_parts = set()
+    seen = set()
+    last_seq = None
+    deadline = time.time() + max_wait
+    while time.time() < deadline:
+        try:
+            manifest = s3_get_json(s3, bucket, key_manifest)
+        except ClientError as e:
+            if not is_not_found(e):
+                raise
+            manifest = None
+        # ignore a manifest left over from an earlier submission of the same batch name
+        if manifest and manifest.get("run", 0) / 1000.0 >= submit_ts - CLOCK_SKEW_SECS:
+            if manifest.get("seq") != last_seq:
+                last_seq = manifest.get("seq")
+                for key in manifest.get("parts", []):
+                    if key in fetched_parts:
+                        continue
+                    for rec in s3_iter_jsonl_gz(s3, bucket, key):
+                        if rec.get("hash") not in seen:
+                            seen.add(rec.get("hash"))
+                            print_record(rec)
+                    fetched_parts.add(key)
+                print(f"[PART] seq={last_seq} completed={len(seen)}/{manifest.get('total', len(hashes))}")
+            if manifest.get("final"):
+                for h in hashes:
+                    if h not in seen:
+                        print(f"[MISS] hash not in partial results: {h}")
+                print("\n[DONE] requestbyhash batch stream complete.")
+                return
+        time.sleep(poll_secs)
+    print(f"[TIMEOUT] batch not final within {max_wait}s; {len(seen)}/{len(hashes)} hash(es) received.")
+    sys.exit(3)
+
+# =================================================
+# Mode 3: bulk directory submit (content-addressed)
+# =================================================
+
+def read_jsonl(path: Path) -> List[Dict[str, Any]]:
+    out = []
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                out.append(json.loads(line))
+    return out
+
+def mode_bulk(args):
+    # imported lazily: iconml_client imports helpers from this module
+    from concurrent.futures import as_completed
+    from iconml_client import IconMLClient
+
+    icon_dir = Path(args.dir).expanduser().resolve()
+    req_path = Path(args.requests).expanduser().resolve()
+    if not icon_dir.is_dir():
+        print(f"[FATAL] icon dir not found: {icon_dir}")
+        sys.exit(2)
+    if not req_path.exists():
+        print(f"[FATAL] requests jsonl not found: {req_path}")
+        sys.exit(2)
+    reqs = read_jsonl(req_path)
+    if not reqs:
+        print(f"[FATAL] no requests in: {req_path}")
+        sys.exit(2)
+
+    t0 = time.time()
+    with IconMLClient(bucket=args.bucket, profile=args.profile, region=args.region,
+                      partition_levels=args.partition_levels, poll_secs=args.poll,
+                      max_wait=args.max_wait, workers=args.workers) as client:
+        futs = client.submit_bulk(icon_dir, reqs)
+        st = client.last_bulk_stats
+        print(f"[BULK] requests={st['requests']} distinct_icons={st['distinct_icons']} "
+              f"uploaded={st['uploaded']} skipped_existing={st['skipped_existing']} "
+              f"cached_results={st['cached_results']} ({time.time() - t0:.1f}s)")
+
+        index = {f: i for i, f in enumerate(futs)}
+        ok = failed = 0
+        with open(args.out, "w", encoding="utf-8") as out:
+            for f in as_completed(futs):
+                i = index[f]
+                rec: Dict[str, Any] = {"index": i, "hash": reqs[i].get("hash")}
+                try:
+                    rec.update(f.result())
+                    ok += 1
+                except Exception as e:
+                    rec["error"] = f"{type(e).__name__}: {e}"
+                    failed += 1
+                out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                if (ok + failed) % 100 == 0:
+                    print(f"[BULK] {ok + failed}/{len(futs)} done")
+    print(f"[DONE] bulk: ok={ok} failed={failed} -> {args.out} ({time.time() - t0:.1f}s)")
+
+# =================================================
+# Mode 4: status (state manifest)
+# =================================================
+
+def fmt_ts(ts: Optional[float]) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)) if ts else "-"
+
+def mode_status(args):
+    """
+    One GET of the state manifest; no per-request HEAD/LIST.
+    Without --hash, print counts by state.
+    """
+    s3 = s3_client(args.profile, args.region)
+    try:
+        manifest = s3_get_json(s3, args.bucket, KEY_STATE_MANIFEST)
+    except ClientError as e:
+        print(f"[FATAL] cannot read state manifest s3://{args.bucket}/{KEY_STATE_MANIFEST}: {e}")
+        sys.exit(3)
+    reqs = manifest.get("requests", {})
+    print(f"[INFO] manifest generated at {fmt_ts(manifest.get('generated_at'))}, {len(reqs)} request(s)")
+
+    if not args.hash:
+        counts: Dict[str, int] = {}
+        for ent in reqs.values():
+            counts[ent.get("state", "?")] = counts.get(ent.get("state", "?"), 0) + 1
+        for state in sorted(counts):
+            print(f"  {state:<11} {counts[state]}")
+        return
+
+    for h in args.hash:
+        ent = reqs.get(h)
+        if not ent:
+            print(f"[MISS] {h}: not in manifest (not received yet, or older than retention)")
+            continue
+        line = (f"[{ent.get('state', '?').upper()}] {h}"
+                f"  received={fmt_ts(ent.get('received_at'))}"
+                f"  processing={fmt_ts(ent.get('processing_at'))}"
+                f"  image_done={fmt_ts(ent.get('image_done_at'))}"
+                f"  done={fmt_ts(ent.get('done_at'))}")
+        if ent.get("state") == "failed":
+            line += f"  error={ent.get('error')}"
+        print(line)
+
 # =================================================
 # CLI
 # =================================================
@@ -274,6 +512,8 @@ def build_parser():
     p.add_argument("--region", default=DEFAULT_REGION, help=f"AWS region (default: {DEFAULT_REGION})")
     p.add_argument("--poll", type=float, default=DEFAULT_POLL_SECS, help="Polling interval seconds")
     p.add_argument("--max-wait", type=float, default=DEFAULT_MAX_WAIT_SECS, help="Max wait seconds")
+    p.add_argument("--partition-levels", type=int, default=PARTITION_LEVELS,
+                   help=f"Hash-partition levels of the S3 layout, 0 = flat (default: {PARTITION_LEVELS})")
 
     sub = p.add_subparsers(dest="mode", required=True)
 
@@ -285,6 +525,19 @@ def build_parser():
     # mode 2: requestbyhash
     p2 = sub.add_parser("requestbyhash", help="Submit a txt of hashes, wait done marker, fetch each hash results")
     p2.add_argument("--txt", required=True, help="Local txt file with hashes (one per line)")
+    p2.add_argument("--stream", action="store_true",
+                    help="Print results as partial manifests are published instead of waiting for the done marker")
+
+    # mode 3: bulk
+    p3 = sub.add_parser("bulk", help="Submit a directory of icons + JSONL of requests with sha256 dedupe")
+    p3.add_argument("--dir", required=True, help="Directory containing the icons named by the requests")
+    p3.add_argument("--requests", required=True, help="JSONL file, one request json per line")
+    p3.add_argument("--out", default="bulk_results.jsonl", help="Output JSONL of results")
+    p3.add_argument("--workers", type=int, default=16, help="Concurrent uploads/fetches")
+
+    # mode 4: status
+    p4 = sub.add_parser("status", help="Query request lifecycle state from the state manifest")
+    p4.add_argument("--hash", nargs="*", default=[], help="Request hash(es); omit for counts by state")
     return p
 
 def main():
@@ -295,6 +548,10 @@ def main():
         mode_icon_json(args)
     elif args.mode == "requestbyhash":
         mode_requestbyhash(args)
+    elif args.mode == "bulk":
+        mode_bulk(args)
+    elif args.mode == "status":
+        mode_status(args)
     else:
         print(f"[FATAL] unknown mode: {args.mode}")
         sys.exit(2)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+图片匹配结果缓存（内容寻址）
+
+同一 icon（sha256 相同）经 iconml/images/、./uploadimages、IPC 反复提交，每次都要全库重新打分。
+这里按 (icon 内容 sha256, 基准库版本, 模型权重指纹, 阈值) 缓存命中列表 [(base 下标, score)]：
+  - 后三项合成 context；基准库或权重变化后 context 改变，旧条目自然失效（启动时直接清除）；
+  - 内存 LRU（OrderedDict）+ sqlite 持久化，重启后按最近使用时间恢复，超出 max_entries 淘汰最旧；
+  - 同一 key 的并发请求合并：首个请求计算，其余等待同一个 Future。
+
+缓存的是下标与分数而不是最终 JSON：best_match 的 info 字段每次由 build_results_payload 现取，
+所以 ./info 更新后不会返回陈旧的包信息。
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterable, List, Tuple
+
+Pairs = List[Tuple[int, float]]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    icon_sha256  TEXT NOT NULL,
+    context      TEXT NOT NULL,
+    pairs        TEXT NOT NULL,
+    used_at      REAL NOT NULL,
+    PRIMARY KEY (icon_sha256, context)
+);
+CREATE INDEX IF NOT EXISTS idx_results_used ON results(used_at);
+"""
+
+
+def sha256_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def library_generation(base_paths: Iterable[str]) -> str:
+    """基准库版本：全部路径 + size + mtime 的摘要（与加载顺序相关，下标随之变化时版本也变）。"""
+    h = hashlib.sha1()
+    for p in base_paths:
+        try:
+            st = os.stat(p)
+            h.update(f"{p}\0{st.st_size}\0{st.st_mtime_ns}\n".encode("utf-8", "surrogateescape"))
+        except OSError:
+            h.update(f"{p}\0-\n".encode("utf-8", "surrogateescape"))
+    return h.hexdigest()[:16]
+
+
+def weights_fingerprint(weights_path: str) -> str:
+    """TF checkpoint 前缀（<prefix>.index / <prefix>.data-*）或单个权重文件的内容摘要。"""
+    d, prefix = os.path.split(weights_path)
+    d = d or "."
+    try:
+        names = sorted(n for n in os.listdir(d) if n == prefix or n.startswith(prefix + "."))
+    except OSError:
+        names = []
+    h = hashlib.sha1()
+    for n in names:
+        h.update(n.encode("utf-8"))
+        with open(os.path.join(d, n), "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()[:16] if names else "none"
+
+
+def make_context(library_gen: str, weights_fp: str, threshold: float) -> str:
+    return f"{library_gen}:{weights_fp}:{threshold!r}"
+
+
+class ResultCache:
+    def __init__(self, db_path: str, context: str, max_entries: int = 100000):
+        d = os.path.dirname(db_path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self.context = context
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._lru: "OrderedDict[str, Pairs]" = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        stale = self._db.execute("DELETE FROM results WHERE context<>?", (context,)).rowcount
+        rows = self._db.execute(
+            "SELECT icon_sha256, pairs FROM results WHERE context=? ORDER BY used_at DESC LIMIT ?",
+            (context, max_entries)).fetchall()
+        for sha, pairs in reversed(rows):
+            self._lru[sha] = [(int(i), float(s)) for i, s in json.loads(pairs)]
+        self._db.execute(
+            "DELETE FROM results WHERE rowid NOT IN (SELECT rowid FROM results ORDER BY used_at DESC LIMIT ?)",
+            (max_entries,))
+        logging.info(f"[CACHE] {len(self._lru)} cached result(s) restored, {stale} stale dropped ({db_path})")
+
+    def get(self, sha: str):
+        with self._lock:
+            pairs = self._lru.get(sha)
+            if pairs is None:
+                return None
+            self._lru.move_to_end(sha)
+            self._db.execute("UPDATE results SET used_at=? WHERE icon_sha256=? AND context=?",
+                             (time.time(), sha, self.context))
+            return pairs
+
+    def put(self, sha: str, pairs: Pairs):
+        pairs = [(int(i), float(s)) for i, s in pairs]
+        with self._lock:
+            self._lru[sha] = pairs
+            self._lru.move_to_end(sha)
+            self._db.execute("INSERT OR REPLACE INTO results (icon_sha256, context, pairs, used_at) VALUES (?,?,?,?)",
+                             (sha, self.context, json.dumps(pairs), time.time()))
+            while len(self._lru) > self.max_entries:
+                old, _ = self._lru.popitem(last=False)
+                self._db.execute("DELETE FROM results WHERE icon_sha256=? AND context=?", (old, self.context))
+
+    def get_or_compute(self, sha: str, compute: Callable[[], Pairs]) -> Tuple[Pairs, bool]:
+        """返回 (pairs, cached)。同一 sha 同时只计算一次，其余调用等待其结果（异常同样传递）。"""
+        pairs = self.get(sha)
+        if pairs is not None:
+            self.hits += 1
+            return pairs, True
+        with self._lock:
+            pairs = self._lru.get(sha)        # 另一个 leader 可能刚刚写入
+            if pairs is not None:
+                self.hits += 1
+                return pairs, True
+            fut = self._inflight.get(sha)
+            leader = fut is None
+            if leader:
+                fut = self._inflight[sha] = Future()
+        if not leader:
+            self.coalesced += 1
+            return fut.result(), True
+
+        self.misses += 1
+        try:
+            pairs = compute()
+            self.put(sha, pairs)
+            fut.set_result(pairs)
+            return pairs, False
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(sha, None)
+
+    def stats(self) -> str:
+        return f"size={len(self._lru)} hits={self.hits} misses={self.misses} coalesced={self.coalesced}"
+
+    def close(self):
+        with self._lock:
+            self._db.close()
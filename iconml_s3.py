@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+共享 S3 传输引擎
+
+原先每个 watcher 线程各自 boto3.client，并串行执行 download/upload/copy/delete。
+TransferEngine 统一提供：
+  - 一个线程安全的 S3 client（调大 max_pool_connections，自适应重试）；
+  - 线程池执行“有序工作项”：同一个工作项内的步骤按顺序执行，不同工作项并发执行；
+    同一 lane（例如同一个 request 名）上的工作项按提交顺序串行；
+  - upload/download 走 TransferConfig 的分片并发；
+  - 删除攒批，用 delete_objects 一次最多 1000 个。
+另有 ListingCache：只用 list_objects_v2 自带的 ETag/LastModified 做增量，不再逐 key head_object；
+分区布局（见 iconml_layout）下按子分区并发列举。
+
+本地测试：设置 ICONML_S3_ENDPOINT_URL 指向 MinIO / moto server 即可；
+也可直接 TransferEngine(client=<moto mock 出来的 client>)。
+"""
+
+import os
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Iterator, List, NamedTuple, Optional
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# --- 调优参数 ---
+S3_ENDPOINT_URL        = os.environ.get("ICONML_S3_ENDPOINT_URL") or None
+TRANSFER_WORKERS       = int(os.environ.get("ICONML_TRANSFER_WORKERS", "32"))
+MAX_POOL_CONNECTIONS   = TRANSFER_WORKERS * 2          # 每个工作项内部的分片传输也要占连接
+MULTIPART_THRESHOLD    = 8 * 1024 * 1024
+MULTIPART_CHUNKSIZE    = 8 * 1024 * 1024
+MULTIPART_CONCURRENCY  = 8
+DELETE_BATCH_MAX       = 1000                         # delete_objects 上限
+RECONCILE_EVERY        = 20                           # 有序前缀：每 N 次增量列举做一次全量核对
+LIST_WORKERS           = 16                           # 分区布局下并发列举的子分区数
+
+
+def make_s3_client(endpoint_url: Optional[str] = S3_ENDPOINT_URL,
+                   max_pool_connections: int = MAX_POOL_CONNECTIONS):
+    cfg = Config(
+        max_pool_connections=max_pool_connections,
+        retries={"max_attempts": 8, "mode": "adaptive"},
+        tcp_keepalive=True,
+    )
+    return boto3.client("s3", endpoint_url=endpoint_url, config=cfg)
+
+
+class TransferEngine:
+    def __init__(self, client=None, workers: int = TRANSFER_WORKERS,
+                 transfer_config: Optional[TransferConfig] = None):
+        self.s3 = client or make_s3_client()
+        self.transfer_config = transfer_config or TransferConfig(
+            multipart_threshold=MULTIPART_THRESHOLD,
+            multipart_chunksize=MULTIPART_CHUNKSIZE,
+            max_concurrency=MULTIPART_CONCURRENCY,
+            use_threads=True,
+        )
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="s3x")
+        self._lock = threading.Lock()
+        self._lanes: Dict[str, Deque] = {}
+        self._pending_deletes: Dict[str, List[str]] = {}   # bucket -> [key]
+
+    # ---------------- 工作项 ----------------
+    def submit(self, fn: Callable, *args, lane: Optional[str] = None, **kwargs) -> Future:
+        """
+        提交一个工作项。lane 相同的工作项按提交顺序串行执行；lane=None 则完全并发。
+        """
+        if lane is None:
+            return self._pool.submit(fn, *args, **kwargs)
+        fut: Future = Future()
+        with self._lock:
+            q = self._lanes.get(lane)
+            if q is not None:
+                q.append((fn, args, kwargs, fut))
+                return fut
+            self._lanes[lane] = deque()
+        self._start(lane, fn, args, kwargs, fut)
+        return fut
+
+    def map(self, fn: Callable, items, lane_of: Optional[Callable] = None) -> List[Future]:
+        """对 items 中每个元素提交 fn(item)，返回与 items 同序的 future 列表。"""
+        return [self.submit(fn, it, lane=lane_of(it) if lane_of else None) for it in items]
+
+    def _start(self, lane: str, fn, args, kwargs, fut: Future):
+        def _run():
+            if not fut.set_running_or_notify_cancel():
+                return
+            try:
+                fut.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                fut.set_exception(e)
+        inner = self._pool.submit(_run)
+        inner.add_done_callback(lambda _f: self._next(lane))
+
+    def _next(self, lane: str):
+        with self._lock:
+            q = self._lanes.get(lane)
+            if not q:
+                self._lanes.pop(lane, None)
+                return
+            fn, args, kwargs, fut = q.popleft()
+        self._start(lane, fn, args, kwargs, fut)
+
+    # ---------------- 传输原语 ----------------
+    def download(self, bucket: str, key: str, local_path: str):
+        self.s3.download_file(bucket, key, local_path, Config=self.transfer_config)
+
+    def upload(self, bucket: str, key: str, local_path: str):
+        self.s3.upload_file(local_path, bucket, key, Config=self.transfer_config)
+
+    def copy(self, bucket: str, src_key: str, dst_key: str):
+        self.s3.copy_object(Bucket=bucket, CopySource={"Bucket": bucket, "Key": src_key}, Key=dst_key)
+
+    def delete_later(self, bucket: str, key: str):
+        """登记删除；由 flush_deletes 批量提交（攒满一批时自动提交）。"""
+        with self._lock:
+            keys = self._pending_deletes.setdefault(bucket, [])
+            keys.append(key)
+            full = len(keys) >= DELETE_BATCH_MAX
+        if full:
+            self.flush_deletes(bucket)
+
+    def flush_deletes(self, bucket: Optional[str] = None) -> int:
+        with self._lock:
+            buckets = [bucket] if bucket else list(self._pending_deletes)
+            batches = {b: self._pending_deletes.pop(b, []) for b in buckets}
+        n = 0
+        for b, keys in batches.items():
+            keys = list(dict.fromkeys(keys))
+            for i in range(0, len(keys), DELETE_BATCH_MAX):
+                chunk = keys[i:i + DELETE_BATCH_MAX]
+                try:
+                    resp = self.s3.delete_objects(
+                        Bucket=b,
+                        Delete={"Objects": [{"Key": k} for k in chunk], "Quiet": True},
+                    )
+                except ClientError as e:
+                    logging.error(f"[S3X] delete_objects failed ({len(chunk)} keys): {e}")
+                    continue
+                for err in resp.get("Errors", []):
+                    logging.warning(f"[S3X] delete {err.get('Key')} failed: {err.get('Code')} {err.get('Message')}")
+                n += len(chunk) - len(resp.get("Errors", []))
+        if n:
+            logging.info(f"S3 batch delete: {n} key(s)")
+        return n
+
+    def shutdown(self):
+        self.flush_deletes()
+        self._pool.shutdown(wait=True)
+
+
+_engine: Optional[TransferEngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> TransferEngine:
+    """进程内共享的传输引擎（三个 watcher 共用一个连接池与线程池）。"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = TransferEngine()
+        return _engine
+
+
+# =========================== 增量列举 ===========================
+class S3Object(NamedTuple):
+    key: str
+    etag: str
+    last_modified: float
+    size: int
+
+
+def list_objects(s3, bucket: str, prefix: str, start_after: Optional[str] = None) -> Iterator[S3Object]:
+    """分页列举 prefix；start_after 给定时只返回字典序在其之后的 key。"""
+    token = None
+    while True:
+        params = {"Bucket": bucket, "Prefix": prefix}
+        if token:
+            params["ContinuationToken"] = token
+        elif start_after:
+            params["StartAfter"] = start_after
+        resp = s3.list_objects_v2(**params)
+        for c in resp.get("Contents", []):
+            if c["Key"].endswith("/"):
+                continue
+            yield S3Object(c["Key"], c.get("ETag", "").strip('"'), c["LastModified"].timestamp(), c.get("Size", 0))
+        if not resp.get("IsTruncated"):
+            return
+        token = resp.get("NextContinuationToken")
+
+
+def list_objects_parallel(s3, bucket: str, prefix: str, workers: int = LIST_WORKERS) -> List[S3Object]:
+    """
+    分区布局的列举：先用 Delimiter='/' 列一次，得到直属对象（未迁移的平铺 key）与一级子分区，
+    再对各子分区并发分页列举（子分区内部的更深层级由普通列举递归覆盖）。
+    """
+    out: List[S3Object] = []
+    parts: List[str] = []
+    token = None
+    while True:
+        params = {"Bucket": bucket, "Prefix": prefix, "Delimiter": "/"}
+        if token:
+            params["ContinuationToken"] = token
+        resp = s3.list_objects_v2(**params)
+        for c in resp.get("Contents", []):
+            if not c["Key"].endswith("/"):
+                out.append(S3Object(c["Key"], c.get("ETag", "").strip('"'), c["LastModified"].timestamp(), c.get("Size", 0)))
+        parts.extend(cp["Prefix"] for cp in resp.get("CommonPrefixes", []))
+        if not resp.get("IsTruncated"):
+            break
+        token = resp.get("NextContinuationToken")
+    if not parts:
+        return out
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(parts))), thread_name_prefix="s3ls") as pool:
+        for objs in pool.map(lambda p: list(list_objects(s3, bucket, p)), parts):
+            out.extend(objs)
+    return out
+
+
+class ListingCache:
+    """
+    记住 prefix 下每个 key 的 ETag/LastModified，changes() 只返回新出现或内容变化的对象。
+
+    ordered=False：每次全量列举（适合处理后即被移走/删除、规模很小的前缀，如 request/）；
+                   消失的 key 会被遗忘，同名重新上传会再次产出。
+    ordered=True ：key 按字典序递增追加（如带日期的批次名），平时只用 StartAfter 从检查点往后列；
+                   每 reconcile_every 次做一次全量核对，兜住覆盖写入与乱序 key。
+    partitioned  ：prefix 下为 hash 分区布局，全量列举时按子分区并发（与 ordered 互斥）。
+    """
+    def __init__(self, s3, bucket: str, prefix: str, suffix: str = "",
+                 ordered: bool = False, reconcile_every: int = RECONCILE_EVERY,
+                 partitioned: bool = False):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.suffix = suffix
+        self.ordered = ordered and not partitioned
+        self.partitioned = partitioned
+        self.reconcile_every = max(1, reconcile_every)
+        self._etags: Dict[str, str] = {}
+        self._checkpoint: Optional[str] = None
+        self._cycles = 0
+
+    def changes(self) -> List[S3Object]:
+        full = not self.ordered or self._cycles % self.reconcile_every == 0
+        self._cycles += 1
+        start_after = None if full else self._checkpoint
+        try:
+            if self.partitioned:
+                listed = list_objects_parallel(self.s3, self.bucket, self.prefix)
+            else:
+                listed = list(list_objects(self.s3, self.bucket, self.prefix, start_after=start_after))
+        except ClientError as e:
+            # 列举失败不修改缓存，下一轮重来
+            logging.error(f"list_objects error: {e} (prefix={self.prefix})")
+            return []
+        out: List[S3Object] = []
+        present = set()
+        for o in listed:
+            if self.suffix and not o.key.endswith(self.suffix):
+                continue
+            present.add(o.key)
+            if self._checkpoint is None or o.key > self._checkpoint:
+                self._checkpoint = o.key
+            if self._etags.get(o.key) != o.etag:
+                self._etags[o.key] = o.etag
+                out.append(o)
+        if full:
+            for k in [k for k in self._etags if k not in present]:
+                self._etags.pop(k, None)
+        return out
+
+    def accept(self, objs: List[S3Object]) -> List[S3Object]:
+        """
+        登记由其他渠道（如 S3 事件通知）得知的对象，返回其中新出现或内容变化的部分；
+        之后的 changes() 不会再次产出这些对象。
+        """
+        out: List[S3Object] = []
+        for o in objs:
+            if self.suffix and not o.key.endswith(self.suffix):
+                continue
+            if self._etags.get(o.key) == o.etag:
+                continue
+            self._etags[o.key] = o.etag
+            if self.ordered and (self._checkpoint is None or o.key > self._checkpoint):
+                self._checkpoint = o.key
+            out.append(o)
+        return out
+
+    def forget(self, key: str):
+        """处理失败时调用，下一轮（ordered 模式下为下一次全量核对）changes() 会再次产出该 key。"""
+        self._etags.pop(key, None)
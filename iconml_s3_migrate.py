@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+S3 key 布局迁移工具（平铺 <-> hash 分区，或调整分区级数）
+
+对每个前缀列举全部 key，目标 key = partition_key(prefix, basename, levels)；
+与当前 key 不同的对象并发 copy 到目标位置，源对象攒批 delete_objects。
+按窗口提交（每次最多 MIGRATE_WINDOW 个，约一页列举结果），等这一窗完成再提交下一窗，
+百万级前缀也不会同时挂着百万个 Future。
+幂等：重复执行只会处理尚未迁移的 key。建议先停 watcher 或在低峰期执行，先 --dry-run 看数量。
+
+用法：
+  python iconml_s3_migrate.py --bucket mr-iconml-dev --levels 2 --dry-run
+  python iconml_s3_migrate.py --bucket mr-iconml-dev --levels 2
+  python iconml_s3_migrate.py --bucket mr-iconml-dev --levels 0      # 回滚为平铺
+"""
+
+import sys
+import time
+import logging
+import argparse
+from typing import List
+
+from iconml_layout import PARTITION_LEVELS, partition_key
+from iconml_s3 import TransferEngine, list_objects_parallel
+
+DEFAULT_BUCKET   = "mr-iconml-dev"
+MIGRATE_WINDOW   = 1000          # 每窗提交的 copy 数（与 list_objects_v2 一页相同）
+DEFAULT_PREFIXES = [
+    "iconml/request/",
+    "iconml/images/",
+    "iconml/inforesults/",
+    "iconml/imageresults/",
+    "iconml/processed/",
+]
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+
+def migrate_prefix(engine: TransferEngine, bucket: str, prefix: str, levels: int,
+                   dry_run: bool, keep_source: bool) -> int:
+    t0 = time.time()
+    # 当前可能是任意布局：已分区的用并发列举，平铺的子分区为空时等价于普通列举
+    objs = list_objects_parallel(engine.s3, bucket, prefix)
+    moves = []
+    for o in objs:
+        name = o.key.rsplit("/", 1)[-1]
+        dst = partition_key(prefix, name, levels)
+        if dst != o.key:
+            moves.append((o.key, dst))
+    logging.info(f"[MIGRATE] {prefix}: {len(objs)} key(s), {len(moves)} to move ({time.time() - t0:.1f}s listing)")
+    if dry_run or not moves:
+        for src, dst in moves[:10]:
+            logging.info(f"  {src} -> {dst}")
+        return len(moves)
+
+    def _move(pair):
+        src, dst = pair
+        engine.copy(bucket, src, dst)
+        if not keep_source:
+            engine.delete_later(bucket, src)
+        return True
+
+    ok = 0
+    for w in range(0, len(moves), MIGRATE_WINDOW):
+        for f in engine.map(_move, moves[w:w + MIGRATE_WINDOW]):
+            try:
+                ok += bool(f.result())
+            except Exception as e:
+                logging.error(f"[MIGRATE] copy failed: {e}")
+    engine.flush_deletes(bucket)
+    logging.info(f"[MIGRATE] {prefix}: moved {ok}/{len(moves)} in {time.time() - t0:.1f}s")
+    return ok
+
+
+def build_parser():
+    p = argparse.ArgumentParser(description="Migrate IconML S3 keys between flat and hash-partitioned layouts")
+    p.add_argument("--bucket", default=DEFAULT_BUCKET)
+    p.add_argument("--prefix", action="append", default=None,
+                   help="Prefix to migrate (repeatable; default: request/images/inforesults/imageresults/processed)")
+    p.add_argument("--levels", type=int, default=PARTITION_LEVELS, help="Target partition levels (0 = flat)")
+    p.add_argument("--dry-run", action="store_true", help="Only count and show sample moves")
+    p.add_argument("--keep-source", action="store_true", help="Copy only, do not delete source keys")
+    return p
+
+
+def main(argv: List[str] = None):
+    args = build_parser().parse_args(argv)
+    engine = TransferEngine()
+    total = 0
+    try:
+        for prefix in args.prefix or DEFAULT_PREFIXES:
+            if not prefix.endswith("/"):
+                prefix += "/"
+            total += migrate_prefix(engine, args.bucket, prefix, args.levels, args.dry_run, args.keep_source)
+    finally:
+        engine.shutdown()
+    logging.info(f"[MIGRATE] {'would move' if args.dry_run else 'moved'} {total} key(s) total")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
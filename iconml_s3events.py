@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+S3 事件通知驱动的摄取（可选）
+
+bucket 为 iconml/request/、iconml/requestbyhash/、iconml/addsamples/ 配置 ObjectCreated 通知，
+投递到 SQS（或 SNS -> SQS）。S3EventRouter 长轮询队列，按前缀把新对象分发给各 watcher；
+KeySource 把“事件”与“定期全量核对列举”合并成同一个新对象来源，漏掉的事件由核对兜底。
+
+未配置 ICONML_SQS_QUEUE_URL 时，KeySource 退化为每轮增量列举（即原有行为）。
+本地测试：ElasticMQ 或 moto server，设置 ICONML_SQS_ENDPOINT_URL 即可。
+"""
+
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from datetime import datetime
+from urllib.parse import unquote_plus
+from typing import List, Optional, Tuple
+
+import boto3
+from botocore.exceptions import ClientError
+
+from iconml_s3 import ListingCache, S3Object
+
+SQS_QUEUE_URL       = os.environ.get("ICONML_SQS_QUEUE_URL", "")
+SQS_ENDPOINT_URL    = os.environ.get("ICONML_SQS_ENDPOINT_URL") or None
+SQS_WAIT_SECONDS    = 20          # 长轮询
+SQS_MAX_MESSAGES    = 10
+RECONCILE_INTERVAL  = 300.0       # 事件模式下全量核对列举的间隔（秒）
+
+
+def _parse_event_time(s: str) -> float:
+    try:
+        return datetime.strptime(s.replace("Z", "+0000"), "%Y-%m-%dT%H:%M:%S.%f%z").timestamp()
+    except (ValueError, AttributeError):
+        return time.time()
+
+
+def parse_s3_event_message(body: str) -> List[Tuple[str, S3Object]]:
+    """
+    解析一条 SQS 消息体，返回 [(bucket, S3Object)]，只保留 ObjectCreated。
+    兼容 S3 直投、SNS 信封、以及 s3:TestEvent。
+    """
+    try:
+        doc = json.loads(body)
+    except ValueError:
+        return []
+    if isinstance(doc, dict) and "Message" in doc and "Records" not in doc:
+        try:
+            doc = json.loads(doc["Message"])
+        except (ValueError, TypeError):
+            return []
+    out: List[Tuple[str, S3Object]] = []
+    for r in (doc.get("Records") or []) if isinstance(doc, dict) else []:
+        if not str(r.get("eventName", "")).startswith("ObjectCreated"):
+            continue
+        s3 = r.get("s3") or {}
+        bucket = (s3.get("bucket") or {}).get("name", "")
+        obj = s3.get("object") or {}
+        key = unquote_plus(obj.get("key", ""))
+        if not key or key.endswith("/"):
+            continue
+        out.append((bucket, S3Object(key, str(obj.get("eTag", "")).strip('"'),
+                                     _parse_event_time(r.get("eventTime", "")), int(obj.get("size", 0)))))
+    return out
+
+
+class S3EventRouter(threading.Thread):
+    """长轮询 SQS，按前缀把 ObjectCreated 事件分发到订阅者队列。"""
+    def __init__(self, queue_url: str, bucket: str, client=None):
+        super().__init__(daemon=True)
+        self.queue_url = queue_url
+        self.bucket = bucket
+        self.sqs = client or boto3.client("sqs", endpoint_url=SQS_ENDPOINT_URL)
+        self._subs: List[Tuple[str, str, "queue.Queue[S3Object]", threading.Event]] = []
+
+    def subscribe(self, prefix: str, suffix: str = "") -> Tuple["queue.Queue[S3Object]", threading.Event]:
+        q: "queue.Queue[S3Object]" = queue.Queue()
+        ev = threading.Event()
+        self._subs.append((prefix, suffix, q, ev))
+        return q, ev
+
+    def _route(self, bucket: str, obj: S3Object) -> bool:
+        if bucket and bucket != self.bucket:
+            return False
+        hit = False
+        for prefix, suffix, q, ev in self._subs:
+            if obj.key.startswith(prefix) and obj.key.endswith(suffix):
+                q.put(obj)
+                ev.set()
+                hit = True
+        return hit
+
+    def run(self):
+        logging.info(f"=== S3EventRouter started ({self.queue_url}) ===")
+        while True:
+            try:
+                resp = self.sqs.receive_message(
+                    QueueUrl=self.queue_url,
+                    MaxNumberOfMessages=SQS_MAX_MESSAGES,
+                    WaitTimeSeconds=SQS_WAIT_SECONDS,
+                )
+                msgs = resp.get("Messages", [])
+                if not msgs:
+                    continue
+                for m in msgs:
+                    for bucket, obj in parse_s3_event_message(m.get("Body", "")):
+                        self._route(bucket, obj)
+                # 已分发到内存队列即确认；即便进程随后退出，核对列举也会补上
+                entries = [{"Id": str(i), "ReceiptHandle": m["ReceiptHandle"]} for i, m in enumerate(msgs)]
+                self.sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            except ClientError as e:
+                logging.error(f"[SQS] receive/delete error: {e}")
+                time.sleep(5.0)
+            except Exception as e:
+                logging.exception(f"[SQS] loop error: {e}")
+                time.sleep(5.0)
+
+
+class KeySource:
+    """
+    某个前缀的新对象来源。
+      - router 为空：每次 poll() 做一次增量列举；
+      - router 非空：poll() 取出已到达的事件，且每 reconcile_interval 秒做一次增量列举兜底。
+    事件与列举共用 ListingCache 的 ETag 记录去重，同一对象不会被产出两次。
+    """
+    def __init__(self, listing: ListingCache, router: Optional[S3EventRouter] = None,
+                 reconcile_interval: float = RECONCILE_INTERVAL):
+        self.listing = listing
+        self.router = router
+        self.reconcile_interval = reconcile_interval
+        self._last_reconcile = 0.0
+        self._q: Optional["queue.Queue[S3Object]"] = None
+        self._ev: Optional[threading.Event] = None
+        if router is not None:
+            self._q, self._ev = router.subscribe(listing.prefix, listing.suffix)
+
+    @property
+    def event_driven(self) -> bool:
+        return self._q is not None
+
+    def poll(self) -> List[S3Object]:
+        if self._q is None:
+            return self.listing.changes()
+        out: List[S3Object] = []
+        self._ev.clear()
+        while True:
+            try:
+                out.append(self._q.get_nowait())
+            except queue.Empty:
+                break
+        out = self.listing.accept(out)
+        if time.time() - self._last_reconcile >= self.reconcile_interval:
+            self._last_reconcile = time.time()
+            seen = {o.key for o in out}
+            out.extend(o for o in self.listing.changes() if o.key not in seen)
+        return out
+
+    @property
+    def wake_event(self) -> Optional[threading.Event]:
+        """事件模式下新事件到达时被 set（poll() 时清除），供调度器提前唤醒；轮询模式为 None。"""
+        return self._ev
+
+    def forget(self, key: str):
+        self.listing.forget(key)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+watcher 循环的统一调度器（自适应退避）
+
+原先每个 run() 循环固定 sleep POLL_LOCAL_INTERVAL + POLL_S3_INTERVAL，不论有没有活。
+这里每项扫描注册为一个 Job，各自独立节奏：
+  - fn() 返回本次处理的工作量；>0 时间隔立即回到 min_interval（有活来就跑快）；
+  - 返回 0 时间隔乘以 backoff，直到 max_interval（空闲时指数退避，夜间几乎不发 list 请求）；
+  - 固定节奏的杂务（攒批删除、清单镜像）令 min_interval == max_interval 即可；
+  - 给定 wake 事件（如 S3 事件通知到达）时，等待会被提前唤醒，on_wake 的 Job 立即到期。
+"""
+
+import time
+import logging
+import threading
+from typing import Callable, List, Optional
+
+
+class Job:
+    def __init__(self, name: str, fn: Callable[[], Optional[int]],
+                 min_interval: float, max_interval: float,
+                 backoff: float = 2.0, on_wake: bool = False):
+        self.name = name
+        self.fn = fn
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = max(1.0, backoff)
+        self.on_wake = on_wake
+        self.interval = min_interval
+        self.next_due = 0.0          # 启动后立即执行一次
+
+    def reset(self, now: float):
+        self.interval = self.min_interval
+        self.next_due = now
+
+    def __repr__(self):
+        return f"Job({self.name}, every {self.interval:.2f}s)"
+
+
+class Scheduler:
+    def __init__(self, tag: str, wake: Optional[threading.Event] = None):
+        self.tag = tag
+        self.wake = wake
+        self.jobs: List[Job] = []
+
+    def add(self, name: str, fn: Callable[[], Optional[int]],
+            min_interval: float, max_interval: Optional[float] = None,
+            backoff: float = 2.0, on_wake: bool = False) -> Job:
+        job = Job(name, fn, min_interval, min_interval if max_interval is None else max_interval,
+                  backoff=backoff, on_wake=on_wake)
+        self.jobs.append(job)
+        return job
+
+    def nudge(self, name: Optional[str] = None):
+        """让指定（或全部 on_wake）Job 立即到期。"""
+        now = time.time()
+        for j in self.jobs:
+            if j.name == name or (name is None and j.on_wake):
+                j.reset(now)
+
+    def run_due(self) -> float:
+        """执行所有到期的 Job，返回距下一个 Job 到期的秒数。"""
+        for j in self.jobs:
+            if time.time() < j.next_due:
+                continue
+            try:
+                n = j.fn() or 0
+            except Exception as e:
+                logging.exception(f"{self.tag} {j.name} error: {e}")
+                n = 0
+            if n > 0:
+                j.interval = j.min_interval
+            else:
+                j.interval = min(j.max_interval, j.interval * j.backoff)
+            j.next_due = time.time() + j.interval
+        if not self.jobs:
+            return 1.0
+        return max(0.0, min(j.next_due for j in self.jobs) - time.time())
+
+    def run_forever(self):
+        while True:
+            delay = self.run_due()
+            if delay <= 0:
+                continue
+            if self.wake is None:
+                time.sleep(delay)
+            elif self.wake.wait(delay):
+                # 先清除再执行：执行期间到达的新事件会再次唤醒
+                self.wake.clear()
+                self.nudge()
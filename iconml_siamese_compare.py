@@ -1,12 +1,17 @@
 import os
+import logging
 import time
-import shutil
 import random
 import numpy as np
 import tensorflow as tf
 import json  # NEW
 import re
-from typing import Optional, Pattern
+import hashlib
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Pattern
 
 
 
@@ -15,6 +20,14 @@ from typing import Optional, Pattern
 # 假定存在：build_siamese_model(input_shape) -> Keras model，输入为 [img1, img2]，输出为相似度（0~1）
 from LoadImageLevelSiamese import e_load_image as load_img
 from siamese import build_siamese_model  # 如果你的函数在别处，请改成正确的导入
+from iconml_decode import DECODER, decode_image, decode_into, read_file
+from iconml_filters import MetadataIndex, filter_key, normalize_filter
+from iconml_fsevents import DirWatcher
+from iconml_handoff import atomic_move, atomic_write_bytes, atomic_write_json, atomic_write_text, commit_temp, temp_target
+from iconml_infer import BACKENDS, INFER_BACKEND, configure_threads, make_backend, parity_check
+from iconml_ipc import SOCK_PATH, MatchIPCServer
+from iconml_result_cache import (ResultCache, library_generation, make_context,
+                                 sha256_bytes, weights_fingerprint)
 
 IMAGE_SIZE = 32  # 固定输入尺寸；你的 e_load_image 内部也会用到这个
 BASE_DIR = "./images"
@@ -28,6 +41,46 @@ SIM_THRESHOLD = 0.996        # 打印相似的阈值
 POLL_INTERVAL = 1.0        # 轮询间隔秒
 RESULTS_DIR = "./imageresults"  # NEW
 IMAGE_EXTS = {".png", ".jpg", ".webp", ".PNG", ".JPG", ".WEBP"}
+# 基准库常驻精度：uint8 每张 3KB（float32 为 12KB），打分时按批反量化；"float32" 恢复旧行为
+LIBRARY_DTYPE = os.environ.get("ICONML_LIBRARY_DTYPE", "uint8")
+PRELOAD_WORKERS = 8        # 基准库并行解码线程数
+PRELOAD_CHUNK = 4096       # 每次提交给线程池的图片数（避免百万级 Future 同时存在）
+LIBRARY_DEDUPE = True      # 像素完全相同的基准图只保留一份张量、只打分一次，结果再扇出到每个路径
+# 近重复聚类（iconml_cluster_library.py 离线生成）：先只打分各簇代表，代表得分 > CLUSTER_GATE 才展开该簇。
+# 簇文件与当前库版本不一致时自动忽略，退回全库扫描。
+# 近似检索可能漏检，默认关闭；开启（ICONML_CLUSTER_SEARCH=1 或 --cluster-search）前先跑
+#   python iconml_siamese_compare.py recall-check --clusters
+# 确认召回。
+CLUSTER_FILE = "./state/library_clusters.json"
+CLUSTER_SEARCH = os.environ.get("ICONML_CLUSTER_SEARCH", "0") == "1"
+CLUSTER_GATE = float(os.environ.get("ICONML_CLUSTER_GATE", "0.95"))
+# 元数据过滤：request 的 filter 字段经 ./uploadfilters/<icon>.filter.json 旁路文件（或 IPC 元数据）传入，
+# 只对满足条件的基准图打分（见 iconml_filters）。旁路文件不放在 UPLOAD_DIR，扫描端只认 IMAGE_EXTS。
+METADATA_FILTERS = True
+FILTER_DIR = "./uploadfilters"
+FILTER_SIDECAR_SUFFIX = ".filter.json"
+# 就绪文件：加载进度 / ready / stopped，外部探活与编排用（tmp + rename 写入）
+READY_FILE = "./state/matcher_ready.json"
+IPC_ENABLED = True         # 同时接受提取端经 Unix socket 直连提交（iconml_ipc），目录监控保留为兜底
+IPC_SOCK_PATH = SOCK_PATH
+
+# 结果缓存：键 = (icon sha256, 基准库版本, 权重指纹, 阈值)，见 iconml_result_cache
+RESULT_CACHE_ENABLED = True
+RESULT_CACHE_PATH = "./state/image_result_cache.db"
+RESULT_CACHE_MAX = 200000
+
+# 离线批量匹配（bulk 模式）
+BULK_TOP_K = 10
+BULK_QUERY_TILE = 256      # 每个 tile 的查询数（同时解码、同时打分）
+BULK_LIB_TILE = 65536      # 每个 tile 的基准库行数；得分矩阵上限 QUERY_TILE×LIB_TILE 个 float32
+BULK_DECODE_WORKERS = 8
+
+# 库内近邻查询（neighbours 模式 / match_server GET /neighbours）：直接用内存里的库张量作查询
+NEIGHBOUR_TOP_K = 10
+NEIGHBOUR_OVERFETCH = 4    # 每个查询张量多取的候选倍数（同包多图、重复张量会占掉名额）
+
+# 模型调用串行化：目录监控主循环与 IPC 连接线程共用同一个模型
+_model_lock = threading.Lock()
 
 def _safe_read_text(path: str) -> str:
     try:
@@ -148,32 +201,32 @@ def parse_info_file(package: str, icon_filename: str) -> dict:
 def ensure_results_dir():
     ensure_dir(RESULTS_DIR)
 
-def save_results_json(upload_path: str,
-                      base_paths: list,
-                      scores: np.ndarray,
-                      threshold: float,
-                      pairs_sorted: list):
+def package_of_path(base_path: str) -> str:
+    """基准图 ./images/<package>_<N>.png -> <package>"""
+    return os.path.basename(base_path).split("_")[0]
+
+def build_results_payload(upload_name: str,
+                          base_paths: list,
+                          pairs_sorted: list,
+                          candidates: Optional[int] = None,
+                          filt: Optional[dict] = None) -> dict:
     """
-    保存 JSON 结果：
+    结果 JSON 的内容（不落盘）：
       - 若有匹配：仅输出最高分 best_match，并从 ./info/<package>.txt 解析字段并合并
-      - 若无匹配：best_match = None（也落盘）
-      - 文件：./imageresults/<upload_basename>.json
+      - 若无匹配：best_match = None
+      - 带过滤条件时 total_candidates 为实际参与打分的候选数，并回显 filter
+    save_results_json 与 iconml_match_server 共用，保证两条路径输出一致。
     """
-    ensure_results_dir()
-    up_base = os.path.basename(upload_path)
-    name_no_ext, _ = os.path.splitext(up_base)
-    out_path = os.path.join(RESULTS_DIR, f"{name_no_ext}.json")
+    up_base = os.path.basename(upload_name)
 
     best_match = None
     if pairs_sorted:
         # 已按分数降序
         i, s = pairs_sorted[0]
-        base_name = os.path.basename(base_paths[i])
-        pkg_name = base_name.split("_")[0]
+        pkg_name = package_of_path(base_paths[i])
 
         # 解析 ./info/<package>.txt —— APK 哈希来自 "[+] Analyzing APK" 行
-        icon_filename = os.path.basename(upload_path)
-        info_fields = parse_info_file(pkg_name, icon_filename)
+        info_fields = parse_info_file(pkg_name, up_base)
 
         best_match = {
             "package": pkg_name,
@@ -187,18 +240,41 @@ def save_results_json(upload_path: str,
 
     payload = {
         "upload_filename": up_base,
-        "total_candidates": int(len(base_paths)),
+        "total_candidates": int(len(base_paths) if candidates is None else candidates),
         "best_match": best_match,
         "timestamp": int(time.time())
     }
+    if filt:
+        payload["filter"] = filt
+    return payload
 
-    with open(out_path, "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False, indent=2)
+def save_results_json(upload_path: str,
+                      base_paths: list,
+                      scores: np.ndarray,
+                      threshold: float,
+                      pairs_sorted: list,
+                      candidates: Optional[int] = None,
+                      filt: Optional[dict] = None):
+    """
+    保存 JSON 结果（内容见 build_results_payload；无匹配时也落盘）
+      - 文件：./imageresults/<upload_basename>.json
+    """
+    ensure_results_dir()
+    name_no_ext, _ = os.path.splitext(os.path.basename(upload_path))
+    out_path = os.path.join(RESULTS_DIR, f"{name_no_ext}.json")
+
+    payload = build_results_payload(upload_path, base_paths, pairs_sorted, candidates, filt)
+
+    # tmp + rename：watcher 只会看到完整的结果文件
+    atomic_write_json(out_path, payload)
 
     print(f"[RESULT] JSON saved -> {out_path}")
+    return payload
 
 # ========= GPU 设置 =========
 def setup_gpu():
+    # 线程池设置必须先于任何 TF 算子执行
+    configure_threads()
     try:
         gpus = tf.config.list_physical_devices('GPU')
         if gpus:
@@ -227,32 +303,30 @@ def list_all_images(dir_path: str):
                 files.append(fp)
     return files
 
-def stable_new_files(upload_dir: str, known_set: set):
+def load_image_bytes(data: bytes, name: str, decoder: str = DECODER) -> np.ndarray:
     """
-    扫描 upload_dir，返回尚未处理过的“稳定”新文件列表。
-    通过短暂等待确认文件大小未变化，避免读到半写入的文件。
+    e_load_image 只接受路径：写入临时文件（保留扩展名）后解码，返回 (32,32,3) float32。
+    供不经过 ./uploadimages 的入口（IPC、HTTP 服务）使用。numpy 解码器直接解字节，不落临时文件。
     """
-    cand = []
-    for root, _, fs in os.walk(upload_dir):
-        for f in fs:
-            fp = os.path.join(root, f)
-            if not is_image_file(fp):
-                continue
-            if fp in known_set:
-                continue
-            cand.append(fp)
-
-    stable = []
-    for p in cand:
+    if decoder == "numpy":
+        return decode_image(data, IMAGE_SIZE)
+    _, ext = os.path.splitext(name)
+    fd, tmp = tempfile.mkstemp(suffix=ext or ".png", prefix="iconml_match_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return load_img(tmp).numpy()[0]
+    finally:
         try:
-            s1 = os.path.getsize(p)
-            time.sleep(0.2)
-            s2 = os.path.getsize(p)
-            if s1 == s2 and s1 > 0:
-                stable.append(p)
-        except FileNotFoundError:
+            os.remove(tmp)
+        except OSError:
             pass
-    return stable
+
+def load_image_path(path: str, data: Optional[bytes] = None, decoder: str = DECODER) -> np.ndarray:
+    """按 DECODER 解码单张图片 -> (32,32,3) float32 [0,1]；data 为已读出的文件内容（可省一次读盘）。"""
+    if decoder == "numpy":
+        return decode_image(data if data is not None else read_file(path), IMAGE_SIZE)
+    return load_img(path).numpy()[0]
 
 def move_to_done(src_path: str, done_dir: str = DONE_DIR):
     ensure_dir(done_dir)
@@ -262,46 +336,321 @@ def move_to_done(src_path: str, done_dir: str = DONE_DIR):
         name, ext = os.path.splitext(base)
         ts = int(time.time())
         dst = os.path.join(done_dir, f"{name}_{ts}{ext}")
-    shutil.move(src_path, dst)
+    atomic_move(src_path, dst)
     return dst
 
 
+# ========= 库量化 =========
+def quantize_image(arr: np.ndarray) -> np.ndarray:
+    """[0,1] float -> uint8（四舍五入，误差 <= 1/510）。"""
+    return np.clip(np.rint(arr * 255.0), 0, 255).astype(np.uint8)
+
+def as_float_batch(batch: np.ndarray) -> np.ndarray:
+    """模型输入前的反量化；float 批原样返回。只作用于当前批切片，全库不会整体展开。"""
+    if batch.dtype == np.uint8:
+        return batch.astype(np.float32) * np.float32(1.0 / 255.0)
+    return batch
+
+
 # ========= 预加载与模型 =========
-def preload_base_images(base_dir: str):
+def compact_rows(arr: np.ndarray, keep: np.ndarray, chunk: int = PRELOAD_CHUNK) -> int:
+    """
+    把 keep 为 True 的行按原顺序前移到 arr 开头（原地），返回保留行数；调用方取 arr[:n]。
+    按连续段、每次最多 chunk 行搬运：目标总在源之前，临时内存只与 chunk 相关，不会整库复制。
     """
-    预加载 ./images/ 下所有图片为 (N, 32, 32, 3) 的 float32 数组。
-    与 e_load_image 对齐：其返回 (1,32,32,3) 的 tf.float32，这里取 [0] 去掉 batch 维。
+    idx = np.flatnonzero(keep)
+    if idx.size == 0:
+        return 0
+    # 连续段 [starts[j], ends[j])
+    brk = np.flatnonzero(np.diff(idx) != 1) + 1
+    starts = idx[np.r_[0, brk]]
+    ends = idx[np.r_[brk - 1, idx.size - 1]] + 1
+    w = 0
+    for s, e in zip(starts.tolist(), ends.tolist()):
+        if s == w:
+            w = e
+            continue
+        for c in range(s, e, chunk):
+            m = min(chunk, e - c)
+            arr[w:w + m] = arr[c:c + m]
+            w += m
+    return w
+
+def preload_base_images(base_dir: str, dtype: str = LIBRARY_DTYPE,
+                        workers: int = PRELOAD_WORKERS, progress=None, decoder: str = DECODER):
     """
+    预加载 ./images/ 下所有图片为 (N, 32, 32, 3) 的数组（dtype 为 uint8 或 float32）。
+    与 e_load_image 对齐：其返回 (1,32,32,3) 的 tf.float32，这里取 [0] 去掉 batch 维；
+    线程池并行解码，直接写入预分配数组的对应行（uint8 时逐张量化），失败的行最后原地压缩掉。
+    decoder="numpy" 时每个分块经 iconml_decode.decode_into 解码、按尺寸分组批量缩放后写入同一切片。
+    progress(loaded, total) 在每个分块完成后回调。
+    """
+    quantize = dtype == "uint8"
     paths = list_all_images(base_dir)
-    ok_paths = []
-    imgs = []
+    n = len(paths)
+    print(f"[LOAD] Start preloading {n} images from '{base_dir}' ({workers} workers, decoder={decoder}) ...")
+    if n == 0:
+        print("[LOAD] Done. Valid images: 0")
+        return [], np.empty((0,), dtype=np.float32)
 
-    print(f"[LOAD] Start preloading {len(paths)} images from '{base_dir}' ...")
-    for i, p in enumerate(paths, 1):
+    out = np.empty((n, IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.uint8 if quantize else np.float32)
+    ok = np.zeros((n,), dtype=bool)
+
+    def _load(i: int):
         try:
-            t = load_img(p)        # tf.Tensor, (1,32,32,3), float32, [0,1]
-            arr = t.numpy()[0]     # (32,32,3)
-            imgs.append(arr)
-            ok_paths.append(p)
+            arr = load_img(paths[i]).numpy()[0]     # (32,32,3) float32 [0,1]
+            out[i] = quantize_image(arr) if quantize else arr
+            ok[i] = True
         except Exception as e:
-            print(f"[WARN] Failed to load '{p}': {e}")
-
-        if i % 500 == 0:
-            print(f"[LOAD] Preloaded {i}/{len(paths)}")
-
+            print(f"[WARN] Failed to load '{paths[i]}': {e}")
+
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="preload") as pool:
+        for start in range(0, n, PRELOAD_CHUNK):
+            end = min(start + PRELOAD_CHUNK, n)
+            if decoder == "numpy":
+                ok[start:end] = decode_into(out[start:end], paths[start:end], pool,
+                                            finish=quantize_image if quantize else None)
+            else:
+                list(pool.map(_load, range(start, end)))
+            print(f"[LOAD] Preloaded {end}/{n}  ({end / max(time.time() - t0, 1e-6):.0f} img/s)")
+            if progress is not None:
+                progress(end, n)
+
+    if not ok.all():
+        out = out[:compact_rows(out, ok)]
+    ok_paths = [p for p, good in zip(paths, ok) if good]
     if not ok_paths:
         print("[LOAD] Done. Valid images: 0")
         return [], np.empty((0,), dtype=np.float32)
+    print(f"[LOAD] Done. Valid images: {len(ok_paths)}  Shape={out.shape}  "
+          f"dtype={out.dtype}  {out.nbytes / 1048576:.1f}MB  in {time.time() - t0:.1f}s")
+    return ok_paths, out
+
+
+class BaseLibrary:
+    """
+    去重后的基准库：
+      paths    : 全部基准图路径（原顺序，长度 N；结果 JSON 与缓存里的下标都指向它）
+      imgs     : 唯一像素张量 (U,H,W,C)，每组取原下标最小的一张作代表
+      inverse  : (N,) 原第 i 张 -> 所属唯一张量下标
+      members  : 第 u 个唯一张量对应的全部原下标（升序）
+    打分只在 imgs 上进行，expand() 把 (…,U) 得分扇出为 (…,N)：同组得分相同，
+    matched_pairs 的稳定排序让平分时下标最小者在前，与未去重时的 best_match 完全一致。
+    """
+    def __init__(self, paths: list, imgs: np.ndarray, dedupe: bool = LIBRARY_DEDUPE):
+        self.paths = paths
+        self.clusters: Optional["ClusterIndex"] = None
+        self.meta: Optional[MetadataIndex] = None
+        self._by_package: Optional[dict] = None
+        self._by_path: Optional[dict] = None
+        n = len(paths)
+        if not dedupe or n == 0:
+            self.imgs = imgs
+            self.inverse = np.arange(n, dtype=np.int64)
+            self.members = [np.array([i], dtype=np.int64) for i in range(n)]
+            return
+        t0 = time.time()
+        first: dict = {}
+        inverse = np.empty((n,), dtype=np.int64)
+        reps = []
+        for i in range(n):
+            key = hashlib.blake2b(imgs[i].tobytes(), digest_size=16).digest()
+            u = first.get(key)
+            if u is None:
+                u = first[key] = len(reps)
+                reps.append(i)
+            inverse[i] = u
+        self.inverse = inverse
+        self.imgs = imgs if len(reps) == n else imgs[np.asarray(reps, dtype=np.int64)]
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.cumsum(np.bincount(inverse, minlength=len(reps)))[:-1]
+        self.members = np.split(order, bounds)
+        print(f"[LOAD] Dedupe: {n} base images -> {len(reps)} unique tensors "
+              f"({n - len(reps)} duplicates, {time.time() - t0:.1f}s)")
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    @property
+    def unique_count(self) -> int:
+        return int(self.imgs.shape[0])
+
+    def expand(self, scores: np.ndarray) -> np.ndarray:
+        """(…,U) -> (…,N)"""
+        return scores[..., self.inverse]
+
+    def expand_topk(self, top_s: np.ndarray, top_i: np.ndarray, k: int):
+        """按唯一张量排好序的 top-K 扇出为原下标的 top-K（同组成员依次展开，截断到 k）。"""
+        out_s, out_i = [], []
+        for s, u in zip(top_s, top_i):
+            for i in self.members[u]:
+                if len(out_i) >= k:
+                    break
+                out_s.append(s)
+                out_i.append(int(i))
+            if len(out_i) >= k:
+                break
+        return np.asarray(out_s, dtype=np.float32), np.asarray(out_i, dtype=np.int64)
+
+    def rows_for(self, item: str) -> np.ndarray:
+        """库内条目 -> 原下标：完整路径、文件名或包名（包名对应该包全部图标）。找不到返回空数组。"""
+        if self._by_package is None:
+            by_pkg: dict = {}
+            by_path: dict = {}
+            for i, p in enumerate(self.paths):
+                by_pkg.setdefault(package_of_path(p), []).append(i)
+                by_path.setdefault(p, i)
+                by_path.setdefault(os.path.normpath(p), i)
+                by_path.setdefault(os.path.basename(p), i)
+            self._by_path = by_path
+            self._by_package = {k: np.asarray(v, dtype=np.int64) for k, v in by_pkg.items()}
+        i = self._by_path.get(item, self._by_path.get(os.path.normpath(item)))
+        if i is not None:
+            return np.array([i], dtype=np.int64)
+        return self._by_package.get(item, np.empty((0,), dtype=np.int64))
+
+
+class ClusterIndex:
+    """
+    簇索引（唯一张量层面）：reps[c] 为第 c 个簇的代表，groups[c] 为其余成员。
+    score() 先对全部代表打分（单簇也作为自身代表，因此第一轮覆盖所有孤立点），
+    只有代表得分 > gate 的簇才继续给成员打分；未展开的成员记 0 分（低于任何阈值）。
+    簇由离线任务按“成员与代表直接相似”构造，gate 低于匹配阈值以留余量，
+    但这仍是近似检索：与代表差异较大的成员可能漏检，需要精确结果时关闭 CLUSTER_SEARCH。
+    """
+    def __init__(self, lib: "BaseLibrary", reps: np.ndarray, groups: List[np.ndarray], gate: float = CLUSTER_GATE):
+        self.reps = reps
+        self.groups = groups
+        self.gate = gate
+        self.expanded = 0          # 累计展开的簇数（观察用）
+
+    @classmethod
+    def load(cls, path: str, lib: "BaseLibrary", generation: str, gate: float = CLUSTER_GATE):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("generation") != generation:
+            print(f"[CLUSTER] {path} is for another library generation; using full scan")
+            return None
+        pos = {lib.paths[int(m[0])]: u for u, m in enumerate(lib.members)}   # 代表路径 -> 唯一下标
+        reps, groups, seen = [], [], set()
+        for c in data.get("clusters", []):
+            r = pos.get(c["rep"])
+            ms = [pos[p] for p in c.get("members", []) if p in pos]
+            if r is None or r in seen:
+                continue
+            ms = [m for m in ms if m not in seen and m != r]
+            seen.add(r)
+            seen.update(ms)
+            reps.append(r)
+            groups.append(np.asarray(ms, dtype=np.int64))
+        # 簇文件之后才出现的唯一张量（理论上不会，generation 已校验）作为单点簇
+        for u in range(lib.unique_count):
+            if u not in seen:
+                reps.append(u)
+                groups.append(np.empty((0,), dtype=np.int64))
+        idx = cls(lib, np.asarray(reps, dtype=np.int64), groups, gate)
+        print(f"[CLUSTER] {len(reps)} clusters over {lib.unique_count} unique tensors "
+              f"({sum(len(g) for g in groups)} expandable members), gate={gate}")
+        return idx
+
+    def score(self, model, uimg: np.ndarray, lib: "BaseLibrary") -> np.ndarray:
+        out = np.zeros((lib.unique_count,), dtype=np.float32)
+        # 代表几乎覆盖全部唯一张量，按批从库里取，不常驻一份副本
+        rs = np.empty((len(self.reps),), dtype=np.float32)
+        for s in range(0, len(self.reps), BATCH_SIZE):
+            e = min(s + BATCH_SIZE, len(self.reps))
+            rs[s:e] = predict_similarity_pairs(model, uimg, lib.imgs[self.reps[s:e]], batch_size=BATCH_SIZE)
+        out[self.reps] = rs
+        hit = [c for c in np.where(rs > self.gate)[0] if len(self.groups[c])]
+        if hit:
+            mem = np.concatenate([self.groups[c] for c in hit])
+            out[mem] = predict_similarity_pairs(model, uimg, lib.imgs[mem], batch_size=BATCH_SIZE)
+            self.expanded += len(hit)
+        return out
+
+
+class ReadyStatus:
+    """
+    启动进度与就绪状态，写入 READY_FILE（JSON）：
+      {"state": "loading"|"ready"|"failed"|"stopped", "pid", "started_at",
+       "library": {"loaded", "total"}, "model": "loading"|"ready"|"failed", "ready_at", "startup_secs"}
+    加载期间的进度更新按 min_interval 节流；状态切换立即写。path 为空时只在内存中维护（HTTP /health 用）。
+    """
+    def __init__(self, path: Optional[str] = READY_FILE, min_interval: float = 1.0):
+        self.path = path
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._last = 0.0
+        self.state = {
+            "state": "loading",
+            "pid": os.getpid(),
+            "started_at": round(time.time(), 3),
+            "library": {"loaded": 0, "total": 0},
+            "model": "loading",
+        }
+        self._write()
+
+    def _write(self):
+        self._last = time.time()
+        if self.path:
+            try:
+                atomic_write_json(self.path, self.state)
+            except OSError as e:
+                print(f"[WARN] ready file write failed: {e}")
+
+    def update(self, force: bool = False, **fields):
+        with self._lock:
+            self.state.update(fields)
+            if force or time.time() - self._last >= self.min_interval:
+                self._write()
+
+    def library_progress(self, loaded: int, total: int):
+        self.update(library={"loaded": loaded, "total": total}, force=loaded >= total)
 
-    base_imgs = np.stack(imgs, axis=0).astype(np.float32)  # (N,32,32,3)
-    print(f"[LOAD] Done. Valid images: {len(ok_paths)}  Shape={base_imgs.shape}")
-    return ok_paths, base_imgs
+    def ready(self, **fields):
+        now = time.time()
+        self.update(force=True, state="ready", ready_at=round(now, 3),
+                    startup_secs=round(now - self.state["started_at"], 3), **fields)
 
+    @property
+    def is_ready(self) -> bool:
+        return self.state["state"] == "ready"
 
-def build_and_load_model(example_image_shape):
+    def snapshot(self) -> dict:
+        with self._lock:
+            return json.loads(json.dumps(self.state))
+
+
+def load_matcher(status: Optional[ReadyStatus] = None, backend: str = INFER_BACKEND):
+    """
+    并行启动：模型构建/加载权重/预热在后台线程进行，同时主线程并行解码基准库。
+    输入 shape 固定为 (IMAGE_SIZE, IMAGE_SIZE, 3)，无需等库加载出第一张图。
+    返回 (BaseLibrary, model)。
+    """
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="model") as ex:
+        fut = ex.submit(build_and_load_model, (IMAGE_SIZE, IMAGE_SIZE, 3), backend)
+        if status is not None:
+            fut.add_done_callback(
+                lambda f: status.update(force=True, model="ready" if f.exception() is None else "failed"))
+        base_paths, base_imgs = preload_base_images(
+            BASE_DIR, progress=status.library_progress if status is not None else None)
+        lib = BaseLibrary(base_paths, base_imgs)
+        del base_imgs
+        model = fut.result()
+    print(f"[LOAD] Library and model ready in {time.time() - t0:.1f}s")
+    return lib, model
+
+
+def build_and_load_model(example_image_shape, backend: str = INFER_BACKEND):
     """
     根据样例图像 shape 构建 Siamese 模型并加载权重。
     example_image_shape 应为 (H,W,C) = (32,32,3)。
+    backend 非 keras 时返回 iconml_infer 包装后的固定签名后端（调用方式相同）。
     """
     if len(example_image_shape) != 3:
         raise ValueError(f"Unexpected example_image_shape: {example_image_shape}")
@@ -322,7 +671,7 @@ def build_and_load_model(example_image_shape):
     dummy2 = np.zeros((1, h, w, c), dtype=np.float32)
     _ = model([dummy1, dummy2], training=False)
     print("[MODEL] Warmup done.")
-    return model
+    return make_backend(model, backend, BATCH_SIZE, (h, w, c))
 
 
 # ========= 推理与输出 =========
@@ -341,7 +690,7 @@ def predict_similarity_pairs(model, upload_img: np.ndarray, base_imgs: np.ndarra
         bsz = end - start
 
         left = np.repeat(upload_img[np.newaxis, ...], bsz, axis=0)   # (bsz,H,W,C)
-        right = base_imgs[start:end]                                 # (bsz,H,W,C)
+        right = as_float_batch(base_imgs[start:end])                 # (bsz,H,W,C)
 
         t0 = time.time()
         out = model([left, right], training=False)
@@ -355,6 +704,121 @@ def predict_similarity_pairs(model, upload_img: np.ndarray, base_imgs: np.ndarra
     return scores
 
 
+def predict_similarity_multi(model, upload_imgs: np.ndarray, base_imgs: np.ndarray, batch_size: int = BATCH_SIZE):
+    """
+    多张上传图 upload_imgs (Q,H,W,C) 同时与 base_imgs (N,H,W,C) 全量比对，返回 scores: (Q,N)。
+    把 Q×N 个配对展平后按 batch_size 切块喂入模型：
+    多个查询合并后每次 model 调用都是满批，最后一块之外不会出现小批。
+    """
+    Q = upload_imgs.shape[0]
+    N = base_imgs.shape[0]
+    total = Q * N
+    scores = np.empty((total,), dtype=np.float32)
+
+    t0 = time.time()
+    start = 0
+    while start < total:
+        end = min(start + batch_size, total)
+        flat = np.arange(start, end)
+        left = upload_imgs[flat // N]      # (bsz,H,W,C)
+        right = as_float_batch(base_imgs[flat % N])   # (bsz,H,W,C)
+        out = model([left, right], training=False)
+        scores[start:end] = np.array(out).reshape(-1)
+        start = end
+    print(f"[INFER] Compared {Q} quer{'y' if Q == 1 else 'ies'} x {N} in {time.time() - t0:.4f}s")
+
+    return scores.reshape(Q, N)
+
+
+def matched_pairs(scores: np.ndarray, threshold: float = SIM_THRESHOLD) -> list:
+    """返回全部命中(>threshold)的 [(index, score)]，按分数降序。"""
+    idx = np.where(scores > threshold)[0]
+    pairs = [(int(i), float(scores[i])) for i in idx]
+    pairs.sort(key=lambda x: x[1], reverse=True)
+    return pairs
+
+
+def score_image(model, uimg: np.ndarray, lib: BaseLibrary, threshold: float = SIM_THRESHOLD,
+                rows: Optional[np.ndarray] = None) -> list:
+    """
+    单张图对唯一张量打分、扇出到全库后返回命中列表；模型调用在 _model_lock 内串行。
+    rows 给定时（元数据过滤）只对这些行涉及的唯一张量打分，其余行记 0 分——
+    与子集外某行像素相同也不会被报出。
+    """
+    if rows is not None:
+        full = np.zeros((len(lib),), dtype=np.float32)
+        if rows.size:
+            uniq, pos = np.unique(lib.inverse[rows], return_inverse=True)
+            with _model_lock:
+                su = predict_similarity_pairs(model, uimg, lib.imgs[uniq], batch_size=BATCH_SIZE)
+            full[rows] = su[pos]
+        return matched_pairs(full, threshold)
+    with _model_lock:
+        if lib.clusters is not None:
+            scores = lib.clusters.score(model, uimg, lib)
+        else:
+            scores = predict_similarity_pairs(model, uimg, lib.imgs, batch_size=BATCH_SIZE)
+    return matched_pairs(lib.expand(scores), threshold)
+
+
+def resolve_filter(lib: BaseLibrary, raw) -> tuple:
+    """request/sidecar 里的 filter -> (规整后的条件或 None, 行号或 None)。"""
+    filt = normalize_filter(raw)
+    if filt is None or lib.meta is None:
+        return None, None
+    return filt, lib.meta.select(filt)
+
+
+def read_filter_sidecar(upload_path: str):
+    """./uploadfilters/<icon>.filter.json（watcher 按 request 的 filter 字段写入）；读后删除。"""
+    side = os.path.join(FILTER_DIR, os.path.basename(upload_path) + FILTER_SIDECAR_SUFFIX)
+    try:
+        with open(side, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"[WARN] bad filter sidecar '{side}': {e}")
+        raw = None
+    try:
+        os.remove(side)
+    except OSError:
+        pass
+    return raw
+
+
+def library_tag(paths: list) -> str:
+    """基准库版本 + 常驻精度 + 解码器：结果缓存与簇文件都以此判断是否对应当前库。"""
+    tag = f"{library_generation(paths)}-{LIBRARY_DTYPE}"
+    return tag if DECODER == "tf" else f"{tag}-{DECODER}"
+
+
+def cached_match(cache: Optional[ResultCache], sha: str, compute) -> list:
+    """有缓存时按内容哈希查/合并计算；否则直接计算。"""
+    if cache is None:
+        return compute()
+    pairs, cached = cache.get_or_compute(sha, compute)
+    if cached:
+        print(f"[CACHE] hit {sha[:12]}… ({cache.stats()})")
+    return pairs
+
+
+def open_result_cache(base_paths: list, cluster_gate: Optional[float] = None) -> Optional[ResultCache]:
+    if not RESULT_CACHE_ENABLED:
+        return None
+    # 簇检索是近似结果，与全库扫描（及其他 gate）的缓存分开
+    lib_ctx = library_tag(base_paths) + (f"-cluster{cluster_gate}" if cluster_gate is not None else "")
+    ctx = make_context(lib_ctx,
+                       f"{weights_fingerprint(WEIGHTS_PATH)}-{INFER_BACKEND}", SIM_THRESHOLD)
+    try:
+        cache = ResultCache(RESULT_CACHE_PATH, ctx, RESULT_CACHE_MAX)
+    except Exception as e:
+        print(f"[WARN] result cache disabled: {e}")
+        return None
+    print(f"[CACHE] context={ctx} {cache.stats()}")
+    return cache
+
+
 def print_matches(upload_path: str, base_paths: list, scores: np.ndarray,
                   threshold: float = SIM_THRESHOLD, max_show: Optional[int] = None):
     """
@@ -362,22 +826,23 @@ def print_matches(upload_path: str, base_paths: list, scores: np.ndarray,
     - 生成的 JSON 中的 matched 列表包含所有命中(>threshold)的条目（不受 max_show 限制）
     - 控制台打印可用 max_show 截断展示
     """
-    idx = np.where(scores > threshold)[0]
+    report_matches(upload_path, base_paths, matched_pairs(scores, threshold), threshold, max_show)
 
-    # 构建“全部命中”的有序列表（用于 JSON）
-    if idx.size == 0:
-        all_pairs_sorted = []  # for JSON
+
+def report_matches(upload_path: str, base_paths: list, all_pairs_sorted: list,
+                   threshold: float = SIM_THRESHOLD, max_show: Optional[int] = None,
+                   rows: Optional[np.ndarray] = None, filt: Optional[dict] = None):
+    """同 print_matches，但直接接收已排序的命中列表（来自缓存或 score_image）。"""
+    if not all_pairs_sorted:
         print(f"[RESULT] {os.path.basename(upload_path)}: No matches > {threshold}")
-    else:
-        all_pairs_sorted = [(int(i), float(scores[i])) for i in idx]
-        all_pairs_sorted.sort(key=lambda x: x[1], reverse=True)
 
     # --- 保存 JSON（包括空命中时也会写出空列表） ---
-    save_results_json(upload_path, base_paths, scores, threshold, all_pairs_sorted)
+    payload = save_results_json(upload_path, base_paths, None, threshold, all_pairs_sorted,
+                                candidates=None if rows is None else int(rows.size), filt=filt)
 
     # --- 控制台打印（可选择性截断） ---
     if not all_pairs_sorted:
-        return
+        return payload
 
     pairs_to_show = all_pairs_sorted
     if max_show is not None:
@@ -386,67 +851,577 @@ def print_matches(upload_path: str, base_paths: list, scores: np.ndarray,
     print(f"[RESULT] {os.path.basename(upload_path)} matches (>{threshold}):")
     for i, s in pairs_to_show:
         print(f"  - {base_paths[i]}   score={s:.4f}")
+    return payload
+
+
+def make_ipc_handler(model, lib: BaseLibrary, cache: Optional[ResultCache] = None):
+    """
+    IPC 请求处理：解码 -> 打分（经结果缓存）-> 写 ./imageresults（与目录路径一致）-> 返回 payload。
+    icon 原件直接落到 ./doneimages，与目录路径处理后的归档位置相同。
+    """
+    def handle(name: str, data: bytes, meta: dict) -> dict:
+        name = os.path.basename(name)
+        if not is_image_file(name):
+            raise ValueError(f"unsupported image type: {name}")
+        uimg = load_image_bytes(data, name)
+        dst = os.path.join(DONE_DIR, name)
+        if not os.path.exists(dst):
+            atomic_write_bytes(dst, data)
+        filt, rows = resolve_filter(lib, meta.get("filter"))
+        n = len(lib) if rows is None else rows.size
+        print(f"[IPC ] Start comparing: {name}  vs  {n} base images{' (filtered)' if filt else ''} ...")
+        pairs = cached_match(cache, sha256_bytes(data) + filter_key(filt),
+                             lambda: score_image(model, uimg, lib, rows=rows))
+        return report_matches(name, lib.paths, pairs, threshold=SIM_THRESHOLD, rows=rows, filt=filt)
+    return handle
+
+
+# ========= 离线批量匹配 =========
+def read_query_list(src: str) -> List[str]:
+    """目录（递归，全部图片）或清单文件（每行一个路径，# 注释；相对路径相对于清单所在目录）。"""
+    if os.path.isdir(src):
+        return sorted(list_all_images(src))
+    root = os.path.dirname(os.path.abspath(src))
+    out = []
+    with open(src, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            p = line.strip()
+            if not p or p.startswith("#"):
+                continue
+            out.append(p if os.path.isabs(p) else os.path.join(root, p))
+    return out
+
+
+def _decode_query(path: str):
+    try:
+        return load_image_path(path)
+    except Exception as e:
+        print(f"[WARN] Failed to load query '{path}': {e}")
+        return None
+
+
+def topk_merge(best_s: np.ndarray, best_i: np.ndarray, scores: np.ndarray, offset: int, k: int):
+    """把一个库 tile 的得分 (Q,L) 并入当前 top-K (Q,K)；argpartition 选出新 top-K（未排序）。"""
+    cat_s = np.concatenate([best_s, scores], axis=1)
+    cat_i = np.concatenate([best_i, np.broadcast_to(
+        np.arange(offset, offset + scores.shape[1], dtype=np.int64), scores.shape)], axis=1)
+    k = min(k, cat_s.shape[1])
+    part = np.argpartition(-cat_s, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(cat_s, part, axis=1), np.take_along_axis(cat_i, part, axis=1)
+
+
+def score_tile_topk(model, qimgs: np.ndarray, base_imgs: np.ndarray, k: int, lib_tile: int):
+    """查询 tile × 全库，分库 tile 打分并维护每个查询的 top-K；返回按分数降序的 (scores, indices)。"""
+    Q = qimgs.shape[0]
+    best_s = np.empty((Q, 0), dtype=np.float32)
+    best_i = np.empty((Q, 0), dtype=np.int64)
+    for l0 in range(0, base_imgs.shape[0], lib_tile):
+        S = predict_similarity_multi(model, qimgs, base_imgs[l0:l0 + lib_tile], batch_size=BATCH_SIZE)
+        best_s, best_i = topk_merge(best_s, best_i, S, l0, k)
+    order = np.argsort(-best_s, axis=1, kind="stable")
+    return np.take_along_axis(best_s, order, axis=1), np.take_along_axis(best_i, order, axis=1)
+
+
+def _bulk_row(query: str, base_paths: list, top_s: np.ndarray, top_i: np.ndarray, threshold: float) -> dict:
+    hits = [(int(i), float(s)) for i, s in zip(top_i, top_s) if s > threshold]
+    best = build_results_payload(query, base_paths, hits)["best_match"] or {}
+    row = {
+        "query": query,
+        "upload_filename": os.path.basename(query),
+        "top_index": [int(i) for i in top_i],
+        "top_path": [base_paths[i] for i in top_i],
+        "top_score": [round(float(s), 6) for s in top_s],
+    }
+    for k in ("package", "packagename", "devid", "label", "permissions", "hash"):
+        row[f"best_{k}"] = best.get(k)
+    row["best_score"] = best.get("score")
+    return row
+
+
+class _BulkWriter:
+    """JSONL 或 Parquet（按扩展名，Parquet 需要 pyarrow）；写到临时名，完成后原子提交。"""
+    def __init__(self, out_path: str):
+        self.out_path = out_path
+        self.tmp = temp_target(out_path)
+        self.parquet = out_path.lower().endswith(".parquet")
+        self.rows = 0
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self._pa = pa
+            self._schema = pa.schema(
+                [("query", pa.string()), ("upload_filename", pa.string()),
+                 ("top_index", pa.list_(pa.int64())), ("top_path", pa.list_(pa.string())),
+                 ("top_score", pa.list_(pa.float32()))] +
+                [(f"best_{k}", pa.string()) for k in ("package", "packagename", "devid", "label", "permissions", "hash")] +
+                [("best_score", pa.float64())])
+            self._w = pq.ParquetWriter(self.tmp, self._schema)
+        else:
+            self._f = open(self.tmp, "w", encoding="utf-8")
+
+    def write(self, rows: List[dict]):
+        if not rows:
+            return
+        if self.parquet:
+            self._w.write_table(self._pa.Table.from_pylist(rows, schema=self._schema))
+        else:
+            for r in rows:
+                self._f.write(json.dumps(r, ensure_ascii=False) + "\n")
+        self.rows += len(rows)
+
+    def commit(self):
+        if self.parquet:
+            self._w.close()
+        else:
+            self._f.close()
+        commit_temp(self.tmp, self.out_path)
+
+
+def bulk_match(model, lib: BaseLibrary, query_paths: List[str], out_path: str,
+               top_k: int = BULK_TOP_K, query_tile: int = BULK_QUERY_TILE, lib_tile: int = BULK_LIB_TILE,
+               workers: int = BULK_DECODE_WORKERS, threshold: float = SIM_THRESHOLD) -> int:
+    """
+    离线批量匹配：查询按 tile 并行解码（下一个 tile 的解码与当前 tile 的打分重叠），
+    每个 tile 与全库（唯一张量）分块打分，逐查询只保留 top-K，再扇出到原下标。返回写出的行数。
+    """
+    total = len(query_paths)
+    writer = _BulkWriter(out_path)
+    tiles = [query_paths[i:i + query_tile] for i in range(0, total, query_tile)]
+    failed = 0
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = [pool.submit(_decode_query, p) for p in tiles[0]] if tiles else []
+        for n, tile in enumerate(tiles):
+            imgs = [f.result() for f in pending]
+            pending = [pool.submit(_decode_query, p) for p in tiles[n + 1]] if n + 1 < len(tiles) else []
+            ok = [(p, im) for p, im in zip(tile, imgs) if im is not None]
+            failed += len(tile) - len(ok)
+            if not ok:
+                continue
+            top_s, top_i = score_tile_topk(model, np.stack([im for _, im in ok], axis=0), lib.imgs, top_k, lib_tile)
+            rows = []
+            for q, (p, _) in enumerate(ok):
+                s_q, i_q = lib.expand_topk(top_s[q], top_i[q], top_k)
+                rows.append(_bulk_row(p, lib.paths, s_q, i_q, threshold))
+            writer.write(rows)
+            done = sum(len(t) for t in tiles[:n + 1])
+            el = time.time() - t0
+            print(f"[BULK] {done}/{total} queries  {done / el:.1f} q/s  elapsed={el:.1f}s")
+    writer.commit()
+    el = time.time() - t0
+    print(f"[BULK] Done: {writer.rows} row(s), {failed} failed to load, "
+          f"{total / el if el > 0 else 0.0:.1f} q/s over {len(lib)} base images -> {out_path}")
+    return writer.rows
+
+
+def run_bulk(args):
+    setup_gpu()
+    query_paths = read_query_list(args.queries)
+    if not query_paths:
+        print(f"[FATAL] No query images in '{args.queries}'. Exit.")
+        return
+    lib, model = load_matcher()
+    if len(lib) == 0:
+        print("[FATAL] No valid images found in ./images . Exit.")
+        return
+    print(f"[BULK] {len(query_paths)} queries x {len(lib)} base images ({lib.unique_count} unique), top-{args.top_k}")
+    bulk_match(model, lib, query_paths, args.out, top_k=args.top_k,
+               query_tile=args.query_tile, lib_tile=args.lib_tile, workers=args.workers,
+               threshold=args.threshold)
+
+
+def recall_check(model, base_paths: list, lib_ref: np.ndarray, lib_q: np.ndarray,
+                 queries: List[np.ndarray], threshold: float = SIM_THRESHOLD) -> dict:
+    """
+    量化库 lib_q 相对参考库 lib_ref（float32）的召回：
+      recall  = 两者都命中(>threshold)的 (query, base) 对 / 参考库命中对
+      top1    = 最高分下标一致的查询比例
+      max_abs = 全部得分的最大绝对差
+    """
+    ref_hits = both = top1 = 0
+    max_abs = 0.0
+    for uimg in queries:
+        s_ref = predict_similarity_pairs(model, uimg, lib_ref)
+        s_q = predict_similarity_pairs(model, uimg, lib_q)
+        h_ref = s_ref > threshold
+        ref_hits += int(h_ref.sum())
+        both += int((h_ref & (s_q > threshold)).sum())
+        top1 += int(np.argmax(s_ref) == np.argmax(s_q))
+        max_abs = max(max_abs, float(np.abs(s_ref - s_q).max()))
+    n = max(1, len(queries))
+    return {
+        "queries": len(queries),
+        "ref_hits": ref_hits,
+        "recall": both / ref_hits if ref_hits else 1.0,
+        "top1_agreement": top1 / n,
+        "max_abs_score_diff": max_abs,
+    }
+
+
+# ========= 库内近邻查询 =========
+def library_neighbours(model, lib: BaseLibrary, items: List[str], top_k: int = NEIGHBOUR_TOP_K,
+                       same_package: bool = False, query_tile: int = BULK_QUERY_TILE,
+                       lib_tile: int = BULK_LIB_TILE) -> List[dict]:
+    """
+    “哪些包的图标和包 X 相似”：items 为包名或基准图路径，查询张量直接取 lib.imgs（不重新解码）。
+    全部条目涉及的唯一张量合并后按 query_tile 批量打分（score_tile_topk），再按包聚合：
+    每个邻居包只保留其最高分的一张图，默认排除查询自身所在的包（same_package=True 时只排除自身图片）。
+    每个条目返回一个 dict；找不到的条目带 error 字段。
+    """
+    resolved = [(item, lib.rows_for(item)) for item in items]
+    own_unique = [np.unique(lib.inverse[rows]) for _, rows in resolved]
+    if not any(u.size for u in own_unique):
+        return [{"query": item, "error": "not found in library"} for item, _ in resolved]
+    query_u = np.unique(np.concatenate(own_unique))
+    kc = min(lib.unique_count, top_k * NEIGHBOUR_OVERFETCH + max(len(u) for u in own_unique))
+
+    t0 = time.time()
+    top: dict = {}
+    for q0 in range(0, query_u.size, query_tile):
+        tile = query_u[q0:q0 + query_tile]
+        top_s, top_i = score_tile_topk(model, as_float_batch(lib.imgs[tile]), lib.imgs, kc, lib_tile)
+        for u, s_u, i_u in zip(tile, top_s, top_i):
+            top[int(u)] = (s_u, i_u)
+    print(f"[NEIGH] {len(items)} item(s) -> {query_u.size} query tensor(s) vs {lib.unique_count} unique "
+          f"in {time.time() - t0:.2f}s")
+
+    out = []
+    for (item, rows), uniq in zip(resolved, own_unique):
+        if not rows.size:
+            out.append({"query": item, "error": "not found in library"})
+            continue
+        own_pkgs = {package_of_path(lib.paths[r]) for r in rows}
+        own_rows = set(int(r) for r in rows)
+        best: dict = {}                                   # 邻居包 -> (score, 原下标)
+        for u in uniq:
+            s_u, i_u = top[int(u)]
+            s_r, i_r = lib.expand_topk(s_u, i_u, len(lib))
+            for s, i in zip(s_r, i_r):
+                pkg = package_of_path(lib.paths[i])
+                if int(i) in own_rows or (not same_package and pkg in own_pkgs):
+                    continue
+                if pkg not in best or s > best[pkg][0]:
+                    best[pkg] = (float(s), int(i))
+        ranked = sorted(best.items(), key=lambda kv: (-kv[1][0], kv[1][1]))[:top_k]
+        out.append({
+            "query": item,
+            "packages": sorted(own_pkgs),
+            "query_images": [lib.paths[r] for r in rows],
+            "neighbours": [{"package": pkg, "path": lib.paths[i], "score": round(s, 6)}
+                           for pkg, (s, i) in ranked],
+        })
+    return out
+
+
+def run_neighbours(args):
+    items = list(args.items)
+    if args.from_file:
+        with open(args.from_file, "r", encoding="utf-8", errors="replace") as f:
+            items += [ln.strip() for ln in f if ln.strip() and not ln.lstrip().startswith("#")]
+    if not items:
+        print("[FATAL] No packages or base paths given. Exit.")
+        return
+    setup_gpu()
+    lib, model = load_matcher()
+    if len(lib) == 0:
+        print("[FATAL] No valid images found in ./images . Exit.")
+        return
+    rows = library_neighbours(model, lib, items, top_k=args.top_k, same_package=args.same_package,
+                              lib_tile=args.lib_tile)
+    text = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in rows)
+    if args.out == "-":
+        print(text, end="")
+    else:
+        atomic_write_text(args.out, text)
+        print(f"[NEIGH] {len(rows)} row(s) -> {args.out}")
+
+
+def cluster_recall_check(model, lib: BaseLibrary, clusters: ClusterIndex, queries: List[np.ndarray],
+                         threshold: float = SIM_THRESHOLD) -> dict:
+    """
+    簇检索（代表过 gate 才展开）相对全库扫描的召回：
+      recall  = 簇检索也命中的 (query, base) 对 / 全库扫描命中对
+      top1    = best_match 一致的查询比例
+      missed  = 漏检对数
+    """
+    ref_hits = both = top1 = 0
+    for uimg in queries:
+        full = lib.expand(predict_similarity_pairs(model, uimg, lib.imgs))
+        approx = lib.expand(clusters.score(model, uimg, lib))
+        h_ref = full > threshold
+        ref_hits += int(h_ref.sum())
+        both += int((h_ref & (approx > threshold)).sum())
+        p_ref, p_apx = matched_pairs(full, threshold), matched_pairs(approx, threshold)
+        top1 += int((p_ref[0][0] if p_ref else None) == (p_apx[0][0] if p_apx else None))
+    n = max(1, len(queries))
+    return {
+        "queries": len(queries),
+        "ref_hits": ref_hits,
+        "missed": ref_hits - both,
+        "recall": both / ref_hits if ref_hits else 1.0,
+        "top1_agreement": top1 / n,
+        "gate": clusters.gate,
+    }
+
+
+def run_cluster_recall_check(args):
+    setup_gpu()
+    lib, model = load_matcher()
+    if len(lib) == 0:
+        print("[FATAL] No valid images found in ./images . Exit.")
+        return
+    clusters = ClusterIndex.load(CLUSTER_FILE, lib, library_tag(lib.paths), gate=args.cluster_gate)
+    if clusters is None:
+        print(f"[FATAL] No usable cluster file at {CLUSTER_FILE} (run iconml_cluster_library.py). Exit.")
+        raise SystemExit(1)
+    if args.queries:
+        queries = [q for q in (_decode_query(p) for p in read_query_list(args.queries)) if q is not None]
+    else:
+        # 默认从库里抽样（唯一张量）：簇成员作查询时最容易暴露漏检
+        idx = random.Random(args.seed).sample(range(lib.unique_count), min(args.samples, lib.unique_count))
+        queries = [as_float_batch(lib.imgs[i:i + 1])[0] for i in idx]
+    res = cluster_recall_check(model, lib, clusters, queries, args.threshold)
+    print(f"[RECALL] cluster search vs full scan over {len(lib)} base images: " + json.dumps(res))
+
+
+def run_recall_check(args):
+    if args.clusters:
+        run_cluster_recall_check(args)
+        return
+    setup_gpu()
+    base_paths, lib_ref = preload_base_images(BASE_DIR, dtype="float32")
+    if lib_ref.shape[0] == 0:
+        print("[FATAL] No valid images found in ./images . Exit.")
+        return
+    lib_q = np.stack([quantize_image(x) for x in lib_ref], axis=0)
+    model = build_and_load_model(lib_ref[0].shape)
+    if args.queries:
+        queries = [q for q in (_decode_query(p) for p in read_query_list(args.queries)) if q is not None]
+    else:
+        # 默认从库里抽样：每个查询至少命中自身
+        idx = random.Random(args.seed).sample(range(len(base_paths)), min(args.samples, len(base_paths)))
+        queries = [lib_ref[i] for i in idx]
+    res = recall_check(model, base_paths, lib_ref, lib_q, queries, args.threshold)
+    print(f"[RECALL] uint8 vs float32 over {len(base_paths)} base images: " + json.dumps(res))
+    print(f"[RECALL] memory float32={lib_ref.nbytes / 1048576:.1f}MB uint8={lib_q.nbytes / 1048576:.1f}MB")
+
+
+def run_parity_check(args):
+    setup_gpu()
+    base_paths, base_imgs = preload_base_images(BASE_DIR)
+    if base_imgs.shape[0] == 0:
+        print("[FATAL] No valid images found in ./images . Exit.")
+        return
+    shape = base_imgs[0].shape
+    ref = build_and_load_model(shape, backend="keras")
+    be = make_backend(ref, args.backend, BATCH_SIZE, shape)
+    idx = random.Random(args.seed).sample(range(len(base_paths)), min(args.samples, len(base_paths)))
+    queries = [as_float_batch(base_imgs[i:i + 1])[0] for i in idx]
+    res = parity_check(ref, be, base_imgs, queries, predict_similarity_pairs, args.threshold)
+    ok = res["max_abs"] <= args.tolerance and res["top1_agreement"] == 1.0
+    print(f"[PARITY] {args.backend} vs keras: {json.dumps(res)} -> {'OK' if ok else 'FAIL'}")
+    if not ok:
+        raise SystemExit(1)
+
+
+def run_decode_check(args):
+    """numpy 解码器与 e_load_image 的逐像素差异、速度，以及对匹配结果（召回）的影响。"""
+    setup_gpu()
+    paths = sorted(list_all_images(BASE_DIR))
+    if not paths:
+        print("[FATAL] No valid images found in ./images . Exit.")
+        return
+    paths = random.Random(args.seed).sample(paths, min(args.samples, len(paths)))
+    t0 = time.time()
+    ref = np.empty((len(paths), IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.float32)
+    ok_ref = np.zeros((len(paths),), dtype=bool)
+    for i, p in enumerate(paths):
+        try:
+            ref[i] = load_img(p).numpy()[0]
+            ok_ref[i] = True
+        except Exception as e:
+            print(f"[WARN] e_load_image failed on '{p}': {e}")
+    t1 = time.time()
+    fast = np.empty_like(ref)
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        ok_np = decode_into(fast, paths, pool)
+    t2 = time.time()
+    both = ok_ref & ok_np
+    ref, fast = ref[both], fast[both]
+    if not both.any():
+        print("[FATAL] No image decoded by both paths. Exit.")
+        raise SystemExit(1)
+    diff = np.abs(ref - fast)
+    res = {
+        "images": int(both.sum()),
+        "only_tf": int((ok_ref & ~ok_np).sum()),
+        "only_numpy": int((ok_np & ~ok_ref).sum()),
+        "max_abs": float(diff.max()),
+        "mean_abs": float(diff.mean()),
+        "p99_abs": float(np.percentile(diff, 99)),
+        "tf_img_per_s": round(len(paths) / max(t1 - t0, 1e-6), 1),
+        "numpy_img_per_s": round(len(paths) / max(t2 - t1, 1e-6), 1),
+    }
+    model = build_and_load_model(ref[0].shape)
+    nq = min(args.queries, ref.shape[0])
+    rec = recall_check(model, paths, ref, fast, [ref[i] for i in range(nq)], args.threshold)
+    res.update(recall=rec["recall"], top1_agreement=rec["top1_agreement"], max_abs_score_diff=rec["max_abs_score_diff"])
+    ok = res["max_abs"] <= args.tolerance and rec["recall"] == 1.0 and res["only_tf"] == 0
+    print(f"[DECODE] numpy vs e_load_image: {json.dumps(res)} -> {'OK' if ok else 'FAIL'}")
+    if not ok:
+        raise SystemExit(1)
+
+
+def build_parser():
+    ap = argparse.ArgumentParser(description="IconML Siamese matcher (watch ./uploadimages, or offline bulk matching)")
+    ap.add_argument("--cluster-search", action="store_true", default=CLUSTER_SEARCH,
+                    help="Watch/IPC: approximate search over CLUSTER_FILE (default off; check recall-check --clusters first)")
+    ap.add_argument("--cluster-gate", type=float, default=CLUSTER_GATE,
+                    help="Representative score above which a cluster is expanded")
+    sub = ap.add_subparsers(dest="mode")
+    sub.add_parser("watch", help="Watch ./uploadimages and serve IPC (default)")
+    b = sub.add_parser("bulk", help="Match a directory or manifest of query icons offline")
+    b.add_argument("--queries", required=True, help="Directory of icons, or a text manifest with one path per line")
+    b.add_argument("--out", required=True, help="Output file (.jsonl, or .parquet with pyarrow)")
+    b.add_argument("--top-k", type=int, default=BULK_TOP_K)
+    b.add_argument("--query-tile", type=int, default=BULK_QUERY_TILE)
+    b.add_argument("--lib-tile", type=int, default=BULK_LIB_TILE)
+    b.add_argument("--workers", type=int, default=BULK_DECODE_WORKERS, help="Parallel query decoders")
+    b.add_argument("--threshold", type=float, default=SIM_THRESHOLD, help="Threshold for best_* columns")
+    nb = sub.add_parser("neighbours", help="Top-K similar packages for library entries (no re-decoding)")
+    nb.add_argument("items", nargs="*", help="Package names or base image paths")
+    nb.add_argument("--from-file", default=None, help="Text file with one package/path per line")
+    nb.add_argument("--top-k", type=int, default=NEIGHBOUR_TOP_K, help="Neighbour packages per query")
+    nb.add_argument("--same-package", action="store_true", help="Also report other icons of the query's own package")
+    nb.add_argument("--lib-tile", type=int, default=BULK_LIB_TILE)
+    nb.add_argument("--out", default="-", help="JSONL output file ('-' for stdout)")
+    r = sub.add_parser("recall-check", help="Compare match results of the uint8 library against float32 "
+                                            "(or, with --clusters, cluster search against a full scan)")
+    r.add_argument("--queries", default=None, help="Query icons (directory or manifest); default: sample the library")
+    r.add_argument("--samples", type=int, default=200)
+    r.add_argument("--seed", type=int, default=0)
+    r.add_argument("--threshold", type=float, default=SIM_THRESHOLD)
+    r.add_argument("--clusters", action="store_true",
+                   help="Instead: recall of cluster-gated search (CLUSTER_FILE, --cluster-gate) against a full scan")
+    pc = sub.add_parser("parity-check", help="Compare an inference backend's scores against the Keras model")
+    pc.add_argument("--backend", default="graph", choices=BACKENDS)
+    pc.add_argument("--samples", type=int, default=50)
+    pc.add_argument("--seed", type=int, default=0)
+    pc.add_argument("--threshold", type=float, default=SIM_THRESHOLD)
+    pc.add_argument("--tolerance", type=float, default=1e-3, help="Max allowed absolute score difference")
+    dc = sub.add_parser("decode-check", help="Compare the NumPy decoder against e_load_image")
+    dc.add_argument("--samples", type=int, default=500, help="Library images to decode both ways")
+    dc.add_argument("--queries", type=int, default=50, help="Of those, how many to use as match queries")
+    dc.add_argument("--workers", type=int, default=PRELOAD_WORKERS)
+    dc.add_argument("--seed", type=int, default=0)
+    dc.add_argument("--threshold", type=float, default=SIM_THRESHOLD)
+    dc.add_argument("--tolerance", type=float, default=0.02, help="Max allowed absolute pixel difference")
+    return ap
 
 
 # ========= 主循环 =========
 def main():
+    args = build_parser().parse_args()
+    # 辅助模块（过滤索引、结果缓存、解码）走 logging，与本文件的 print 输出并列显示
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.mode == "bulk":
+        run_bulk(args)
+        return
+    if args.mode == "neighbours":
+        run_neighbours(args)
+        return
+    if args.mode == "recall-check":
+        run_recall_check(args)
+        return
+    if args.mode == "parity-check":
+        run_parity_check(args)
+        return
+    if args.mode == "decode-check":
+        run_decode_check(args)
+        return
+
     setup_gpu()
 
     ensure_dir(BASE_DIR)
     ensure_dir(UPLOAD_DIR)
+    ensure_dir(FILTER_DIR)
     ensure_dir(DONE_DIR)
 
-    # 1) 预加载基准库
-    base_paths, base_imgs = preload_base_images(BASE_DIR)
-    if base_imgs.shape[0] == 0:
+    # 1) 并行：预加载基准库 + 构建并加载模型（输入为 (32,32,3)）；进度写入就绪文件
+    status = ReadyStatus(READY_FILE)
+    try:
+        lib, model = load_matcher(status)
+    except Exception as e:
+        status.update(force=True, state="failed", error=str(e))
+        raise
+    if len(lib) == 0:
+        status.update(force=True, state="failed", error="no valid base images")
         print("[FATAL] No valid images found in ./images . Exit.")
         return
-
-    # 2) 构建并加载模型（输入为 (32,32,3)）
-    model = build_and_load_model(base_imgs[0].shape)
-
-    # 3) 循环监控 ./uploadimages
-    seen = set()
-    print(f"[WATCH] Start watching '{UPLOAD_DIR}' ... (poll interval {POLL_INTERVAL}s)")
+    if args.cluster_search:
+        lib.clusters = ClusterIndex.load(CLUSTER_FILE, lib, library_tag(lib.paths), gate=args.cluster_gate)
+        if lib.clusters is not None:
+            print(f"[CLUSTER] Approximate search ON (gate={args.cluster_gate}); "
+                  f"matches outside expanded clusters are not reported")
+    if METADATA_FILTERS:
+        lib.meta = MetadataIndex(lib.paths, package_of_path, lambda pkg: parse_info_file(pkg, ""),
+                                 workers=PRELOAD_WORKERS)
+    cache = open_result_cache(lib.paths, lib.clusters.gate if lib.clusters is not None else None)
+
+    # 3) 提取端直连通道（与目录监控并行；提取端连不上时自动退回写 ./uploadimages）
+    ipc = None
+    if IPC_ENABLED:
+        try:
+            ipc = MatchIPCServer(make_ipc_handler(model, lib, cache), IPC_SOCK_PATH)
+            ipc.start()
+            print(f"[IPC ] Listening on {IPC_SOCK_PATH}")
+        except OSError as e:
+            print(f"[WARN] IPC disabled: {e}")
+
+    # 4) 监控 ./uploadimages（inotify 事件，退化为轮询）
+    watcher = DirWatcher(UPLOAD_DIR, suffixes=IMAGE_EXTS, recursive=True, poll_interval=POLL_INTERVAL)
+    print(f"[WATCH] Start watching '{UPLOAD_DIR}' ... (mode={watcher.mode})")
+    status.ready(library_size=len(lib), unique=lib.unique_count, ipc=ipc is not None)
+    print(f"[READY] Serving after {status.state['startup_secs']:.1f}s -> {READY_FILE}")
     while True:
         try:
-            new_files = stable_new_files(UPLOAD_DIR, seen)
+            new_files = watcher.ready(timeout=POLL_INTERVAL)
             if new_files:
                 print(f"[WATCH] Detected {len(new_files)} new file(s).")
 
             for up in new_files:
-                seen.add(up)
-                # 加载上传图：e_load_image -> (1,32,32,3) tf.float32
+                if not os.path.exists(up):
+                    continue
+                # 加载上传图：e_load_image（或 numpy 解码器）-> (32,32,3) float32 [0,1]
                 try:
-                    t = load_img(up)
-                    uimg = t.numpy()[0]  # (32,32,3), float32, [0,1]
+                    data = read_file(up)
+                    sha = sha256_bytes(data)
+                    uimg = load_image_path(up, data)
                 except Exception as e:
                     print(f"[WARN] Failed to load upload '{up}': {e}")
                     dst = move_to_done(up)
                     print(f"[DONE] Moved '{up}' -> '{dst}'")
-                    seen.discard(up)            # <<< 关键：处理完移出 seen
                     continue
 
-                # 成功处理完
-                # ...
+                # 已解码到内存，先移走源文件（过滤条件旁路文件随之读取并删除）
+                filt, rows = resolve_filter(lib, read_filter_sidecar(up))
                 dst = move_to_done(up)
                 print(f"[DONE] Moved '{up}' -> '{dst}'")
-                seen.discard(up) 
 
                 # 推理对比（分批）
-                print(f"[INFER] Start comparing: {os.path.basename(up)}  vs  {len(base_paths)} base images ...")
-                scores = predict_similarity_pairs(model, uimg, base_imgs, batch_size=BATCH_SIZE)
+                if filt:
+                    print(f"[INFER] Start comparing: {os.path.basename(up)}  vs  {rows.size} filtered base images {filt}")
+                else:
+                    print(f"[INFER] Start comparing: {os.path.basename(up)}  vs  {len(lib)} base images ({lib.unique_count} unique) ...")
+                pairs = cached_match(cache, sha + filter_key(filt), lambda: score_image(model, uimg, lib, rows=rows))
 
                 # 打印匹配项
-                print_matches(up, base_paths, scores, threshold=SIM_THRESHOLD, max_show=None)
-                ensure_results_dir()
-                # 移动到 done
-                dst = move_to_done(up)
-                print(f"[DONE] Moved '{up}' -> '{dst}'")
-
-            time.sleep(POLL_INTERVAL)
+                report_matches(up, lib.paths, pairs, threshold=SIM_THRESHOLD, max_show=None, rows=rows, filt=filt)
         except KeyboardInterrupt:
             print("\n[EXIT] KeyboardInterrupt received. Bye.")
+            if ipc is not None:
+                ipc.close()
+            status.update(force=True, state="stopped")
             break
         except Exception as e:
             print(f"[ERROR] Loop error: {e}")
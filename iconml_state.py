@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+request 生命周期状态清单
+
+原先每个 request 靠 S3 上的 copy+delete 表达状态：request/ -> processing/ -> processed/，
+每个请求 4 次 S3 变更。这里改为：
+  - 本地 sqlite（WAL）记录每个 request 的状态与时间戳：received / processing / done / failed；
+  - 定期（仅在有变化时）把近期状态导出为一个 S3 对象（iconml/state/requests.json），
+    客户端一次 GET 即可查询任意 request 的状态；
+  - S3 上的移动变成可选的归档工作：done 的 request 按批 copy 到 processed/，源删除攒批提交。
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+RECEIVED   = "received"
+PROCESSING = "processing"
+DONE       = "done"
+FAILED     = "failed"
+STATES     = (RECEIVED, PROCESSING, DONE, FAILED)
+
+MANIFEST_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    name           TEXT PRIMARY KEY,
+    state          TEXT NOT NULL,
+    etag           TEXT,
+    icon_filename  TEXT,
+    s3_key         TEXT,
+    error          TEXT,
+    received_at    REAL,
+    processing_at  REAL,
+    image_done_at  REAL,
+    done_at        REAL,
+    failed_at      REAL,
+    updated_at     REAL NOT NULL,
+    archived       INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_requests_state ON requests(state, archived);
+CREATE INDEX IF NOT EXISTS idx_requests_updated ON requests(updated_at);
+"""
+
+_TS_COLUMN = {
+    RECEIVED: "received_at",
+    PROCESSING: "processing_at",
+    DONE: "done_at",
+    FAILED: "failed_at",
+}
+
+
+class RequestStateStore:
+    """
+    线程安全（单连接 + 锁）。name 为 request 文件名（<hash>.json）。
+    mark() 只在状态真正前进时写库；done/failed 之后同 ETag 的重复事件不会回退状态。
+    """
+    def __init__(self, db_path: str):
+        d = os.path.dirname(db_path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._dirty = True     # 启动后先镜像一次
+
+    # ---------------- 写 ----------------
+    def mark(self, name: str, state: str, **fields: Any):
+        """
+        记录状态迁移。fields 可含 etag / icon_filename / s3_key / error。
+        若给出的 etag 与库中不同（同名覆盖上传），视为新请求，从头开始。
+        """
+        if state not in STATES:
+            raise ValueError(f"unknown state: {state}")
+        now = time.time()
+        cols = {k: v for k, v in fields.items() if k in ("etag", "icon_filename", "s3_key", "error")}
+        with self._lock:
+            row = self._db.execute("SELECT state, etag FROM requests WHERE name=?", (name,)).fetchone()
+            if row is None or (cols.get("etag") and row["etag"] and cols["etag"] != row["etag"]):
+                cols.update({"name": name, "state": state, _TS_COLUMN[state]: now,
+                             "updated_at": now, "archived": 0})
+                if row is not None:
+                    self._db.execute("DELETE FROM requests WHERE name=?", (name,))
+                keys = ", ".join(cols)
+                self._db.execute(f"INSERT INTO requests ({keys}) VALUES ({', '.join('?' * len(cols))})",
+                                 tuple(cols.values()))
+            else:
+                if row["state"] == DONE and state != DONE:
+                    return
+                cols.update({"state": state, _TS_COLUMN[state]: now, "updated_at": now})
+                sets = ", ".join(f"{k}=?" for k in cols)
+                self._db.execute(f"UPDATE requests SET {sets} WHERE name=?", (*cols.values(), name))
+            self._dirty = True
+
+    def mark_image_done(self, name: str):
+        now = time.time()
+        with self._lock:
+            self._db.execute("UPDATE requests SET image_done_at=?, updated_at=? WHERE name=?", (now, now, name))
+            self._dirty = True
+
+    def mark_archived(self, names: Iterable[str]):
+        names = list(names)
+        if not names:
+            return
+        with self._lock:
+            self._db.executemany("UPDATE requests SET archived=1 WHERE name=?", [(n,) for n in names])
+
+    # ---------------- 读 ----------------
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM requests WHERE name=?", (name,)).fetchone()
+        return dict(row) if row else None
+
+    def is_settled(self, name: str, etag: str) -> bool:
+        """该 request（同一 ETag）是否已 done/failed，用于重启后跳过已处理的对象。"""
+        r = self.get(name)
+        return bool(r) and r["etag"] == etag and r["state"] in (DONE, FAILED)
+
+    def in_state(self, state: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM requests WHERE state=?", (state,)).fetchall()
+        return [dict(r) for r in rows]
+
+    def archive_candidates(self, limit: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT name, s3_key FROM requests WHERE state=? AND archived=0 ORDER BY done_at LIMIT ?",
+                (DONE, limit)).fetchall()
+        return [dict(r) for r in rows]
+
+    # ---------------- 清单镜像 ----------------
+    @property
+    def dirty(self) -> bool:
+        return self._dirty
+
+    def manifest(self, retention_sec: float) -> Dict[str, Any]:
+        """
+        紧凑清单：{"version", "generated_at", "requests": {<stem>: {...}}}。
+        只包含 retention_sec 内有更新的请求；未完成的请求总是包含。
+        """
+        since = time.time() - retention_sec
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM requests WHERE updated_at>=? OR state IN (?, ?)",
+                (since, RECEIVED, PROCESSING)).fetchall()
+            self._dirty = False
+        reqs: Dict[str, Dict[str, Any]] = {}
+        for r in rows:
+            ent: Dict[str, Any] = {"state": r["state"]}
+            for k in ("icon_filename", "error", "received_at", "processing_at",
+                      "image_done_at", "done_at", "failed_at"):
+                if r[k] is not None:
+                    ent[k] = round(r[k], 3) if isinstance(r[k], float) else r[k]
+            reqs[os.path.splitext(r["name"])[0]] = ent
+        return {"version": MANIFEST_VERSION, "generated_at": round(time.time(), 3), "requests": reqs}
+
+    def mirror_to_s3(self, s3, bucket: str, key: str, retention_sec: float) -> bool:
+        if not self._dirty:
+            return False
+        body = json.dumps(self.manifest(retention_sec), ensure_ascii=False, separators=(",", ":"))
+        try:
+            s3.put_object(Bucket=bucket, Key=key, Body=body.encode("utf-8"),
+                          ContentType="application/json", CacheControl="no-cache")
+        except Exception as e:
+            self._dirty = True
+            logging.error(f"[STATE] mirror manifest failed: {e}")
+            return False
+        return True
+
+    def close(self):
+        with self._lock:
+            self._db.close()
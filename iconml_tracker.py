@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+批次完成度追踪（反向索引）
+
+requestbyhash 的一个批次 = 一组 APK hash；每个 hash 完成的条件是：
+    inforesults/<hash>.json      已出现（或已归档到 bak）
+    imageresults/<icon_base>.json 已出现（或已归档到 bak）
+
+旧实现每轮对每个未完成 hash 做多次 exists()，并反复解析 request/<hash>.json。
+这里改为维护反向索引：
+    info hash  -> {batch}
+    icon base  -> {hash}
+request 元数据只解析一次并缓存；目录变化由 DirWatcher 事件增量喂入，
+每轮开销只与“新出现的结果文件数”成正比，与待完成总量无关。
+已经同步拿到的结果（如经 IPC 匹配）用 mark_image 直接记为完成，不等目录事件。
+"""
+
+import os
+import json
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from iconml_fsevents import DirWatcher
+
+
+def _icon_base(icon_filename: str) -> Optional[str]:
+    base, _ = os.path.splitext(os.path.basename(icon_filename or ""))
+    return base or None
+
+
+class CompletionTracker:
+    def __init__(self,
+                 info_dirs: Iterable[str],
+                 image_dirs: Iterable[str],
+                 request_dir: Optional[str] = None):
+        self.info_dirs = list(info_dirs)
+        self.image_dirs = list(image_dirs)
+        self.request_dir = request_dir
+
+        # 批次 -> 全部 hash / 未完成 hash
+        self.batches: Dict[str, Set[str]] = {}
+        self.remaining: Dict[str, Set[str]] = {}
+
+        # 反向索引
+        self._hash_batches: Dict[str, Set[str]] = {}   # hash -> {batch}
+        self._icon_hashes: Dict[str, Set[str]] = {}    # icon_base -> {hash}
+        self._hash_icon: Dict[str, Optional[str]] = {} # hash -> icon_base（request 元数据缓存）
+
+        # 只记录被追踪 hash / icon 的完成状态
+        self._info_done: Set[str] = set()
+        self._image_done: Set[str] = set()
+
+        # 已存在的文件由 add_batch 一次性探测，这里只订阅之后的变化
+        def _watch(d: str) -> DirWatcher:
+            return DirWatcher(d, suffixes=(".json",), emit_existing=False)
+        self._watchers: List[Tuple[str, DirWatcher]] = (
+            [("info", _watch(d)) for d in self.info_dirs] +
+            [("image", _watch(d)) for d in self.image_dirs] +
+            ([("request", _watch(request_dir))] if request_dir else [])
+        )
+
+    # ---------------- 批次管理 ----------------
+    def add_batch(self, name: str, hashes: Iterable[str],
+                  icons: Optional[Dict[str, str]] = None):
+        """
+        注册批次。icons: {hash: icon_filename}；未提供时从 request/<hash>.json 读取（只读一次）。
+        已存在的结果在这里一次性探测，之后只靠增量事件更新。
+        """
+        if name in self.batches:
+            self.drop_batch(name)
+        hs = set(hashes)
+        self.batches[name] = hs
+        self.remaining[name] = set(hs)
+
+        for h in hs:
+            self._hash_batches.setdefault(h, set()).add(name)
+            if h not in self._hash_icon:
+                if icons is not None:
+                    self._set_icon(h, _icon_base(icons.get(h, "")))
+                else:
+                    self._set_icon(h, self._icon_base_from_request(h))
+            if h not in self._info_done and self._exists_in(self.info_dirs, f"{h}.json"):
+                self._info_done.add(h)
+            base = self._hash_icon.get(h)
+            if base and base not in self._image_done and self._exists_in(self.image_dirs, f"{base}.json"):
+                self._image_done.add(base)
+
+        for h in hs:
+            if self._is_done(h):
+                self.remaining[name].discard(h)
+
+    def drop_batch(self, name: str):
+        hs = self.batches.pop(name, set())
+        self.remaining.pop(name, None)
+        for h in hs:
+            owners = self._hash_batches.get(h)
+            if owners is None:
+                continue
+            owners.discard(name)
+            if owners:
+                continue
+            self._hash_batches.pop(h, None)
+            self._info_done.discard(h)
+            base = self._hash_icon.pop(h, None)
+            if base:
+                peers = self._icon_hashes.get(base, set())
+                peers.discard(h)
+                if not peers:
+                    self._icon_hashes.pop(base, None)
+                    self._image_done.discard(base)
+
+    def progress(self, name: str) -> Tuple[List[str], List[str]]:
+        """返回 (done, pending)"""
+        hs = self.batches.get(name, set())
+        pend = self.remaining.get(name, set())
+        return [h for h in hs if h not in pend], list(pend)
+
+    def is_complete(self, name: str) -> bool:
+        return name in self.batches and not self.remaining.get(name)
+
+    def icon_of(self, h: str) -> Optional[str]:
+        """被追踪 hash 的 icon_base（来自缓存的 request 元数据）。"""
+        return self._hash_icon.get(h)
+
+    # ---------------- 增量事件 ----------------
+    def on_info(self, h: str) -> Set[str]:
+        if h not in self._hash_batches:
+            return set()
+        self._info_done.add(h)
+        return self._settle(h)
+
+    def on_image(self, base: str) -> Set[str]:
+        hs = self._icon_hashes.get(base)
+        if not hs:
+            return set()
+        self._image_done.add(base)
+        touched: Set[str] = set()
+        for h in list(hs):
+            touched |= self._settle(h)
+        return touched
+
+    def mark_image(self, base: str) -> Set[str]:
+        """
+        imageresults/<base>.json 已由调用方确认写好（如 IPC 同步返回）：直接记为完成。
+        可在 add_batch 之前调用，注册时不再探测该文件。
+        """
+        self._image_done.add(base)
+        touched: Set[str] = set()
+        for h in list(self._icon_hashes.get(base, ())):
+            touched |= self._settle(h)
+        return touched
+
+    def on_request(self, h: str) -> Set[str]:
+        """request/<hash>.json 出现或被覆盖：刷新该 hash 的 icon 缓存。"""
+        if h not in self._hash_batches or not self.request_dir:
+            return set()
+        base = self._icon_base_from_request(h)
+        if not base or base == self._hash_icon.get(h):
+            return set()
+        self._set_icon(h, base)
+        if base not in self._image_done and self._exists_in(self.image_dirs, f"{base}.json"):
+            self._image_done.add(base)
+        return self._settle(h)
+
+    def poll(self) -> Set[str]:
+        """消费目录事件，返回有进展的批次名集合（不阻塞）。"""
+        touched: Set[str] = set()
+        for kind, w in self._watchers:
+            for path in w.ready(timeout=0.0):
+                stem = os.path.splitext(os.path.basename(path))[0]
+                if kind == "info":
+                    touched |= self.on_info(stem)
+                elif kind == "image":
+                    touched |= self.on_image(stem)
+                else:
+                    touched |= self.on_request(stem)
+        return touched
+
+    # ---------------- 内部 ----------------
+    def _set_icon(self, h: str, base: Optional[str]):
+        old = self._hash_icon.get(h)
+        if old and old != base:
+            peers = self._icon_hashes.get(old, set())
+            peers.discard(h)
+            if not peers:
+                self._icon_hashes.pop(old, None)
+        self._hash_icon[h] = base
+        if base:
+            self._icon_hashes.setdefault(base, set()).add(h)
+
+    def _is_done(self, h: str) -> bool:
+        base = self._hash_icon.get(h)
+        return h in self._info_done and bool(base) and base in self._image_done
+
+    def _settle(self, h: str) -> Set[str]:
+        if not self._is_done(h):
+            return set()
+        touched = set()
+        for b in self._hash_batches.get(h, ()):
+            rem = self.remaining.get(b)
+            if rem is not None and h in rem:
+                rem.discard(h)
+                touched.add(b)
+        return touched
+
+    def _icon_base_from_request(self, h: str) -> Optional[str]:
+        if not self.request_dir:
+            return None
+        j = os.path.join(self.request_dir, f"{h}.json")
+        try:
+            with open(j, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return _icon_base(data.get("icon_filename") or "")
+
+    @staticmethod
+    def _exists_in(dirs: List[str], fname: str) -> bool:
+        return any(os.path.exists(os.path.join(d, fname)) for d in dirs)
@@ -2,29 +2,41 @@
 # -*- coding: utf-8 -*-
 
 import os
+import gzip
 import json
 import time
-import shutil
 import logging
 import threading
 from typing import Dict, Optional, Set, List
-import boto3
 from botocore.exceptions import ClientError
 
+from iconml_fsevents import DirWatcher
+from iconml_handoff import atomic_move, atomic_write_json, atomic_write_text, commit_temp, temp_target
+from iconml_s3 import ListingCache, S3Object, get_engine
+import iconml_state as rstate
+from iconml_layout import PARTITION_LEVELS, partition_key
+from iconml_s3events import RECONCILE_INTERVAL, SQS_QUEUE_URL, KeySource, S3EventRouter
+from iconml_scheduler import Scheduler
+from iconml_tracker import CompletionTracker
+
 # =========================== 全局配置 ===========================
 BUCKET = "mr-iconml-dev"
 
 # --- request 流水线(S3) ---
 S3_REQUEST        = "iconml/request/"
 S3_IMAGES         = "iconml/images/"
-S3_PROCESSING     = "iconml/processing/"
-S3_PROCESSED      = "iconml/processed/"
+S3_PROCESSING     = "iconml/processing/"     # 旧布局；状态已改由清单记录，不再使用
+S3_PROCESSED      = "iconml/processed/"      # done 的 request 按批归档到这里
+S3_STATE_MANIFEST = "iconml/state/requests.json"
 S3_INFORESULTS    = "iconml/inforesults/"
 S3_IMAGERESULTS   = "iconml/imageresults/"
+# 以上前缀的 hash 分区级数（见 iconml_layout；0 = 平铺）。request/ 的列举兼容两种布局
+S3_PARTITION_LEVELS = PARTITION_LEVELS
 
 # --- request 本地目录 ---
 DIR_REQUEST           = "request"
 DIR_UPLOADIMAGES      = "uploadimages"
+DIR_UPLOADFILTERS     = "uploadfilters"   # request 的 filter 旁路文件（不放进匹配端扫描的 uploadimages）
 DIR_INFORESULTS       = "inforesults"
 DIR_IMAGERESULTS      = "imageresults"
 DIR_BAKINFORESULTS    = "bakinforesults"
@@ -33,11 +45,17 @@ DIR_BAKIMAGERESULTS   = "bakimageresults"
 # --- requestbyhash (RBH) 专用(S3) ---
 S3_RBH        = "iconml/requestbyhash/"
 S3_RBH_DONE   = "iconml/requestbyhashdone/"
+S3_RBH_BUNDLE = "iconml/requestbyhashbundle/"   # <批次名去扩展名>.jsonl.gz，先于 done 标记上传
+S3_RBH_PARTIAL = "iconml/requestbyhashpartial/" # <批次名去扩展名>/manifest.json + 增量结果分片
 
 # --- requestbyhash (RBH) 本地目录 ---
 DIR_RBH         = "requestbyhash"
 DIR_RBH_DONE    = "requestbyhashdone"
 DIR_RBH_BAK     = "bakrequestbyhashdone"  # 归档 done 与源 txt
+DIR_RBH_PARTIAL = "requestbyhashpartial"  # 增量分片的本地临时文件（上传后删除）
+
+# 长批次的滚动部分结果：每 N 秒把新完成的 hash 发布为一个分片并更新清单；0 = 关闭
+RBH_PARTIAL_INTERVAL = 30.0
 
 # --- addsample (AS) 专用(S3) ---
 S3_AS_IN       = "iconml/addsamples/"
@@ -48,63 +66,86 @@ DIR_AS_IN      = "addsamples"            # 从 S3 下载的待处理 txt
 DIR_AS_DONE    = "addsampleprocessed"    # 你本地产出的处理完成 txt
 DIR_AS_BAK     = "bakaddsamples"         # 本地归档
 
-# --- 轮询间隔 ---
-POLL_S3_INTERVAL     = 2.0     # 扫 S3 的节奏
-POLL_LOCAL_INTERVAL  = 1.0     # 扫本地目录的节奏
-STABLE_WAIT_SEC      = 0.2     # 本地文件大小稳定检测
+# --- 调度节奏（见 iconml_scheduler）：有新工作时按最小间隔，空闲时指数退避到最大间隔 ---
+POLL_S3_INTERVAL     = 0.5     # 扫 S3 的最小间隔（事件模式下有事件即提前唤醒）
+POLL_S3_MAX_INTERVAL = 30.0    # 空闲时退避上限
+POLL_LOCAL_INTERVAL  = 0.2     # 扫本地结果目录的最小间隔
+POLL_LOCAL_MAX_INTERVAL = 2.0
+POLL_BACKOFF         = 2.0
+FLUSH_DELETES_INTERVAL = 2.0   # 攒批删除的提交节奏
 LOG_LEVEL            = logging.INFO
 
+# --- S3 事件通知摄取（见 iconml_s3events）---
+# 配置了 SQS 队列（ICONML_SQS_QUEUE_URL）时，新对象由 ObjectCreated 事件驱动，
+# 每 EVENT_RECONCILE_INTERVAL 秒做一次增量列举兜底漏掉的事件；为空则保持轮询列举
+EVENT_QUEUE_URL          = SQS_QUEUE_URL
+EVENT_RECONCILE_INTERVAL = RECONCILE_INTERVAL
+
+# --- request 状态清单（见 iconml_state）---
+DIR_STATE              = "state"
+STATE_DB_PATH          = os.path.join(DIR_STATE, "requests.sqlite3")
+STATE_MIRROR_INTERVAL  = 10.0               # 有变化时最多每 N 秒镜像一次到 S3_STATE_MANIFEST
+STATE_RETENTION_SEC    = 7 * 24 * 3600      # 清单只保留近 N 秒有更新的请求（库里全量保留）
+# done 的 request 是否从 request/ 归档到 processed/（按批 copy + 攒批 delete）；
+# False 则源对象原地保留，只靠清单表达状态
+REQUEST_ARCHIVE        = True
+ARCHIVE_INTERVAL       = 60.0
+ARCHIVE_BATCH          = 500
+
+# --- 本地交接协议（见 iconml_handoff）---
+# 结果生产者应先写 *.tmp 再 rename；若外部生产者只能原地写，置 True 并在写完后落 <name>.ready 标记
+RESULTS_READY_MARKER = False
+
 logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s [%(levelname)s] %(message)s")
 
 # 统一确保目录存在
 for d in [
-    DIR_REQUEST, DIR_UPLOADIMAGES,
+    DIR_REQUEST, DIR_UPLOADIMAGES, DIR_UPLOADFILTERS,
     DIR_INFORESULTS, DIR_IMAGERESULTS,
     DIR_BAKINFORESULTS, DIR_BAKIMAGERESULTS,
-    DIR_RBH, DIR_RBH_DONE, DIR_RBH_BAK,
-    DIR_AS_IN, DIR_AS_DONE, DIR_AS_BAK
+    DIR_RBH, DIR_RBH_DONE, DIR_RBH_BAK, DIR_RBH_PARTIAL,
+    DIR_AS_IN, DIR_AS_DONE, DIR_AS_BAK,
+    DIR_STATE
 ]:
     os.makedirs(d, exist_ok=True)
 
 
 # =========================== 公共 I/O 工具 ===========================
 def new_s3():
-    """每个线程独立创建 S3 client，避免跨线程复用连接。"""
-    return boto3.client("s3")
-
-def s3_list_prefix(s3, bucket: str, prefix: str) -> List[str]:
-    keys, token = [], None
-    while True:
-        params = {"Bucket": bucket, "Prefix": prefix}
-        if token:
-            params["ContinuationToken"] = token
+    """三个线程共用传输引擎里的 S3 client（boto3 client 线程安全），共享同一个连接池。"""
+    return get_engine().s3
+
+def gather(futs, tag: str) -> list:
+    """按提交顺序收集工作项结果；失败的工作项记日志并返回 None。"""
+    out = []
+    for f in futs:
         try:
-            resp = s3.list_objects_v2(**params)
-        except ClientError as e:
-            logging.error(f"s3_list_prefix error: {e} (prefix={prefix})")
-            return keys
-        for c in resp.get("Contents", []):
-            if not c["Key"].endswith("/"):
-                keys.append(c["Key"])
-        if not resp.get("IsTruncated"):
-            break
-        token = resp.get("NextContinuationToken")
-    return keys
-
-def s3_head_last_modified_ts(s3, bucket: str, key: str) -> Optional[float]:
-    try:
-        resp = s3.head_object(Bucket=bucket, Key=key)
-        return resp["LastModified"].timestamp()
-    except ClientError:
-        return None
+            out.append(f.result())
+        except Exception as e:
+            logging.error(f"{tag} work item failed: {e}")
+            out.append(None)
+    return out
+
+def needs_download(obj: S3Object, local_path: str) -> bool:
+    """列举已告知对象有变化；本地已有且不旧于 S3（如重启后）则不必重下。"""
+    if not os.path.exists(local_path):
+        return True
+    return obj.last_modified > os.path.getmtime(local_path) + 1.0
 
 def s3_download(s3, bucket: str, key: str, local_path: str):
-    os.makedirs(os.path.dirname(local_path), exist_ok=True)
-    s3.download_file(bucket, key, local_path)
+    # 先落临时名再 rename，下游只会看到完整文件
+    tmp = temp_target(local_path)
+    try:
+        s3.download_file(bucket, key, tmp, Config=get_engine().transfer_config)
+        commit_temp(tmp, local_path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
     logging.info(f"S3 -> local: s3://{bucket}/{key} -> {local_path}")
 
 def s3_upload(s3, bucket: str, key: str, local_path: str):
-    s3.upload_file(local_path, bucket, key)
+    s3.upload_file(local_path, bucket, key, Config=get_engine().transfer_config)
     logging.info(f"local -> S3: {local_path} -> s3://{bucket}/{key}")
 
 def s3_copy(s3, bucket: str, src_key: str, dst_key: str):
@@ -115,20 +156,18 @@ def s3_delete(s3, bucket: str, key: str):
     s3.delete_object(Bucket=bucket, Key=key)
     logging.info(f"S3 delete: s3://{bucket}/{key}")
 
-def s3_move(s3, bucket: str, src_key: str, dst_key: str):
+def s3_delete_later(bucket: str, key: str):
+    """登记删除，由引擎攒批 delete_objects；每轮循环末尾 flush。"""
+    get_engine().delete_later(bucket, key)
+
+def s3_move(s3, bucket: str, src_key: str, dst_key: str, defer_delete: bool = False):
     if src_key == dst_key:
         return
     s3_copy(s3, bucket, src_key, dst_key)
-    s3_delete(s3, bucket, src_key)
-
-def file_is_stable(path: str, wait_sec: float = STABLE_WAIT_SEC) -> bool:
-    try:
-        s1 = os.path.getsize(path)
-        time.sleep(wait_sec)
-        s2 = os.path.getsize(path)
-        return s1 == s2 and s1 > 0
-    except FileNotFoundError:
-        return False
+    if defer_delete:
+        s3_delete_later(bucket, src_key)
+    else:
+        s3_delete(s3, bucket, src_key)
 
 def move_local(src: str, dst_dir: str) -> str:
     os.makedirs(dst_dir, exist_ok=True)
@@ -137,8 +176,7 @@ def move_local(src: str, dst_dir: str) -> str:
     if os.path.exists(dst):
         name, ext = os.path.splitext(base)
         dst = os.path.join(dst_dir, f"{name}_{int(time.time())}{ext}")
-    time.sleep(1.5)  # 给 FS 缓冲，避免紧跟读写抖动
-    shutil.move(src, dst)
+    atomic_move(src, dst)
     logging.info(f"Local move: {src} -> {dst}")
     return dst
 
@@ -151,206 +189,267 @@ def load_json(path: str) -> Optional[dict]:
         return None
 
 
+def icon_keys(icon_filename: str) -> List[str]:
+    """icon 的候选 key：当前布局在前；分区布局下附带平铺 key（兼容未迁移的旧对象）。"""
+    key = partition_key(S3_IMAGES, icon_filename, S3_PARTITION_LEVELS)
+    return [key] if key == S3_IMAGES + icon_filename else [key, S3_IMAGES + icon_filename]
+
+
+def load_result(fname: str, *dirs: str) -> Optional[dict]:
+    """在结果目录及其 bak 目录中查找并解析结果 json；不存在返回 None。"""
+    for d in dirs:
+        p = os.path.join(d, fname)
+        if os.path.exists(p):
+            return load_json(p)
+    return None
+
+
+def bundle_name(batch_name: str) -> str:
+    return os.path.splitext(batch_name)[0] + ".jsonl.gz"
+
+
+def make_source(listing: ListingCache, router: Optional[S3EventRouter]) -> KeySource:
+    return KeySource(listing, router, reconcile_interval=EVENT_RECONCILE_INTERVAL)
+
+
+def make_scheduler(tag: str, source: KeySource) -> Scheduler:
+    """每个 watcher 一个调度器；事件模式下 S3 事件到达会唤醒并立即执行 on_wake 的 Job。"""
+    return Scheduler(tag, wake=source.wake_event)
+
+
+def flush_deletes() -> int:
+    return get_engine().flush_deletes(BUCKET)
+
+
 # =========================== request 流水线（线程1） ===========================
 class RequestTask:
-    def __init__(self, req_json_name: str, icon_filename: str, s3_processing_key: str):
+    def __init__(self, req_json_name: str, icon_filename: str, s3_key: str):
         self.req_json_name = req_json_name
         self.icon_filename = icon_filename
         self.icon_base_noext = os.path.splitext(icon_filename)[0]
-        self.s3_processing_key = s3_processing_key
+        self.s3_key = s3_key
         self.created_ts = time.time()
     def __repr__(self):
         return f"Task(req={self.req_json_name}, icon={self.icon_filename})"
 
 class RequestWatcher(threading.Thread):
-    def __init__(self):
+    def __init__(self, router: Optional[S3EventRouter] = None):
         super().__init__(daemon=True)
+        self.engine = get_engine()
         self.s3 = new_s3()
         # 队列
         self.pending_inforesults: Dict[str, RequestTask] = {}    # key: request_json_name
         self.pending_imageresults: Dict[str, RequestTask] = {}   # key: icon_base
-        # S3 最近更新时间缓存（处理同名覆盖）
-        self.seen_s3_lm_request: Dict[str, float] = {}
-        # 兜底增量同步缓存
-        self.seen_local_inforesults_mtime: Dict[str, float] = {}
-        self.seen_local_imageresults_mtime: Dict[str, float] = {}
-
-    def _handle_new_request_from_s3(self):
-        keys = s3_list_prefix(self.s3, BUCKET, S3_REQUEST)
-        for key in keys:
-            if not key.endswith(".json"):
-                continue
-            name = os.path.basename(key)
-            local_path = os.path.join(DIR_REQUEST, name)
-
-            s3lm = s3_head_last_modified_ts(self.s3, BUCKET, key)
-            oldlm = self.seen_s3_lm_request.get(name, 0.0)
-            local_mtime = os.path.getmtime(local_path) if os.path.exists(local_path) else 0.0
+        # S3 增量列举（ETag/LastModified 来自列举结果本身，不再逐 key HEAD）
+        self.request_listing = ListingCache(self.s3, BUCKET, S3_REQUEST, suffix=".json",
+                                            partitioned=S3_PARTITION_LEVELS > 0)
+        self.request_source = make_source(self.request_listing, router)
+        # 本地结果目录的“文件就绪”事件（已存在的结果也会在启动后产出一次）
+        self.info_watch = DirWatcher(DIR_INFORESULTS, suffixes=(".json",), poll_interval=POLL_LOCAL_MAX_INTERVAL,
+                                     ready_marker=RESULTS_READY_MARKER)
+        self.image_watch = DirWatcher(DIR_IMAGERESULTS, suffixes=(".json",), poll_interval=POLL_LOCAL_MAX_INTERVAL,
+                                      ready_marker=RESULTS_READY_MARKER)
+        # 上传失败的就绪文件，下一轮重试（事件只产出一次）
+        self.retry_inforesults: List[str] = []
+        self.retry_imageresults: List[str] = []
+        # 生命周期状态清单：取代 request/ -> processing/ -> processed/ 的逐个 S3 移动
+        self.state = rstate.RequestStateStore(STATE_DB_PATH)
+        # 重启：processing 中的请求恢复到队列
+        for r in self.state.in_state(rstate.PROCESSING):
+            if r["icon_filename"]:
+                t = RequestTask(r["name"], r["icon_filename"], r["s3_key"])
+                self.pending_inforesults[t.req_json_name] = t
+                self.pending_imageresults[t.icon_base_noext] = t
+
+    def _pull_one_request(self, obj: S3Object) -> Optional[RequestTask]:
+        """工作项（线程池内执行）：下载 request -> 下载 icon；状态记入清单，不再移动 S3 对象。"""
+        key = obj.key
+        name = os.path.basename(key)
+        local_path = os.path.join(DIR_REQUEST, name)
+
+        # 源对象留在 request/ 直到归档；重启后再次列举到的已完成请求直接跳过
+        if self.state.is_settled(name, obj.etag):
+            return None
+        self.state.mark(name, rstate.RECEIVED, etag=obj.etag, s3_key=key)
 
-            # 首次或 S3 更新 -> 下载
-            if (s3lm is not None) and (not os.path.exists(local_path) or s3lm > local_mtime + 1.0 or s3lm > oldlm + 1.0):
-                try:
-                    s3_download(self.s3, BUCKET, key, local_path)
-                    self.seen_s3_lm_request[name] = s3lm or time.time()
-                except ClientError as e:
-                    logging.error(f"[REQ] download request failed: {key}, {e}")
-                    continue
+        # 新出现或 S3 更新 -> 下载
+        if needs_download(obj, local_path):
+            s3_download(self.s3, BUCKET, key, local_path)
 
-            # S3 移动到 processing（幂等）
-            processing_key = S3_PROCESSING + name
-            try:
-                s3_move(self.s3, BUCKET, key, processing_key)
-            except ClientError as e:
-                logging.warning(f"[REQ] move request->processing warn: {e}")
+        data = load_json(local_path)
+        if not data:
+            self.state.mark(name, rstate.FAILED, error="invalid json")
+            return None
+        icon_filename = data.get("icon_filename")
+        if not icon_filename:
+            logging.error(f"[REQ] json missing icon_filename: {local_path}")
+            self.state.mark(name, rstate.FAILED, error="missing icon_filename")
+            return None
 
-            data = load_json(local_path)
-            if not data:
-                continue
-            icon_filename = data.get("icon_filename")
-            if not icon_filename:
-                logging.error(f"[REQ] json missing icon_filename: {local_path}")
-                continue
+        # 可选的元数据过滤条件：写到单独目录，且先于 icon 落地，匹配端发现 icon 时旁路文件已就绪
+        icon_local = os.path.join(DIR_UPLOADIMAGES, icon_filename)
+        if data.get("filter"):
+            atomic_write_json(os.path.join(DIR_UPLOADFILTERS, icon_filename + ".filter.json"), data["filter"])
 
-            # 下载 icon 到本地（若不存在）
-            icon_key = S3_IMAGES + icon_filename
-            icon_local = os.path.join(DIR_UPLOADIMAGES, icon_filename)
-            if not os.path.exists(icon_local):
+        # 下载 icon 到本地（若不存在）；迁移期间分区 key 不存在时回退到平铺 key
+        if not os.path.exists(icon_local):
+            for icon_key in icon_keys(icon_filename):
                 try:
                     s3_download(self.s3, BUCKET, icon_key, icon_local)
+                    break
                 except ClientError as e:
-                    logging.warning(f"[REQ] download icon warn (non-fatal): {e}")
+                    logging.warning(f"[REQ] download icon warn (non-fatal): {e} ({icon_key})")
 
-            t = RequestTask(name, icon_filename, processing_key)
-            self.pending_inforesults[name] = t
-            self.pending_imageresults[t.icon_base_noext] = t
-            logging.info(f"[ENQUEUE][REQ] {t}")
+        self.state.mark(name, rstate.PROCESSING, icon_filename=icon_filename)
+        return RequestTask(name, icon_filename, key)
 
-    def _scan_local_inforesults(self):
-        if not self.pending_inforesults:
-            return
-        need = set(self.pending_inforesults.keys())
-        for fname in os.listdir(DIR_INFORESULTS):
-            if not fname.endswith(".json") or fname not in need:
-                continue
-            fpath = os.path.join(DIR_INFORESULTS, fname)
-            if not file_is_stable(fpath):
-                continue
-            t = self.pending_inforesults.get(fname)
-            if not t:
-                continue
-
-            try:
-                s3_upload(self.s3, BUCKET, S3_INFORESULTS + fname, fpath)
-            except ClientError as e:
-                logging.error(f"[REQ] upload inforesults failed: {e}")
-                continue
+    def _handle_new_request_from_s3(self) -> int:
+        objs = self.request_source.poll()
+        futs = self.engine.map(self._pull_one_request, objs, lane_of=lambda o: os.path.basename(o.key))
+        for obj, f in zip(objs, futs):
             try:
-                s3_move(self.s3, BUCKET, t.s3_processing_key, S3_PROCESSED + fname)
-            except ClientError as e:
-                logging.warning(f"[REQ] processing->processed warn: {e}")
-
-            move_local(fpath, DIR_BAKINFORESULTS)
-            self.pending_inforesults.pop(fname, None)
-            logging.info(f"[DEQUEUE][REQ] inforesults {fname}")
-
-    def _scan_local_imageresults(self):
-        if not self.pending_imageresults:
-            return
-        need = set(self.pending_imageresults.keys())
-        for fname in os.listdir(DIR_IMAGERESULTS):
-            if not fname.endswith(".json"):
-                continue
-            base = os.path.splitext(fname)[0]
-            if base not in need:
-                continue
-            fpath = os.path.join(DIR_IMAGERESULTS, fname)
-            if not file_is_stable(fpath):
+                t = f.result()
+            except Exception as e:
+                logging.error(f"[REQ] download request failed: {obj.key}, {e}")
+                self.request_source.forget(obj.key)   # 下一轮（事件模式下为下一次核对）重试
                 continue
-            t = self.pending_imageresults.get(base)
-            if not t:
+            if t is None:
                 continue
+            self.pending_inforesults[t.req_json_name] = t
+            self.pending_imageresults[t.icon_base_noext] = t
+            logging.info(f"[ENQUEUE][REQ] {t}")
+        return len(objs)
 
-            try:
-                s3_upload(self.s3, BUCKET, S3_IMAGERESULTS + fname, fpath)
-            except ClientError as e:
-                logging.error(f"[REQ] upload imageresults failed: {e}")
-                continue
-            try:
-                s3_delete(self.s3, BUCKET, S3_IMAGES + t.icon_filename)
-            except ClientError as e:
-                logging.warning(f"[REQ] delete icon warn: {e}")
-
-            move_local(fpath, DIR_BAKIMAGERESULTS)
-            self.pending_imageresults.pop(base, None)
-            logging.info(f"[DEQUEUE][REQ] imageresults {fname}")
-
-    # 兜底：任何新/更新的本地结果，都直接上传（不依赖队列）
-    def _sync_inforesults_incremental(self):
-        for fname in os.listdir(DIR_INFORESULTS):
-            if not fname.endswith(".json"):
-                continue
-            fpath = os.path.join(DIR_INFORESULTS, fname)
-            if not file_is_stable(fpath):
-                continue
-            m = os.path.getmtime(fpath)
-            if m <= self.seen_local_inforesults_mtime.get(fname, 0.0):
-                continue
-            try:
-                s3_upload(self.s3, BUCKET, S3_INFORESULTS + fname, fpath)
-            except ClientError as e:
-                logging.error(f"[REQ][INCR] upload inforesults failed: {e}")
-                continue
-            move_local(fpath, DIR_BAKINFORESULTS)
-            self.seen_local_inforesults_mtime[fname] = m
-            self.pending_inforesults.pop(fname, None)
-            logging.info(f"[REQ][INCR] inforesults {fname}")
-
-    def _sync_imageresults_incremental(self):
-        for fname in os.listdir(DIR_IMAGERESULTS):
-            if not fname.endswith(".json"):
-                continue
-            fpath = os.path.join(DIR_IMAGERESULTS, fname)
-            if not file_is_stable(fpath):
-                continue
-            m = os.path.getmtime(fpath)
-            if m <= self.seen_local_imageresults_mtime.get(fname, 0.0):
+    def _ack_inforesult(self, fpath: str, t: Optional[RequestTask]) -> bool:
+        """工作项：上传结果 -> 清单记 done -> 本地归档。顺序执行。"""
+        fname = os.path.basename(fpath)
+        try:
+            s3_upload(self.s3, BUCKET, partition_key(S3_INFORESULTS, fname, S3_PARTITION_LEVELS), fpath)
+        except ClientError as e:
+            logging.error(f"[REQ] upload inforesults failed: {e}")
+            return False
+        if t:
+            self.state.mark(t.req_json_name, rstate.DONE)
+        move_local(fpath, DIR_BAKINFORESULTS)
+        return True
+
+    def _ack_imageresult(self, fpath: str, t: Optional[RequestTask]) -> bool:
+        """工作项：上传结果 -> 删除 S3 源 icon（攒批）-> 本地归档。"""
+        fname = os.path.basename(fpath)
+        try:
+            s3_upload(self.s3, BUCKET, partition_key(S3_IMAGERESULTS, fname, S3_PARTITION_LEVELS), fpath)
+        except ClientError as e:
+            logging.error(f"[REQ] upload imageresults failed: {e}")
+            return False
+        if t:
+            for icon_key in icon_keys(t.icon_filename):
+                s3_delete_later(BUCKET, icon_key)
+            self.state.mark_image_done(t.req_json_name)
+        move_local(fpath, DIR_BAKIMAGERESULTS)
+        return True
+
+    # 任何新/更新的本地结果都直接上传（不依赖队列）；若命中队列，再推进 S3 状态
+    def _drain_local_inforesults(self) -> int:
+        paths = [p for p in self.retry_inforesults + self.info_watch.ready() if os.path.exists(p)]
+        self.retry_inforesults = []
+        tasks = [self.pending_inforesults.get(os.path.basename(p)) for p in paths]
+        futs = [self.engine.submit(self._ack_inforesult, p, t, lane=os.path.basename(p)) for p, t in zip(paths, tasks)]
+        for fpath, t, ok in zip(paths, tasks, gather(futs, "[REQ] inforesults")):
+            fname = os.path.basename(fpath)
+            if not ok:
+                self.retry_inforesults.append(fpath)
                 continue
-            try:
-                s3_upload(self.s3, BUCKET, S3_IMAGERESULTS + fname, fpath)
-            except ClientError as e:
-                logging.error(f"[REQ][INCR] upload imageresults failed: {e}")
+            if t:
+                self.pending_inforesults.pop(fname, None)
+            logging.info(f"[DEQUEUE][REQ] inforesults {fname}" if t else f"[REQ][INCR] inforesults {fname}")
+        return len(paths)
+
+    def _drain_local_imageresults(self) -> int:
+        paths = [p for p in self.retry_imageresults + self.image_watch.ready() if os.path.exists(p)]
+        self.retry_imageresults = []
+        bases = [os.path.splitext(os.path.basename(p))[0] for p in paths]
+        tasks = [self.pending_imageresults.get(b) for b in bases]
+        futs = [self.engine.submit(self._ack_imageresult, p, t, lane=os.path.basename(p)) for p, t in zip(paths, tasks)]
+        for fpath, base, t, ok in zip(paths, bases, tasks, gather(futs, "[REQ] imageresults")):
+            fname = os.path.basename(fpath)
+            if not ok:
+                self.retry_imageresults.append(fpath)
                 continue
-            move_local(fpath, DIR_BAKIMAGERESULTS)
-            self.seen_local_imageresults_mtime[fname] = m
-            self.pending_imageresults.pop(os.path.splitext(fname)[0], None)
-            logging.info(f"[REQ][INCR] imageresults {fname}")
+            if t:
+                self.pending_imageresults.pop(base, None)
+            logging.info(f"[DEQUEUE][REQ] imageresults {fname}" if t else f"[REQ][INCR] imageresults {fname}")
+        return len(paths)
+
+    def _archive_one(self, name: str, s3_key: str) -> bool:
+        """工作项：request/<name> -> processed/<name>；源已不存在视为已归档。"""
+        try:
+            s3_move(self.s3, BUCKET, s3_key, partition_key(S3_PROCESSED, name, S3_PARTITION_LEVELS), defer_delete=True)
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code", "")
+            if code not in ("NoSuchKey", "404"):
+                raise
+        return True
+
+    def _archive_done_requests(self) -> int:
+        """按批归档已完成请求：每批 copy 并发执行，源删除随下一次 flush_deletes 一次提交。"""
+        rows = [r for r in self.state.archive_candidates(ARCHIVE_BATCH) if r["s3_key"]]
+        futs = [self.engine.submit(self._archive_one, r["name"], r["s3_key"], lane=r["name"]) for r in rows]
+        done = [r["name"] for r, ok in zip(rows, gather(futs, "[REQ] archive")) if ok]
+        self.state.mark_archived(done)
+        if done:
+            logging.info(f"[REQ] archived {len(done)} request(s) -> {S3_PROCESSED}")
+        return len(done)
+
+    def _mirror_state(self) -> int:
+        if self.state.mirror_to_s3(self.s3, BUCKET, S3_STATE_MANIFEST, STATE_RETENTION_SEC):
+            logging.debug(f"[REQ] state manifest -> s3://{BUCKET}/{S3_STATE_MANIFEST}")
+            return 1
+        return 0
 
     def run(self):
         logging.info("=== RequestWatcher started ===")
-        while True:
-            try:
-                self._handle_new_request_from_s3()
-                self._scan_local_inforesults()
-                self._scan_local_imageresults()
-                # 兜底增量
-                self._sync_inforesults_incremental()
-                self._sync_imageresults_incremental()
-                time.sleep(POLL_LOCAL_INTERVAL)
-                time.sleep(POLL_S3_INTERVAL)
-            except Exception as e:
-                logging.exception(f"[REQ] loop error: {e}")
-                time.sleep(1.0)
+        sched = make_scheduler("[REQ]", self.request_source)
+        sched.add("pull-requests", self._handle_new_request_from_s3,
+                  POLL_S3_INTERVAL, POLL_S3_MAX_INTERVAL, POLL_BACKOFF, on_wake=True)
+        sched.add("inforesults", self._drain_local_inforesults,
+                  POLL_LOCAL_INTERVAL, POLL_LOCAL_MAX_INTERVAL, POLL_BACKOFF)
+        sched.add("imageresults", self._drain_local_imageresults,
+                  POLL_LOCAL_INTERVAL, POLL_LOCAL_MAX_INTERVAL, POLL_BACKOFF)
+        if REQUEST_ARCHIVE:
+            sched.add("archive", self._archive_done_requests, ARCHIVE_INTERVAL)
+        sched.add("flush-deletes", flush_deletes, FLUSH_DELETES_INTERVAL)
+        sched.add("mirror-state", self._mirror_state, STATE_MIRROR_INTERVAL)
+        sched.run_forever()
 
 
 # =========================== requestbyhash 流水线（线程2） ===========================
-class RBHWatcher(threading.Thread):
+class PartialState:
+    """一个批次的增量发布进度。run 区分进程重启/批次重拉，分片 key 不会相互覆盖。"""
     def __init__(self):
+        self.run = int(time.time() * 1000)
+        self.seq = 0
+        self.published: Set[str] = set()
+        self.parts: List[str] = []
+
+class RBHWatcher(threading.Thread):
+    def __init__(self, router: Optional[S3EventRouter] = None):
         super().__init__(daemon=True)
+        self.engine = get_engine()
         self.s3 = new_s3()
         # 记录批次 -> {hash集合}
         self.batches: Dict[str, Set[str]] = {}
-        # S3 TXT 的 LastModified 记忆（支持同名覆盖）
-        self.rbh_seen_s3_lm: Dict[str, float] = {}
+        # S3 TXT 增量列举：ETag 变化即同名覆盖。源 txt 不会从 S3 删除，
+        # 批次名通常按日期递增，平时从检查点 StartAfter 往后列，定期全量核对
+        self.listing = ListingCache(self.s3, BUCKET, S3_RBH, suffix=".txt", ordered=True)
+        self.source = make_source(self.listing, router)
+        # 完成度反向索引：request 元数据只读一次，结果目录增量喂入
+        self.tracker = CompletionTracker(
+            info_dirs=[DIR_INFORESULTS, DIR_BAKINFORESULTS],
+            image_dirs=[DIR_IMAGERESULTS, DIR_BAKIMAGERESULTS],
+            request_dir=DIR_REQUEST,
+        )
+        # 批次 -> 增量发布进度
+        self.partials: Dict[str, PartialState] = {}
 
     def _read_hashes(self, path: str) -> Set[str]:
         out = set()
@@ -365,58 +464,27 @@ class RBHWatcher(threading.Thread):
             logging.error(f"[RBH] read hashes error: {e} ({path})")
         return out
 
-    def _pull_batches_from_s3(self):
-        keys = s3_list_prefix(self.s3, BUCKET, S3_RBH)
-        for key in keys:
-            if not key.endswith(".txt"):
+    def _pull_one_batch(self, obj: S3Object):
+        """工作项：必要时下载批次 txt，返回 (name, hashes)。"""
+        name = os.path.basename(obj.key)
+        local = os.path.join(DIR_RBH, name)
+        if needs_download(obj, local):
+            s3_download(self.s3, BUCKET, obj.key, local)
+        return name, self._read_hashes(local)
+
+    def _pull_batches_from_s3(self) -> int:
+        objs = self.source.poll()
+        futs = self.engine.map(self._pull_one_batch, objs, lane_of=lambda o: os.path.basename(o.key))
+        for obj, res in zip(objs, gather(futs, "[RBH] download")):
+            if not res:
+                self.source.forget(obj.key)
                 continue
-            name = os.path.basename(key)
-            local = os.path.join(DIR_RBH, name)
-            s3lm = s3_head_last_modified_ts(self.s3, BUCKET, key)
-            old = self.rbh_seen_s3_lm.get(name, 0.0)
-            local_m = os.path.getmtime(local) if os.path.exists(local) else 0.0
-
-            if (s3lm is not None) and (not os.path.exists(local) or s3lm > local_m + 1.0 or s3lm > old + 1.0):
-                try:
-                    s3_download(self.s3, BUCKET, key, local)
-                    self.rbh_seen_s3_lm[name] = s3lm or time.time()
-                    self.batches[name] = self._read_hashes(local)
-                    logging.info(f"[RBH] pull {name}, hashes={len(self.batches[name])}")
-                except Exception as e:
-                    logging.error(f"[RBH] download failed: {e}")
-
-    def _info_exists_locally(self, h: str) -> bool:
-        return os.path.exists(os.path.join(DIR_INFORESULTS, f"{h}.json"))
-
-    def _icon_base_from_request(self, h: str) -> Optional[str]:
-        """尝试从本地 request/<h>.json 读取 icon_filename -> icon_hash(base)。若无则返回 None。"""
-        j = os.path.join(DIR_REQUEST, f"{h}.json")
-        if not os.path.exists(j):
-            return None
-        data = load_json(j)
-        if not data:
-            return None
-        icon_filename = data.get("icon_filename") or ""
-        base, _ = os.path.splitext(icon_filename)
-        return base or None
-
-    def _image_exists_for_hash(self, h: str) -> bool:
-        """若能解析出 icon_base，就检查 imageresults/<icon_base>.json；否则认为图像未就绪。"""
-        base = self._icon_base_from_request(h)
-        if not base:
-            return False
-        return os.path.exists(os.path.join(DIR_IMAGERESULTS, f"{base}.json"))
-
-    def _all_done_for_batch(self, hashes: Set[str]) -> (List[str], List[str]):
-        done, pending = [], []
-        for h in hashes:
-            info_ok = self._info_exists_locally(h)
-            img_ok  = self._image_exists_for_hash(h)
-            if info_ok and img_ok:
-                done.append(h)
-            else:
-                pending.append(h)
-        return done, pending
+            name, hashes = res
+            self.batches[name] = hashes
+            self.partials[name] = PartialState()
+            self.tracker.add_batch(name, hashes)
+            logging.info(f"[RBH] pull {name}, hashes={len(hashes)}")
+        return len(objs)
 
     def _write_summary(self, local_txt_name: str, done: List[str], pending: List[str], all_hashes: Set[str]) -> str:
         lines = []
@@ -430,149 +498,249 @@ class RBHWatcher(threading.Thread):
         for h in pending: lines.append(f"  - {h}")
         lines.append("")
         lines.append("NOTE:")
-        lines.append("  SUCCESS COMPLETED: inforesults/<hash>.json & imageresults/<icon_hash>.json both present.")
+        lines.append("  SUCCESS COMPLETED: inforesults/<hash>.json & imageresults/<icon_hash>.json both present (or in bak*).")
         lines.append("  PENDING_OR_TIMEOUT: missing either inforesult or imageresult (或 request/<hash>.json 缺失，无法确定 icon_hash)。")
         return "\n".join(lines)
 
-    def _try_finalize_batches(self):
+    def _result_record(self, h: str) -> dict:
+        info = load_result(f"{h}.json", DIR_INFORESULTS, DIR_BAKINFORESULTS)
+        base = self.tracker.icon_of(h)
+        image = load_result(f"{base}.json", DIR_IMAGERESULTS, DIR_BAKIMAGERESULTS) if base else None
+        return {
+            "hash": h,
+            "status": "done" if info is not None and image is not None else "pending",
+            "icon_base": base,
+            "inforesult": info,
+            "imageresult": image,
+        }
+
+    def _write_records(self, local: str, hashes: Set[str]) -> str:
+        """每行一个 hash 的 {"hash","status","icon_base","inforesult","imageresult"}，gzip 压缩。"""
+        tmp = temp_target(local)
+        try:
+            with gzip.open(tmp, "wt", encoding="utf-8") as f:
+                for h in sorted(hashes):
+                    f.write(json.dumps(self._result_record(h), ensure_ascii=False, separators=(",", ":")) + "\n")
+            commit_temp(tmp, local)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return local
+
+    def _write_bundle(self, name: str, hashes: Set[str]) -> str:
+        """批次结果打包：客户端一次 GET 流式解析，代替逐 hash 的 HEAD+GET。"""
+        return self._write_records(os.path.join(DIR_RBH_DONE, bundle_name(name)), hashes)
+
+    def _publish_partial(self, name: str, final: bool = False) -> int:
+        """
+        把上次发布之后新完成的 hash 写成一个分片上传，再覆盖该批次的清单：
+            {"batch","run","seq","updated_at","total","completed":[...],"parts":[...],"final"}
+        清单最后写，客户端看到的分片一定已存在。返回本次新发布的 hash 数。
+        """
+        ps = self.partials.setdefault(name, PartialState())
+        done, _ = self.tracker.progress(name)
+        fresh = set(done) - ps.published
+        if not fresh and not final:
+            return 0
+        stem = os.path.splitext(name)[0]
+        seq = ps.seq + 1
+        parts = list(ps.parts)
+        if fresh:
+            part_name = f"{ps.run}-{seq:06d}.jsonl.gz"
+            local = self._write_records(os.path.join(DIR_RBH_PARTIAL, f"{stem}-{part_name}"), fresh)
+            key = f"{S3_RBH_PARTIAL}{stem}/{part_name}"
+            try:
+                s3_upload(self.s3, BUCKET, key, local)
+            finally:
+                os.remove(local)
+            parts.append(key)
+        manifest = {
+            "batch": name,
+            "run": ps.run,
+            "seq": seq,
+            "updated_at": round(time.time(), 3),
+            "total": len(self.batches.get(name, ())),
+            "completed": sorted(ps.published | fresh),
+            "parts": parts,
+            "final": final,
+        }
+        if final:
+            manifest["bundle"] = S3_RBH_BUNDLE + bundle_name(name)
+        self.s3.put_object(Bucket=BUCKET, Key=f"{S3_RBH_PARTIAL}{stem}/manifest.json",
+                           Body=json.dumps(manifest, ensure_ascii=False).encode("utf-8"),
+                           ContentType="application/json", CacheControl="no-cache")
+        ps.seq, ps.parts = seq, parts
+        ps.published |= fresh
+        if fresh:
+            logging.info(f"[RBH] partial {name} seq={seq}: +{len(fresh)} completed={len(ps.published)}")
+        return len(fresh)
+
+    def _publish_partials(self) -> int:
+        n = 0
+        for name in list(self.batches):
+            try:
+                n += self._publish_partial(name)
+            except Exception as e:
+                logging.error(f"[RBH] publish partial failed: {name}, {e}")
+        return n
+
+    def _try_finalize_batches(self) -> int:
+        touched = self.tracker.poll()
         for name, hashes in list(self.batches.items()):
-            done, pending = self._all_done_for_batch(hashes)
+            done, pending = self.tracker.progress(name)
             if pending:
-                logging.info(f"[RBH] wait {name}: completed={len(done)} pending={len(pending)}")
+                if name in touched:
+                    logging.info(f"[RBH] wait {name}: completed={len(done)} pending={len(pending)}")
                 continue
             # 全部完成 -> 生成同名 done.txt
             out = self._write_summary(name, done, pending, hashes)
             local_done = os.path.join(DIR_RBH_DONE, name)  # 与源同名
-            with open(local_done, "w", encoding="utf-8") as f:
-                f.write(out)
+            atomic_write_text(local_done, out)
+            local_bundle = self._write_bundle(name, hashes)
 
+            # 先传结果包与最终清单，再传 done 标记：客户端看到标记时结果包一定已存在
             try:
+                s3_upload(self.s3, BUCKET, S3_RBH_BUNDLE + bundle_name(name), local_bundle)
+                if RBH_PARTIAL_INTERVAL > 0:
+                    self._publish_partial(name, final=True)
                 s3_upload(self.s3, BUCKET, S3_RBH_DONE + name, local_done)
             except Exception as e:
                 logging.error(f"[RBH] upload done failed: {e}")
                 continue
 
+            move_local(local_bundle, DIR_RBH_BAK)
             move_local(local_done, DIR_RBH_BAK)
             src = os.path.join(DIR_RBH, name)
             if os.path.exists(src):
                 move_local(src, DIR_RBH_BAK)
             self.batches.pop(name, None)
+            self.partials.pop(name, None)
+            self.tracker.drop_batch(name)
             logging.info(f"[RBH] finalized {name}")
+        return len(touched)
 
     def run(self):
         logging.info("=== RBHWatcher started ===")
-        while True:
-            try:
-                self._pull_batches_from_s3()
-                self._try_finalize_batches()
-                time.sleep(POLL_LOCAL_INTERVAL)
-                time.sleep(POLL_S3_INTERVAL)
-            except Exception as e:
-                logging.exception(f"[RBH] loop error: {e}")
-                time.sleep(1.0)
+        sched = make_scheduler("[RBH]", self.source)
+        sched.add("pull-batches", self._pull_batches_from_s3,
+                  POLL_S3_INTERVAL, POLL_S3_MAX_INTERVAL, POLL_BACKOFF, on_wake=True)
+        sched.add("finalize", self._try_finalize_batches,
+                  POLL_LOCAL_INTERVAL, POLL_LOCAL_MAX_INTERVAL, POLL_BACKOFF)
+        if RBH_PARTIAL_INTERVAL > 0:
+            sched.add("partials", self._publish_partials, RBH_PARTIAL_INTERVAL)
+        sched.run_forever()
 
 
 # =========================== addsample 流水线（线程3） ===========================
 class AddSampleWatcher(threading.Thread):
     """
     addsample 逻辑：
-      - 拉取 S3 iconml/addsamples/*.txt 到本地 addsamples/   （支持同名覆盖：用 LastModified 判定）
+      - 拉取 S3 iconml/addsamples/*.txt 到本地 addsamples/   （支持同名覆盖：列举中 ETag 变化即重新拉取）
       - 你处理完毕后在本地 addSampleProcessed/ 产出同名 .txt
       - 监控到后：
             * 上传到 S3 iconml/addsampleprocessed/
             * 删除/清理 S3 源 addsamples/<name>.txt
             * 本地两个 txt 都归档到 bakaddsamples/
     """
-    def __init__(self):
+    def __init__(self, router: Optional[S3EventRouter] = None):
         super().__init__(daemon=True)
+        self.engine = get_engine()
         self.s3 = new_s3()
-        self.seen_s3_lm: Dict[str, float] = {}      # name -> s3 LastModified
+        self.listing = ListingCache(self.s3, BUCKET, S3_AS_IN, suffix=".txt")
+        self.source = make_source(self.listing, router)
         self.pending_names: Dict[str, str] = {}     # name -> s3_source_key
-
-    def _pull_from_s3(self):
-        keys = s3_list_prefix(self.s3, BUCKET, S3_AS_IN)
-        for key in keys:
-            if not key.endswith(".txt"):
+        self.done_watch = DirWatcher(DIR_AS_DONE, suffixes=(".txt",), poll_interval=POLL_LOCAL_MAX_INTERVAL)
+        self.ready_done: Dict[str, str] = {}        # name -> 本地已就绪路径（尚未匹配到 pending）
+
+    def _pull_one_sample(self, obj: S3Object) -> str:
+        """工作项：必要时下载 txt，返回 name。"""
+        name = os.path.basename(obj.key)
+        local = os.path.join(DIR_AS_IN, name)
+        if needs_download(obj, local):
+            s3_download(self.s3, BUCKET, obj.key, local)
+        return name
+
+    def _pull_from_s3(self) -> int:
+        objs = self.source.poll()
+        futs = self.engine.map(self._pull_one_sample, objs, lane_of=lambda o: os.path.basename(o.key))
+        for obj, name in zip(objs, gather(futs, "[AS] download")):
+            if not name:
+                self.source.forget(obj.key)
                 continue
-            name = os.path.basename(key)
-            local = os.path.join(DIR_AS_IN, name)
-            s3lm = s3_head_last_modified_ts(self.s3, BUCKET, key)
-            old  = self.seen_s3_lm.get(name, 0.0)
-            local_m = os.path.getmtime(local) if os.path.exists(local) else 0.0
+            self.pending_names[name] = obj.key
+            logging.info(f"[AS] pull {name}")
+        return len(objs)
 
-            if (s3lm is not None) and (not os.path.exists(local) or s3lm > local_m + 1.0 or s3lm > old + 1.0):
-                try:
-                    s3_download(self.s3, BUCKET, key, local)
-                    self.seen_s3_lm[name] = s3lm or time.time()
-                    self.pending_names[name] = key
-                    logging.info(f"[AS] pull {name}")
-                except ClientError as e:
-                    logging.error(f"[AS] download failed: {e}")
-
-    def _scan_local_done(self):
-        if not self.pending_names:
-            return
-        need = set(self.pending_names.keys())
-        for fname in os.listdir(DIR_AS_DONE):
-            if not fname.endswith(".txt") or fname not in need:
-                continue
-            fpath = os.path.join(DIR_AS_DONE, fname)
-            if not file_is_stable(fpath):
-                continue
-            s3_dst = S3_AS_DONE + fname
-            s3_src = self.pending_names.get(fname)
+    def _ack_done(self, fname: str, fpath: str, s3_src: Optional[str]) -> bool:
+        """工作项：上传处理结果 -> 删除 S3 源（攒批）-> 本地归档。"""
+        try:
+            s3_upload(self.s3, BUCKET, S3_AS_DONE + fname, fpath)
+        except ClientError as e:
+            logging.error(f"[AS] upload done failed: {e}")
+            return False
 
-            # 上传处理结果
-            try:
-                s3_upload(self.s3, BUCKET, s3_dst, fpath)
-            except ClientError as e:
-                logging.error(f"[AS] upload done failed: {e}")
+        # 删除 S3 源（或也可改成 move 到一个历史目录）
+        if s3_src:
+            s3_delete_later(BUCKET, s3_src)
+
+        # 本地归档：done 与 in 各归档一份
+        move_local(fpath, DIR_AS_BAK)
+        src_txt = os.path.join(DIR_AS_IN, fname)
+        if os.path.exists(src_txt):
+            move_local(src_txt, DIR_AS_BAK)
+        return True
+
+    def _scan_local_done(self) -> int:
+        fresh = self.done_watch.ready()
+        for fpath in fresh:
+            self.ready_done[os.path.basename(fpath)] = fpath
+        items = []
+        for fname in [n for n in self.ready_done if n in self.pending_names]:
+            fpath = self.ready_done.pop(fname)
+            if os.path.exists(fpath):
+                items.append((fname, fpath))
+        futs = [self.engine.submit(self._ack_done, n, p, self.pending_names.get(n), lane=n) for n, p in items]
+        for (fname, fpath), ok in zip(items, gather(futs, "[AS] finalize")):
+            if not ok:
+                self.ready_done[fname] = fpath
                 continue
-
-            # 删除 S3 源（或也可改成 move 到一个历史目录）
-            if s3_src:
-                try:
-                    s3_delete(self.s3, BUCKET, s3_src)
-                except ClientError as e:
-                    logging.warning(f"[AS] delete source warn: {e}")
-
-            # 本地归档：done 与 in 各归档一份
-            move_local(fpath, DIR_AS_BAK)
-            src_txt = os.path.join(DIR_AS_IN, fname)
-            if os.path.exists(src_txt):
-                move_local(src_txt, DIR_AS_BAK)
-
             self.pending_names.pop(fname, None)
             logging.info(f"[AS] finalized {fname}")
+        return len(fresh) + len(items)
 
     def run(self):
         logging.info("=== AddSampleWatcher started ===")
-        while True:
-            try:
-                self._pull_from_s3()
-                self._scan_local_done()
-                time.sleep(POLL_LOCAL_INTERVAL)
-                time.sleep(POLL_S3_INTERVAL)
-            except Exception as e:
-                logging.exception(f"[AS] loop error: {e}")
-                time.sleep(1.0)
+        sched = make_scheduler("[AS]", self.source)
+        sched.add("pull-samples", self._pull_from_s3,
+                  POLL_S3_INTERVAL, POLL_S3_MAX_INTERVAL, POLL_BACKOFF, on_wake=True)
+        sched.add("done", self._scan_local_done,
+                  POLL_LOCAL_INTERVAL, POLL_LOCAL_MAX_INTERVAL, POLL_BACKOFF)
+        sched.add("flush-deletes", flush_deletes, FLUSH_DELETES_INTERVAL)
+        sched.run_forever()
 
 
 # =========================== 主函数：启动三个线程 ===========================
 def main():
-    req = RequestWatcher()
-    rbh = RBHWatcher()
-    ads = AddSampleWatcher()
+    router = S3EventRouter(EVENT_QUEUE_URL, BUCKET) if EVENT_QUEUE_URL else None
+    req = RequestWatcher(router)
+    rbh = RBHWatcher(router)
+    ads = AddSampleWatcher(router)
+    if router is not None:
+        # 订阅在各 watcher 构造时完成，之后再启动路由线程
+        router.start()
     req.start()
     rbh.start()
     ads.start()
-    logging.info("=== merged watcher running (request + requestbyhash + addsample) ===")
+    logging.info("=== merged watcher running (request + requestbyhash + addsample), "
+                 f"ingest={'s3-events' if router else 'polling'} ===")
     # 主线程保持存活
     try:
         while True:
             time.sleep(60.0)
     except KeyboardInterrupt:
         logging.info("KeyboardInterrupt, exit.")
+        get_engine().flush_deletes()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,57 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def sc():
+    """iconml_siamese_compare; needs TensorFlow and the model modules (LoadImageLevelSiamese, siamese)."""
+    pytest.importorskip("tensorflow")
+    pytest.importorskip("LoadImageLevelSiamese")
+    pytest.importorskip("siamese")
+    import iconml_siamese_compare
+    return iconml_siamese_compare
+
+
+class _L1Model:
+    """Deterministic stand-in scorer: 1 - mean |a - b| (1-Lipschitz in the max pixel error)."""
+    def __call__(self, inputs, training=False):
+        a, b = inputs
+        return (1.0 - np.abs(np.asarray(a) - np.asarray(b)).mean(axis=(1, 2, 3))).reshape(-1, 1)
+
+
+@pytest.fixture
+def l1_model():
+    return _L1Model()
+
+
+@pytest.fixture
+def png():
+    """png(arr, mode=None) -> PNG bytes of a uint8 array."""
+    image = pytest.importorskip("PIL.Image")
+
+    def encode(arr, mode=None):
+        buf = io.BytesIO()
+        image.fromarray(arr, mode).save(buf, "PNG")
+        return buf.getvalue()
+    return encode
+
+
+@pytest.fixture
+def s3(request, monkeypatch):
+    """moto-backed client from iconml_s3.make_s3_client, with the test module's BUCKET already created."""
+    pytest.importorskip("boto3")
+    moto = pytest.importorskip("moto")
+    from iconml_s3 import make_s3_client
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        client = make_s3_client(endpoint_url=None)
+        client.create_bucket(Bucket=getattr(request.module, "BUCKET", "iconml-test"))
+        yield client
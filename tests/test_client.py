@@ -0,0 +1,168 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("boto3")
+pytest.importorskip("moto")
+
+from iconml_client import IconMLClient, ResultPoller, sha256_file
+from iconml_layout import partition_key
+from iconml_request_demo import PREFIX_IMAGERESULTS, PREFIX_IMAGES, PREFIX_INFORESULTS, PREFIX_REQUEST
+
+BUCKET = "iconml-test"
+LEVELS = 1
+
+
+@pytest.fixture
+def client(s3):
+    c = IconMLClient(bucket=BUCKET, partition_levels=LEVELS, poll_secs=0.05, max_wait=10, workers=4, s3=s3)
+    yield c
+    c.close()
+
+
+def _wait_for_key(s3, prefix, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        keys = [o["Key"] for o in s3.list_objects_v2(Bucket=BUCKET, Prefix=prefix).get("Contents", [])]
+        if keys:
+            return keys
+        time.sleep(0.02)
+    raise AssertionError(f"nothing under {prefix}")
+
+
+def _respond_later(s3, result_name, payload):
+    """Stand-in for the watcher: once the request lands, upload the matcher's result file unchanged."""
+    def _run():
+        _wait_for_key(s3, PREFIX_REQUEST)
+        s3.put_object(Bucket=BUCKET, Key=partition_key(PREFIX_IMAGERESULTS, result_name, LEVELS),
+                      Body=json.dumps(payload).encode("utf-8"))
+    t = threading.Thread(target=_run, daemon=True)
+    t.start()
+    return t
+
+
+def test_submit_icon_resolves_on_stem_named_result(s3, client, tmp_path):
+    icon = tmp_path / "abc.png"
+    icon.write_bytes(b"\x89PNG fake")
+    _respond_later(s3, "abc.json", {"upload_filename": "abc.png", "best_match": None})
+
+    res = client.submit_icon(icon, request={"icon_filename": "abc.png"}).result(timeout=10)
+    assert res["imageresult"]["upload_filename"] == "abc.png"
+    assert res["inforesult"] is None
+
+
+def test_submit_icon_with_matcher_output_name(s3, client, tmp_path, monkeypatch, sc):
+    monkeypatch.setattr(sc, "RESULTS_DIR", str(tmp_path / "imageresults"))
+    monkeypatch.setattr(sc, "INFO_DIR", str(tmp_path / "info"))
+    upload = tmp_path / "uploadimages" / "xcwewsss.webp"
+    sc.save_results_json(str(upload), [], None, sc.SIM_THRESHOLD, [])
+    (written,) = os.listdir(sc.RESULTS_DIR)
+    with open(os.path.join(sc.RESULTS_DIR, written), "r", encoding="utf-8") as f:
+        payload = json.load(f)
+
+    icon = tmp_path / "xcwewsss.webp"
+    icon.write_bytes(b"RIFF fake")
+    _respond_later(s3, written, payload)
+    res = client.submit_icon(icon, request={"icon_filename": icon.name}).result(timeout=10)
+    assert res["imageresult"]["upload_filename"] == "xcwewsss.webp"
+
+
+def test_submit_bulk_reuses_existing_result_and_isolates_unreadable_icons(s3, client, tmp_path):
+    (tmp_path / "a.png").write_bytes(b"icon-a")
+    (tmp_path / "b.png").write_bytes(b"icon-b")
+    sha_a = sha256_file(tmp_path / "a.png")
+    s3.put_object(Bucket=BUCKET, Key=partition_key(PREFIX_IMAGERESULTS, f"{sha_a}.json", LEVELS),
+                  Body=b'{"upload_filename": "cached"}')
+
+    futs = client.submit_bulk(tmp_path, [
+        {"icon_filename": "a.png"},
+        {"icon_filename": "missing.png"},
+        {"icon_filename": "b.png"},
+    ], max_wait=10)
+
+    assert futs[0].result(timeout=10) == {
+        "icon_filename": f"{sha_a}.png", "imageresult": {"upload_filename": "cached"}, "inforesult": None}
+    with pytest.raises(FileNotFoundError):
+        futs[1].result(timeout=1)
+    assert client.last_bulk_stats["cached_results"] == 1
+    assert client.last_bulk_stats["uploaded"] == 1
+    assert client.last_bulk_stats["unreadable_icons"] == 1
+    # b.png still went out: its request lands in the bucket
+    assert _wait_for_key(s3, PREFIX_REQUEST)
+    assert not futs[2].done()
+
+
+def test_submit_bulk_uploads_icon_for_hash_request_with_cached_image(s3, client, tmp_path):
+    (tmp_path / "a.png").write_bytes(b"icon-a")
+    sha_a = sha256_file(tmp_path / "a.png")
+    s3.put_object(Bucket=BUCKET, Key=partition_key(PREFIX_IMAGERESULTS, f"{sha_a}.json", LEVELS),
+                  Body=b'{"upload_filename": "cached"}')
+
+    futs = client.submit_bulk(tmp_path, [{"icon_filename": "a.png", "hash": "h1"}], max_wait=10)
+
+    # the request goes to the watcher, which needs images/<sha>.png to exist
+    assert client.last_bulk_stats["uploaded"] == 1
+    assert client.last_bulk_stats["cached_results"] == 0
+    assert _wait_for_key(s3, partition_key(PREFIX_IMAGES, f"{sha_a}.png", LEVELS))
+    (req_key,) = _wait_for_key(s3, PREFIX_REQUEST)
+    req = json.loads(s3.get_object(Bucket=BUCKET, Key=req_key)["Body"].read())
+    assert req == {"icon_filename": f"{sha_a}.png", "hash": "h1"}
+    s3.put_object(Bucket=BUCKET, Key=partition_key(PREFIX_INFORESULTS, "h1.json", LEVELS), Body=b'{"hash": "h1"}')
+    assert futs[0].result(timeout=10) == {
+        "icon_filename": f"{sha_a}.png", "imageresult": {"upload_filename": "cached"}, "inforesult": {"hash": "h1"}}
+
+    # a second icon-only request for the same content needs neither an upload nor a request
+    futs = client.submit_bulk(tmp_path, [{"icon_filename": "a.png"}], max_wait=10)
+    assert client.last_bulk_stats["uploaded"] == 0 and client.last_bulk_stats["cached_results"] == 1
+    assert futs[0].result(timeout=10)["imageresult"] == {"upload_filename": "cached"}
+
+
+class _FlakyList:
+    """Delegates to a real client; the first `failures` list calls raise a transport error."""
+    def __init__(self, s3, failures):
+        from botocore.exceptions import EndpointConnectionError
+        self._s3 = s3
+        self._left = failures
+        self._exc = EndpointConnectionError(endpoint_url="https://s3.invalid")
+
+    def list_objects_v2(self, **kw):
+        if self._left > 0:
+            self._left -= 1
+            raise self._exc
+        return self._s3.list_objects_v2(**kw)
+
+    def __getattr__(self, name):
+        return getattr(self._s3, name)
+
+
+def test_poller_survives_transport_errors(s3):
+    key = "iconml/imageresults/zz.json"
+    pool = ThreadPoolExecutor(max_workers=2)
+    poller = ResultPoller(_FlakyList(s3, failures=3), BUCKET, pool, poll_secs=0.01)
+    poller.start()
+    try:
+        fut = poller.wait_for(key, max_wait=10)
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b'{"ok": 1}')
+        assert fut.result(timeout=10) == {"ok": 1}
+        assert poller.is_alive()
+    finally:
+        poller.stop()
+        pool.shutdown()
+
+
+def test_poller_exit_fails_pending_futures(s3):
+    pool = ThreadPoolExecutor(max_workers=1)
+    poller = ResultPoller(s3, BUCKET, pool, poll_secs=0.01)
+    poller.start()
+    fut = poller.wait_for("iconml/imageresults/never.json", max_wait=3600)
+    poller.stop()
+    poller.join(timeout=5)
+    with pytest.raises(RuntimeError):
+        fut.result(timeout=1)
+    with pytest.raises(RuntimeError):
+        poller.wait_for("iconml/imageresults/late.json", max_wait=3600).result(timeout=1)
+    pool.shutdown()
@@ -0,0 +1,21 @@
+import pytest
+
+
+@pytest.fixture
+def cl(sc):
+    import iconml_cluster_library
+    return iconml_cluster_library
+
+
+@pytest.mark.parametrize("value,want", [("0/1", (0, 1)), ("3/4", (3, 4)), (" 1 / 2 ", (1, 2))])
+def test_parse_shard(cl, value, want):
+    assert cl.parse_shard(value) == want
+
+
+@pytest.mark.parametrize("value", ["4/4", "5/4", "-1/4", "1/0", "0/0", "1", "a/b", "1/2/3", ""])
+def test_bad_shard_is_a_usage_error(cl, value, monkeypatch, capsys):
+    monkeypatch.setattr(cl.sc, "load_matcher", lambda *a, **k: pytest.fail("loaded the library"))
+    with pytest.raises(SystemExit) as ei:
+        cl.main(["--shard", value])
+    assert ei.value.code == 2
+    assert "--shard" in capsys.readouterr().err
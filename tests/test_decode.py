@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+pytest.importorskip("PIL.Image")
+
+from iconml_decode import area_weights, decode_into, decode_rgb, resize_area_batch
+
+
+def _rand(shape, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, shape, dtype=np.uint8)
+
+
+@pytest.mark.parametrize("src,dst", [(64, 32), (48, 32), (72, 32), (33, 32), (20, 32), (192, 32), (7, 3)])
+def test_area_weights_rows_sum_to_one(src, dst):
+    w = area_weights(src, dst)
+    assert w.shape == (dst, src)
+    assert (w >= 0).all()
+    np.testing.assert_allclose(w.sum(axis=1), 1.0, atol=1e-6)
+
+
+@pytest.mark.parametrize("factor", [1, 2, 3, 6])
+def test_integer_downscale_is_block_mean(factor):
+    imgs = _rand((2, 32 * factor, 32 * factor, 3))
+    want = imgs.astype(np.float64).reshape(2, 32, factor, 32, factor, 3).mean(axis=(2, 4)) / 255.0
+    np.testing.assert_allclose(resize_area_batch(imgs, 32), want, atol=1e-6)
+
+
+@pytest.mark.parametrize("h,w", [(48, 48), (72, 72), (48, 72), (100, 36), (20, 20)])
+def test_non_integer_sizes_match_tf_area(h, w):
+    tf = pytest.importorskip("tensorflow")
+    imgs = _rand((3, h, w, 3), seed=h * w)
+    want = tf.image.resize(tf.constant(imgs, tf.float32) / 255.0, (32, 32), method="area").numpy()
+    np.testing.assert_allclose(resize_area_batch(imgs, 32), want, atol=1e-5)
+
+
+def test_decode_into_groups_sizes_writes_view_and_masks_failures(png):
+    srcs = [_rand((64, 64, 3), 1), _rand((48, 48, 3), 2), None, _rand((64, 64, 3), 3), _rand((20, 30, 3), 4)]
+    items = [png(a) if a is not None else b"not an image" for a in srcs]
+    lib = np.full((8, 32, 32, 3), 7, dtype=np.float32)
+    view = lib[2:7]
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        ok = decode_into(view, items, pool, read=lambda b: b)
+
+    assert ok.tolist() == [True, True, False, True, True]
+    for i, a in enumerate(srcs):
+        if a is not None:
+            np.testing.assert_allclose(lib[2 + i], resize_area_batch(a[np.newaxis], 32)[0], atol=1e-6)
+    assert (lib[:2] == 7).all() and (lib[7:] == 7).all()     # rows outside the slice untouched
+
+
+def test_decode_into_finish_quantizes_in_place(png):
+    a = _rand((64, 64, 3), 5)
+    out = np.zeros((1, 32, 32, 3), dtype=np.uint8)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        decode_into(out, [png(a)], pool, read=lambda b: b,
+                    finish=lambda x: np.clip(np.rint(x * 255.0), 0, 255).astype(np.uint8))
+    want = np.rint(a.astype(np.float64).reshape(32, 2, 32, 2, 3).mean(axis=(1, 3)))
+    assert np.abs(out[0].astype(np.int64) - want).max() <= 1
+
+
+@pytest.mark.parametrize("mode,shape", [("RGBA", (16, 16, 4)), ("LA", (16, 16, 2)), ("L", (16, 16))])
+def test_alpha_and_gray_match_tf_decode_channels_3(mode, shape, png):
+    tf = pytest.importorskip("tensorflow")
+    arr = _rand(shape, 6)
+    if mode == "RGBA":
+        arr[..., 3] = np.where(np.arange(16)[:, None] % 2 == 0, 0, 128)     # fully and half transparent rows
+    data = png(arr, mode)
+    want = tf.io.decode_image(data, channels=3).numpy()
+    got = decode_rgb(data)
+    assert got.shape == want.shape == (16, 16, 3)
+    np.testing.assert_array_equal(got, want)
@@ -0,0 +1,110 @@
+import json
+import logging
+
+import numpy as np
+import pytest
+
+from iconml_filters import MetadataIndex, filter_key, normalize_filter
+
+# path -> package; several base images per package
+PATHS = [
+    "base/com.a/0.png",        # 0
+    "base/com.a/1.png",        # 1
+    "base/com.a.b/0.png",      # 2
+    "base/com.ab/0.png",       # 3
+    "base/com.a~x/0.png",      # 4  '~' sorts after every letter
+    "base/com.b/0.png",        # 5
+    "base/org.c/0.png",        # 6
+    "base/com.aa/0.png",       # 7
+]
+INFO = {
+    "com.a":   {"devid": "DEV1", "permissions": "android.permission.SEND_SMS;android.permission.INTERNET"},
+    "com.a.b": {"devid": "dev1", "permissions": "android.permission.INTERNET"},
+    "com.ab":  {"devid": "dev2", "permissions": "android.permission.SEND_SMS"},
+    "com.a~x": {"devid": "dev3", "permissions": ""},
+    "com.b":   {"devid": "dev2", "permissions": "android.permission.SEND_SMS;android.permission.INTERNET"},
+    "org.c":   {},
+    "com.aa":  {"devid": "", "permissions": " android.permission.INTERNET ;"},
+}
+
+
+@pytest.fixture(scope="module")
+def index():
+    return MetadataIndex(PATHS, package_of=lambda p: p.split("/")[1], info_of=lambda pkg: INFO[pkg], workers=2)
+
+
+def _select(index, **raw):
+    rows = index.select(normalize_filter(raw))
+    assert rows is None or (rows.dtype == np.int64 and np.all(np.diff(rows) > 0))
+    return None if rows is None else rows.tolist()
+
+
+def test_no_filter_means_whole_library(index):
+    assert _select(index) is None
+    assert normalize_filter({"devid": "", "packages": [], "permissions": ["  "]}) is None
+    assert filter_key(None) == ""
+
+
+def test_prefix_bisect_covers_every_continuation(index):
+    assert _select(index, package_prefix="com.a") == [0, 1, 2, 3, 4, 7]
+    assert _select(index, package_prefix="com.a.") == [2]
+    assert _select(index, package_prefix="COM.A~") == [4]
+    assert _select(index, package_prefix="com.b") == [5]
+    assert _select(index, package_prefix="org.") == [6]
+    assert _select(index, package_prefix="net.") == []
+    assert _select(index, package_prefix="com.zz") == []              # bisect past the last package
+
+
+def test_or_within_field(index):
+    assert _select(index, devid=["dev1", "dev3"]) == [0, 1, 2, 4]     # devid compared case-insensitively
+    assert _select(index, packages=["com.b", "org.c", "com.nope"]) == [5, 6]
+    assert _select(index, package_prefix=["org.", "com.ab"]) == [3, 6]
+
+
+def test_and_across_fields(index):
+    assert _select(index, devid="dev2", permissions=["android.permission.SEND_SMS"]) == [3, 5]
+    assert _select(index, devid="dev2",
+                   permissions=["android.permission.SEND_SMS", "android.permission.INTERNET"]) == [5]
+    assert _select(index, package_prefix="com.a", permissions=["android.permission.INTERNET"]) == [0, 1, 2, 7]
+    assert _select(index, package_prefix="com.a", devid=["dev2", "dev3"]) == [3, 4]
+    assert _select(index, packages="com.b", devid="dev1") == []
+
+
+@pytest.mark.parametrize("raw", [
+    {"devid": "no-such-dev"},
+    {"permissions": ["android.permission.NO_SUCH"]},
+    {"packages": ["com.nope"]},
+    {"package_prefix": "com.a", "devid": "no-such-dev"},
+    {"devid": "dev1", "permissions": ["android.permission.INTERNET", "android.permission.NO_SUCH"]},
+])
+def test_unknown_values_select_nothing(index, raw):
+    assert _select(index, **raw) == []
+
+
+def test_filter_key_is_order_insensitive():
+    a = normalize_filter({"devid": ["B", "a"], "permissions": "x"})
+    b = normalize_filter({"permissions": ["X"], "devid": ["a", "b", "a"]})
+    assert a == b == {"devid": ["a", "b"], "permissions": ["x"]}
+    assert filter_key(a) == filter_key(b) != ""
+    assert json.loads(json.dumps(a)) == a
+
+
+def test_index_summary_is_logged(caplog):
+    with caplog.at_level(logging.INFO):
+        MetadataIndex(PATHS[:2], package_of=lambda p: p.split("/")[1], info_of=lambda pkg: INFO[pkg])
+    assert any("[FILTER] Metadata index: 1 packages" in r.getMessage() for r in caplog.records)
+
+
+def test_sidecar_lives_outside_the_scanned_directory(sc, tmp_path, monkeypatch):
+    from iconml_fsevents import DirWatcher
+    monkeypatch.setattr(sc, "FILTER_DIR", str(tmp_path / "uploadfilters"))
+    (tmp_path / "uploadfilters").mkdir()
+    side = tmp_path / "uploadfilters" / "abc.png.filter.json"
+    side.write_text(json.dumps({"devid": "dev1"}), encoding="utf-8")
+
+    assert sc.read_filter_sidecar(str(tmp_path / "uploadimages" / "abc.png")) == {"devid": "dev1"}
+    assert not side.exists()                                            # consumed exactly once
+    assert sc.read_filter_sidecar(str(tmp_path / "uploadimages" / "abc.png")) is None
+
+    w = DirWatcher(str(tmp_path), suffixes=sc.IMAGE_EXTS, poll_interval=0.1)
+    assert w._match("abc.png") and not w._match("abc.png.filter.json")
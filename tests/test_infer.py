@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from iconml_infer import GraphBackend, TFLiteBackend, _FixedBatchBackend
+
+SHAPE = (8, 8, 3)
+BATCH = 4
+
+
+def _tiny_siamese():
+    """Same layout as the production model (shared tower, |a-b|, sigmoid head), randomly initialised."""
+    tf.keras.utils.set_random_seed(0)
+    inp = tf.keras.Input(SHAPE)
+    x = tf.keras.layers.Conv2D(4, 3, activation="relu")(inp)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    tower = tf.keras.Model(inp, x)
+    a, b = tf.keras.Input(SHAPE), tf.keras.Input(SHAPE)
+    d = tf.keras.layers.Lambda(lambda t: tf.abs(t[0] - t[1]))([tower(a), tower(b)])
+    out = tf.keras.layers.Dense(1, activation="sigmoid")(d)
+    return tf.keras.Model([a, b], out)
+
+
+@pytest.fixture(scope="module")
+def model():
+    return _tiny_siamese()
+
+
+def _pairs(n, seed=1):
+    rng = np.random.default_rng(seed)
+    return (rng.random((n,) + SHAPE, dtype=np.float32), rng.random((n,) + SHAPE, dtype=np.float32))
+
+
+def _expected_padding(n):
+    return (-n) % BATCH
+
+
+@pytest.mark.parametrize("make", [
+    lambda m: GraphBackend(m, BATCH, SHAPE, jit=False),
+    lambda m: GraphBackend(m, BATCH, SHAPE, jit=True),
+    lambda m: TFLiteBackend(m, BATCH, SHAPE, quant="none", num_threads=1),
+], ids=["graph", "graph-xla", "tflite"])
+def test_backend_matches_eager_keras(model, make):
+    be = make(model)
+    padded = 0
+    for n in (1, BATCH - 1, BATCH, BATCH + 1, 3 * BATCH + 2):
+        left, right = _pairs(n, seed=n)
+        ref = model([left, right], training=False).numpy()
+        got = be([left, right], training=False)
+        assert got.shape == (n, 1)
+        np.testing.assert_allclose(got, ref, atol=1e-5)
+        padded += _expected_padding(n)
+        assert be.padded == padded
+
+
+def test_base_backend_is_abstract():
+    with pytest.raises(TypeError):
+        _FixedBatchBackend(BATCH, SHAPE)
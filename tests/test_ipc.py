@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import pytest
+
+from iconml_ipc import IPCError, IPCTimeout, IPCUnavailable, MatchIPCClient, MatchIPCServer
+
+
+@pytest.fixture
+def sock_path():
+    # AF_UNIX paths are length-limited, pytest's tmp_path can exceed that
+    d = tempfile.mkdtemp(prefix="ipc")
+    yield os.path.join(d, "m.sock")
+    shutil.rmtree(d, ignore_errors=True)
+
+
+def _server(sock_path, handler, **kw):
+    srv = MatchIPCServer(handler, sock_path, **kw)
+    srv.start()
+    return srv
+
+
+def test_match_round_trip_and_handler_error(sock_path):
+    def handler(name, data, meta):
+        if name == "bad.png":
+            raise ValueError("cannot decode")
+        return {"name": name, "size": len(data), "hash": meta.get("hash")}
+
+    srv = _server(sock_path, handler)
+    try:
+        c = MatchIPCClient(sock_path, timeout=5)
+        assert c.ping()
+        assert c.match("a.png", b"12345", hash="h1") == {"name": "a.png", "size": 5, "hash": "h1"}
+        with pytest.raises(IPCError, match="cannot decode"):
+            c.match("bad.png", b"")
+        assert c.match("b.png", b"x")["size"] == 1            # connection survives handler errors
+        c.close()
+    finally:
+        srv.close()
+
+
+def test_timeout_after_send_is_distinguished(sock_path):
+    started, finished = threading.Event(), threading.Event()
+
+    def handler(name, data, meta):
+        started.set()
+        time.sleep(0.5)
+        finished.set()            # the matcher still completes (and writes imageresults)
+        return {"name": name}
+
+    srv = _server(sock_path, handler)
+    try:
+        c = MatchIPCClient(sock_path, timeout=0.1)
+        with pytest.raises(IPCTimeout):
+            c.match("slow.png", b"x")
+        assert started.is_set()
+        assert finished.wait(5)
+    finally:
+        srv.close()
+
+
+def test_missing_socket_is_plain_unavailable(sock_path):
+    with pytest.raises(IPCUnavailable) as ei:
+        MatchIPCClient(sock_path, timeout=1).match("a.png", b"x")
+    assert not isinstance(ei.value, IPCTimeout)
+
+
+def test_connections_beyond_the_cap_are_rejected(sock_path):
+    release = threading.Event()
+    entered = []
+
+    def handler(name, data, meta):
+        entered.append(name)
+        release.wait(10)
+        return {"name": name}
+
+    srv = _server(sock_path, handler, max_connections=2)
+    try:
+        busy = [MatchIPCClient(sock_path, timeout=10) for _ in range(2)]
+        results = [None, None]
+        threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, busy[i].match(f"{i}.png", b"x")))
+                   for i in range(2)]
+        for t in threads:
+            t.start()
+        deadline = time.monotonic() + 5
+        while len(entered) < 2:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+        extra = MatchIPCClient(sock_path, timeout=5)
+        with pytest.raises(IPCUnavailable) as ei:           # closed without being served -> safe to fall back
+            extra.match("2.png", b"x")
+        assert not isinstance(ei.value, IPCTimeout)
+        assert srv.rejected == 1
+        assert len(entered) == 2
+
+        release.set()
+        for t in threads:
+            t.join(10)
+        assert [r["name"] for r in results] == ["0.png", "1.png"]
+        for c in busy:
+            c.close()
+        deadline = time.monotonic() + 5                     # slots are released when connections close
+        while True:
+            try:
+                assert MatchIPCClient(sock_path, timeout=5).match("3.png", b"x") == {"name": "3.png"}
+                break
+            except IPCUnavailable:
+                assert time.monotonic() < deadline
+                time.sleep(0.05)
+    finally:
+        srv.close()
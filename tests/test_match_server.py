@@ -0,0 +1,88 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp.test_utils import TestClient, TestServer
+
+
+@pytest.fixture
+def ms(sc, monkeypatch, tmp_path):
+    import iconml_match_server
+    from iconml_decode import decode_image
+    monkeypatch.setattr(sc, "load_image_bytes", lambda data, name: decode_image(data, sc.IMAGE_SIZE))
+    monkeypatch.setattr(sc, "INFO_DIR", str(tmp_path / "info"))
+    return iconml_match_server
+
+
+def _serve(sc, ms, model, scenario):
+    rng = np.random.default_rng(5)
+    raw = rng.integers(0, 256, (4, sc.IMAGE_SIZE, sc.IMAGE_SIZE, 3), dtype=np.uint8)
+    paths = [f"./images/com.pkg{i}_0.png" for i in range(4)]
+    lib = sc.BaseLibrary(paths, raw.astype(np.float32) / 255.0)
+
+    async def main():
+        app = ms.build_app(lambda: (lib, model), sc.ReadyStatus(None))
+        async with TestClient(TestServer(app)) as client:
+            for _ in range(500):
+                if (await client.get("/health")).status == 200:
+                    break
+                await asyncio.sleep(0.01)
+            return await scenario(client, app, raw)
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize("bad", ["abc", "", "nan", "inf"])
+def test_match_rejects_bad_threshold(sc, ms, bad, l1_model, png):
+    async def scenario(client, app, raw):
+        r = await client.post(f"/match?name=q.png&threshold={bad}", data=png(raw[1]))
+        return r.status, await r.text(), app["batcher"].queries
+    status, text, queries = _serve(sc, ms, l1_model, scenario)
+    assert status == 400 and "threshold" in text
+    assert queries == 0                                 # rejected before any inference
+
+
+def test_match_with_threshold(sc, ms, l1_model, png):
+    async def scenario(client, app, raw):
+        r = await client.post("/match?name=q.png&threshold=0.999", data=png(raw[2]))
+        return r.status, await r.json()
+    status, body = _serve(sc, ms, l1_model, scenario)
+    assert status == 200
+    assert body["best_match"]["package"] == "com.pkg2"
+
+
+def test_match_builds_payload_off_the_event_loop(sc, ms, monkeypatch, l1_model, png):
+    seen = []
+    build = sc.build_results_payload
+
+    def spy(*args, **kw):
+        seen.append(threading.current_thread().name)
+        return build(*args, **kw)
+    monkeypatch.setattr(sc, "build_results_payload", spy)
+
+    async def scenario(client, app, raw):
+        r = await client.post("/match?name=q.png", data=png(raw[0]))
+        return r.status
+    assert _serve(sc, ms, l1_model, scenario) == 200
+    assert len(seen) == 1 and seen[0].startswith("decode")
+
+
+def test_run_serial_uses_the_inference_thread(sc, ms, monkeypatch, l1_model):
+    seen = []
+
+    def fake_neighbours(model, lib, items, top_k, same_package):
+        seen.append(threading.current_thread().name)
+        return [{"query": q, "neighbours": []} for q in items]
+    monkeypatch.setattr(sc, "library_neighbours", fake_neighbours)
+
+    async def scenario(client, app, raw):
+        batcher = app["batcher"]
+        name = await batcher.run_serial(lambda: threading.current_thread().name)
+        r = await client.get("/neighbours?q=com.pkg1&k=3")
+        return name, r.status, await r.json()
+    name, status, body = _serve(sc, ms, l1_model, scenario)
+    assert name.startswith("infer")
+    assert status == 200 and body["results"][0]["query"] == "com.pkg1"
+    assert seen and seen[0] == name
@@ -0,0 +1,136 @@
+import itertools
+import sqlite3
+import threading
+import time
+import types
+
+import pytest
+
+import iconml_result_cache
+from iconml_result_cache import ResultCache, make_context
+
+CTX = make_context("lib0", "w0", 0.5)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Strictly increasing used_at so LRU order on disk does not depend on timer resolution."""
+    ticks = itertools.count(1)
+    monkeypatch.setattr(iconml_result_cache, "time", types.SimpleNamespace(time=lambda: float(next(ticks))))
+
+
+def _db_rows(path):
+    with sqlite3.connect(path) as db:
+        return sorted(db.execute("SELECT icon_sha256, context FROM results").fetchall())
+
+
+def _run_callers(cache, n, compute):
+    results, errors = [None] * n, [None] * n
+
+    def call(i):
+        try:
+            results[i] = cache.get_or_compute("aa", compute)
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    return threads, results, errors
+
+
+def _wait_until(cond, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def test_concurrent_callers_compute_once(tmp_path):
+    cache = ResultCache(str(tmp_path / "c.sqlite"), CTX)
+    release, calls = threading.Event(), []
+
+    def compute():
+        calls.append(1)
+        release.wait(10)
+        return [(3, 0.9), (1, 0.7)]
+
+    n = 8
+    threads, results, errors = _run_callers(cache, n, compute)
+    _wait_until(lambda: cache.coalesced == n - 1)     # everyone else is parked on the leader's Future
+    release.set()
+    for t in threads:
+        t.join(10)
+
+    assert len(calls) == 1
+    assert errors == [None] * n
+    assert all(r[0] == [(3, 0.9), (1, 0.7)] for r in results)
+    assert sorted(r[1] for r in results) == [False] + [True] * (n - 1)
+    assert (cache.misses, cache.coalesced) == (1, n - 1)
+    assert cache.get_or_compute("aa", lambda: pytest.fail("recomputed")) == ([(3, 0.9), (1, 0.7)], True)
+    cache.close()
+
+
+def test_compute_error_reaches_every_waiter(tmp_path):
+    cache = ResultCache(str(tmp_path / "c.sqlite"), CTX)
+    release = threading.Event()
+
+    def compute():
+        release.wait(10)
+        raise ValueError("model exploded")
+
+    n = 5
+    threads, results, errors = _run_callers(cache, n, compute)
+    _wait_until(lambda: cache.coalesced == n - 1)
+    release.set()
+    for t in threads:
+        t.join(10)
+
+    assert results == [None] * n
+    assert all(isinstance(e, ValueError) and "model exploded" in str(e) for e in errors)
+    assert cache.get("aa") is None                     # failures are not cached...
+    assert cache.get_or_compute("aa", lambda: [(0, 1.0)]) == ([(0, 1.0)], False)   # ...and the next call retries
+    cache.close()
+
+
+def test_eviction_survives_reopen(tmp_path, clock):
+    path = str(tmp_path / "c.sqlite")
+    cache = ResultCache(path, CTX, max_entries=3)
+    for sha in ("s1", "s2", "s3"):
+        cache.put(sha, [(int(sha[1]), 0.5)])
+    assert cache.get("s1") is not None                # s1 is now the most recently used
+    cache.put("s4", [(4, 0.5)])                        # evicts s2
+    cache.put("s5", [(5, 0.5)])                        # evicts s3
+    cache.close()
+    assert [r[0] for r in _db_rows(path)] == ["s1", "s4", "s5"]
+
+    reopened = ResultCache(path, CTX, max_entries=3)
+    assert list(reopened._lru) == ["s1", "s4", "s5"]   # restored in LRU order
+    assert reopened.get("s2") is None and reopened.get("s3") is None
+    assert reopened.get("s4") == [(4, 0.5)]
+    reopened.close()
+
+    smaller = ResultCache(path, CTX, max_entries=2)   # shrinking the limit trims the oldest on open
+    assert list(smaller._lru) == ["s5", "s4"]         # s4 was touched after reopening, s1 is the oldest
+    smaller.close()
+    assert [r[0] for r in _db_rows(path)] == ["s4", "s5"]
+
+
+def test_context_change_drops_old_rows(tmp_path):
+    path = str(tmp_path / "c.sqlite")
+    cache = ResultCache(path, CTX)
+    cache.put("s1", [(1, 0.9)])
+    cache.put("s2", [(2, 0.8)])
+    cache.close()
+
+    other = make_context("lib1", "w0", 0.5)           # e.g. the base library changed
+    cache = ResultCache(path, other)
+    assert cache.get("s1") is None and len(cache._lru) == 0
+    assert _db_rows(path) == []
+    cache.put("s1", [(7, 0.6)])
+    cache.close()
+    assert _db_rows(path) == [("s1", other)]
+
+    cache = ResultCache(path, CTX)                     # switching back does not resurrect the old rows
+    assert cache.get("s1") is None
+    cache.close()
@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("boto3")
+pytest.importorskip("moto")
+
+from botocore.awsrequest import AWSResponse
+
+from iconml_s3 import DELETE_BATCH_MAX, TransferEngine
+
+BUCKET = "iconml-s3x-test"
+
+
+class _Gauge:
+    """Tracks concurrently running work items, overall and per lane."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = {}
+        self.peak = {}
+        self.order = {}
+
+    def enter(self, lane, i):
+        with self.lock:
+            self.active[lane] = self.active.get(lane, 0) + 1
+            self.active["*"] = self.active.get("*", 0) + 1
+            for k in (lane, "*"):
+                self.peak[k] = max(self.peak.get(k, 0), self.active[k])
+            self.order.setdefault(lane, []).append(i)
+
+    def leave(self, lane):
+        with self.lock:
+            self.active[lane] -= 1
+            self.active["*"] -= 1
+
+
+def test_lanes_serialize_and_pool_bounds_concurrency(s3):
+    workers = 4
+    engine = TransferEngine(client=s3, workers=workers)
+    gauge = _Gauge()
+
+    def work(lane, i):
+        gauge.enter(lane, i)
+        try:
+            engine.s3.put_object(Bucket=BUCKET, Key=f"{lane}/{i}", Body=b"x")
+            time.sleep(0.01)
+        finally:
+            gauge.leave(lane)
+        return i
+
+    lanes = [f"req{n}" for n in range(6)]
+    futs = [engine.submit(work, lane, i, lane=lane) for i in range(5) for lane in lanes]
+    futs += [engine.submit(work, "free", i) for i in range(8)]
+    assert sorted(f.result(timeout=30) for f in futs) == sorted(list(range(5)) * 6 + list(range(8)))
+    engine.shutdown()
+
+    for lane in lanes:
+        assert gauge.peak[lane] == 1                      # one at a time per lane
+        assert gauge.order[lane] == list(range(5))        # in submission order
+    assert 1 < gauge.peak["*"] <= workers                 # lanes run in parallel, bounded by the pool
+    keys = {o["Key"] for o in s3.list_objects_v2(Bucket=BUCKET)["Contents"]}
+    assert len(keys) == 6 * 5 + 8
+
+
+class _PartialDeletes:
+    """Real client, except delete_objects reports AccessDenied for `denied` keys and records batch sizes."""
+    def __init__(self, s3, denied):
+        self._s3 = s3
+        self.denied = set(denied)
+        self.batches = []
+
+    def delete_objects(self, Bucket, Delete):
+        keys = [o["Key"] for o in Delete["Objects"]]
+        self.batches.append(len(keys))
+        ok = [{"Key": k} for k in keys if k not in self.denied]
+        resp = self._s3.delete_objects(Bucket=Bucket, Delete=dict(Delete, Objects=ok)) if ok else {}
+        resp["Errors"] = resp.get("Errors", []) + [
+            {"Key": k, "Code": "AccessDenied", "Message": "Access Denied"} for k in keys if k in self.denied]
+        return resp
+
+    def __getattr__(self, name):
+        return getattr(self._s3, name)
+
+
+def test_delete_batches_at_limit_and_reports_per_key_errors(s3, caplog):
+    n = 2 * DELETE_BATCH_MAX + 500
+    keys = [f"icons/{i:05d}.png" for i in range(n)]
+    for k in keys:
+        s3.put_object(Bucket=BUCKET, Key=k, Body=b"")
+    denied = {keys[3], keys[DELETE_BATCH_MAX + 7], keys[-1]}
+    client = _PartialDeletes(s3, denied)
+    engine = TransferEngine(client=client, workers=2)
+
+    for k in keys + keys[-10:]:                     # duplicates within a batch are sent once
+        engine.delete_later(BUCKET, k)
+    with caplog.at_level(logging.WARNING):
+        deleted = engine.flush_deletes()
+    engine.shutdown()
+
+    assert client.batches[:2] == [DELETE_BATCH_MAX, DELETE_BATCH_MAX]   # auto-flushed when full
+    assert all(b <= DELETE_BATCH_MAX for b in client.batches)
+    assert sum(client.batches) == n
+    assert deleted == n - DELETE_BATCH_MAX * 2 - len([k for k in denied if k in keys[2 * DELETE_BATCH_MAX:]])
+    for k in denied:
+        assert any(k in r.getMessage() and "AccessDenied" in r.getMessage() for r in caplog.records)
+    left = set()
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=BUCKET, Prefix="icons/"):
+        left.update(o["Key"] for o in page.get("Contents", []))
+    assert left == denied
+
+
+class _Raw:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kw):
+        yield self.body
+
+
+def test_throttled_puts_are_retried(s3, tmp_path):
+    throttles = [2]
+    attempts = [0]
+
+    def slow_down(request, **kw):
+        attempts[0] += 1
+        if throttles[0] > 0:
+            throttles[0] -= 1
+            body = b'<?xml version="1.0"?><Error><Code>SlowDown</Code><Message>Please reduce your request rate.</Message></Error>'
+            return AWSResponse(request.url, 503, {}, _Raw(body))
+        return None
+
+    s3.meta.events.register_first("before-send.s3.PutObject", slow_down)
+    src = tmp_path / "icon.png"
+    src.write_bytes(b"\x89PNG icon")
+    engine = TransferEngine(client=s3, workers=2)
+    engine.submit(engine.upload, BUCKET, "images/icon.png", str(src)).result(timeout=60)
+    engine.shutdown()
+
+    assert attempts[0] == 3
+    assert s3.get_object(Bucket=BUCKET, Key="images/icon.png")["Body"].read() == b"\x89PNG icon"
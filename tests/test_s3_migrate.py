@@ -0,0 +1,64 @@
+import threading
+
+import pytest
+
+pytest.importorskip("boto3")
+pytest.importorskip("moto")
+
+import iconml_s3_migrate
+from iconml_layout import partition_key
+from iconml_s3 import TransferEngine
+
+BUCKET = "iconml-migrate-test"
+PREFIX = "iconml/images/"
+
+
+class _CountingEngine(TransferEngine):
+    """Tracks how many submitted copies are outstanding at once."""
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self._count_lock = threading.Lock()
+        self.outstanding = 0
+        self.peak = 0
+
+    def submit(self, fn, *args, lane=None, **kwargs):
+        with self._count_lock:
+            self.outstanding += 1
+            self.peak = max(self.peak, self.outstanding)
+        fut = super().submit(fn, *args, lane=lane, **kwargs)
+        fut.add_done_callback(self._done)
+        return fut
+
+    def _done(self, _f):
+        with self._count_lock:
+            self.outstanding -= 1
+
+
+def _keys(s3, prefix):
+    out = set()
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=BUCKET, Prefix=prefix):
+        out.update(o["Key"] for o in page.get("Contents", []))
+    return out
+
+
+def test_migrate_submits_in_bounded_windows(s3, monkeypatch):
+    monkeypatch.setattr(iconml_s3_migrate, "MIGRATE_WINDOW", 7)
+    names = [f"{i:064x}.png" for i in range(30)]
+    for n in names:
+        s3.put_object(Bucket=BUCKET, Key=PREFIX + n, Body=n.encode())
+    engine = _CountingEngine(client=s3, workers=4)
+
+    moved = iconml_s3_migrate.migrate_prefix(engine, BUCKET, PREFIX, 2, dry_run=False, keep_source=False)
+    engine.shutdown()
+
+    assert moved == 30
+    assert engine.peak <= 7
+    expected = {partition_key(PREFIX, n, 2) for n in names}
+    assert _keys(s3, PREFIX) == expected
+    for n in names[:3]:
+        assert s3.get_object(Bucket=BUCKET, Key=partition_key(PREFIX, n, 2))["Body"].read() == n.encode()
+
+    # idempotent: nothing left to move
+    engine = _CountingEngine(client=s3, workers=4)
+    assert iconml_s3_migrate.migrate_prefix(engine, BUCKET, PREFIX, 2, dry_run=False, keep_source=False) == 0
+    engine.shutdown()
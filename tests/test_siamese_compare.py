@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+
+def _merge_in_chunks(sc, scores, k, chunk):
+    q = scores.shape[0]
+    best_s = np.empty((q, 0), dtype=np.float32)
+    best_i = np.empty((q, 0), dtype=np.int64)
+    for l0 in range(0, scores.shape[1], chunk):
+        best_s, best_i = sc.topk_merge(best_s, best_i, scores[:, l0:l0 + chunk], l0, k)
+    order = np.argsort(-best_s, axis=1, kind="stable")
+    return np.take_along_axis(best_s, order, axis=1), np.take_along_axis(best_i, order, axis=1)
+
+
+@pytest.mark.parametrize("n,k,chunk", [(100, 10, 7), (100, 10, 100), (64, 5, 1), (50, 10, 16)])
+def test_topk_merge_matches_full_sort(sc, n, k, chunk):
+    scores = np.random.default_rng(n + k + chunk).random((4, n), dtype=np.float32)
+    top_s, top_i = _merge_in_chunks(sc, scores, k, chunk)
+    ref_i = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    np.testing.assert_array_equal(top_i, ref_i)
+    np.testing.assert_array_equal(top_s, np.take_along_axis(scores, ref_i, axis=1))
+
+
+def test_topk_merge_with_ties_across_chunks(sc):
+    # 0.9 appears in every chunk; only 3 of the 6 tied entries fit in k
+    scores = np.array([[0.1, 0.9, 0.5, 0.9, 0.2, 0.9, 0.99, 0.9, 0.3, 0.9, 0.9, 0.0]], dtype=np.float32)
+    top_s, top_i = _merge_in_chunks(sc, scores, 4, 3)
+    np.testing.assert_array_equal(top_s[0], np.float32([0.99, 0.9, 0.9, 0.9]))
+    assert top_i[0, 0] == 6
+    tied = set(np.where(scores[0] == np.float32(0.9))[0])
+    assert set(top_i[0, 1:].tolist()) <= tied and len(set(top_i[0].tolist())) == 4
+
+
+def test_topk_merge_k_larger_than_n(sc):
+    scores = np.array([[0.3, 0.7, 0.5], [0.0, 0.0, 1.0]], dtype=np.float32)
+    top_s, top_i = _merge_in_chunks(sc, scores, 10, 2)
+    assert top_s.shape == top_i.shape == (2, 3)
+    np.testing.assert_array_equal(top_i[0], [1, 2, 0])
+    assert top_i[1, 0] == 2 and sorted(top_i[1].tolist()) == [0, 1, 2]
+
+
+def test_uint8_round_trip_within_one_step(sc):
+    x = np.random.default_rng(0).random((16, 32, 32, 3), dtype=np.float32)
+    q = sc.quantize_image(x)
+    assert q.dtype == np.uint8
+    back = sc.as_float_batch(q)
+    assert back.dtype == np.float32
+    assert np.abs(back - x).max() <= 1.0 / 255.0
+    assert sc.as_float_batch(x) is x          # float batches pass through untouched
+
+
+def test_uint8_library_scores_track_float32(sc, monkeypatch, l1_model):
+    monkeypatch.setattr(sc, "print", lambda *a, **k: None, raising=False)
+    rng = np.random.default_rng(1)
+    lib = rng.random((300, 32, 32, 3), dtype=np.float32)
+    lib_q = sc.quantize_image(lib)
+    model = l1_model
+    for qi in (0, 17, 299):
+        s_ref = sc.predict_similarity_pairs(model, lib[qi], lib, batch_size=64)
+        s_q = sc.predict_similarity_pairs(model, lib[qi], lib_q, batch_size=64)
+        assert np.abs(s_ref - s_q).max() <= 1.0 / 255.0
+        assert np.argmax(s_q) == qi
+
+
+@pytest.mark.parametrize("pattern", ["random", "none", "all", "head", "tail", "alternate"])
+def test_compact_rows_in_place(sc, pattern):
+    rng = np.random.default_rng(7)
+    n = 53
+    keep = {"random": rng.random(n) < 0.7, "none": np.zeros(n, bool), "all": np.ones(n, bool),
+            "head": np.arange(n) >= 5, "tail": np.arange(n) < n - 5, "alternate": np.arange(n) % 2 == 0}[pattern]
+    arr = rng.integers(0, 256, size=(n, 4, 4, 3), dtype=np.uint8)
+    expected = arr[keep].copy()
+    buf = arr.__array_interface__["data"][0]
+    m = sc.compact_rows(arr, keep, chunk=4)
+    assert m == int(keep.sum())
+    np.testing.assert_array_equal(arr[:m], expected)
+    assert arr.__array_interface__["data"][0] == buf
+
+
+def test_preload_drops_unreadable_rows_without_copying(sc, tmp_path):
+    from PIL import Image
+    rng = np.random.default_rng(3)
+    for i in range(6):
+        if i in (0, 3):
+            (tmp_path / f"{i}.png").write_bytes(b"not an image")
+        else:
+            Image.fromarray(rng.integers(0, 256, (40, 40, 3), dtype=np.uint8)).save(tmp_path / f"{i}.png")
+    paths, imgs = sc.preload_base_images(str(tmp_path), dtype="uint8", workers=2, decoder="numpy")
+    assert sorted(p.rsplit("/", 1)[-1] for p in paths) == ["1.png", "2.png", "4.png", "5.png"]
+    assert imgs.shape == (4, sc.IMAGE_SIZE, sc.IMAGE_SIZE, 3) and imgs.base is not None   # a view of the load buffer
+    from iconml_decode import decode_image
+    for p, row in zip(paths, imgs):
+        np.testing.assert_array_equal(row, sc.quantize_image(decode_image(open(p, "rb").read(), sc.IMAGE_SIZE)))
+
+
+def test_cluster_score_gathers_representatives_per_batch(sc, monkeypatch, l1_model):
+    monkeypatch.setattr(sc, "print", lambda *a, **k: None, raising=False)
+    monkeypatch.setattr(sc, "BATCH_SIZE", 4)
+    rng = np.random.default_rng(11)
+    imgs = sc.quantize_image(rng.random((10, 32, 32, 3), dtype=np.float32))
+    lib = sc.BaseLibrary([f"./images/p{i}_0.png" for i in range(10)], imgs)
+    reps = np.array([0, 3, 5, 6, 7, 8, 9], dtype=np.int64)
+    groups = [np.array([1, 2]), np.array([4]), np.empty(0, np.int64)] + [np.empty(0, np.int64)] * 4
+    idx = sc.ClusterIndex(lib, reps, groups, gate=0.999)
+    assert not any(isinstance(v, np.ndarray) and v.ndim == 4 for v in vars(idx).values())   # no library copy
+
+    model = l1_model
+    full = sc.predict_similarity_pairs(model, sc.as_float_batch(imgs[3]), imgs)
+    out = idx.score(model, sc.as_float_batch(imgs[3]), lib)
+    np.testing.assert_allclose(out[reps], full[reps], rtol=0, atol=1e-6)
+    np.testing.assert_allclose(out[4], full[4], rtol=0, atol=1e-6)     # cluster of rep 3 expanded
+    assert out[1] == out[2] == 0.0 and idx.expanded == 1
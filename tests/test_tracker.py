@@ -0,0 +1,36 @@
+from iconml_tracker import CompletionTracker
+
+
+def _tracker(tmp_path):
+    info, image = tmp_path / "inforesults", tmp_path / "imageresults"
+    info.mkdir()
+    image.mkdir()
+    return CompletionTracker(info_dirs=[str(info)], image_dirs=[str(image)]), info, image
+
+
+def test_mark_image_before_registration_skips_the_file_probe(tmp_path, monkeypatch):
+    tr, info, image = _tracker(tmp_path)
+    (info / "h1.json").write_text("{}")
+    (info / "h2.json").write_text("{}")
+    tr.mark_image("icon1")                        # IPC returned before the batch is registered
+
+    probed = []
+    real = CompletionTracker._exists_in
+    monkeypatch.setattr(CompletionTracker, "_exists_in",
+                        staticmethod(lambda dirs, fname: probed.append(fname) or real(dirs, fname)))
+    tr.add_batch("b", ["h1", "h2"], icons={"h1": "icon1.png", "h2": "icon2.png"})
+
+    assert tr.remaining["b"] == {"h2"}
+    assert "icon1.json" not in probed
+
+
+def test_mark_image_settles_registered_hashes(tmp_path):
+    tr, info, image = _tracker(tmp_path)
+    tr.add_batch("b", ["h1"], icons={"h1": "icon1.png"})
+    assert tr.remaining["b"] == {"h1"}
+    assert tr.mark_image("icon1") == set()        # info half still missing
+    (info / "h1.json").write_text("{}")
+    assert tr.on_info("h1") == {"b"}
+    assert tr.is_complete("b")
+    tr.drop_batch("b")
+    assert "icon1" not in tr._image_done